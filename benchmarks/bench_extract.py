@@ -0,0 +1,42 @@
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ghost_text import extract_text
+from fake_services import sample_post
+
+# Usage: python benchmarks/bench_extract.py [posts] [paragraphs per post]
+WORDS = ['ghost', 'post', 'embedding', 'related', 'tag', 'content', 'search', 'editor', 'theme',
+    'member', 'newsletter', 'publish', 'draft', 'card', 'section', 'markup', 'lexical', 'mobiledoc']
+
+
+def corpus(posts, paragraphs, seed=0):
+    rng = random.Random(seed)
+    result = []
+    for i in range(posts):
+        texts = [' '.join(rng.choice(WORDS) for _ in range(rng.randint(40, 120))) for _ in range(paragraphs)]
+        result.append(sample_post(texts, 'Post '+str(i)))
+    return result
+
+
+def main():
+    posts = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    paragraphs = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    samples = corpus(posts, paragraphs)
+    print(str(posts)+" posts of "+str(paragraphs)+" paragraphs")
+    for name in ('mobiledoc', 'lexical', 'html'):
+        documents = [sample[name] for sample in samples]
+        size = sum(len(document.get(name) or '') for document in documents)
+        start = time.perf_counter()
+        characters = 0
+        for document in documents:
+            characters += len(extract_text(document))
+        elapsed = time.perf_counter() - start
+        print("%-10s %8.0f posts/s %7.1f MB/s in, %d characters out" % (name, posts / elapsed, size / elapsed / 1e6, characters))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fake_services import FakeServices, synthetic_posts
+
+# Runs the scripts end to end against the local fake Ghost and OpenAI services, as
+# subprocesses with a generated .env, and reports for each one the wall time, posts
+# per second, p50/p99 per-post latency (first listed to finished), requests by
+# endpoint and peak RSS.
+#
+#   python benchmarks/bench_scripts.py --sizes 1000,10000
+#   python benchmarks/bench_scripts.py --sizes 1000 --openai-latency 0.2 --throttle-every 50 --collide-every 100
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+ADMIN_KEY = '0123456789abcdef01234567:' + '0123456789abcdef' * 4
+
+# name: (script, arguments), run in this order against one site
+SCRIPTS = {
+    'embed': ('ghost_embeddings.py', []),
+    'relate': ('ghost_relation_tags.py', []),
+    'tag': ('ghost_tag_blogs.py', []),
+    'vocabulary': ('ghost_tag_blogs.py', ['reset', 'vocabulary']),
+    'cleanup': ('ghost_tag_cleanup.py', ['both']),
+    # embed, relate and tag in one run; compare with --scripts embed,relate,tag
+    'pipeline': ('ghostai.py', ['pipeline']),
+}
+
+
+def write_env(directory, site_url, settings):
+    values = {
+        'GHOST_ADMIN_API_KEY': ADMIN_KEY,
+        'GHOST_SITE_URL': site_url,
+        'OPENAI_API_KEY': 'sk-benchmark',
+        'LOG_PATH': './log',
+        'EMBEDDING_OUTPUT_PATH': './output',
+        'EMBEDDING_CACHE_PATH': './cache/embeddings.sqlite',
+        'MAX_RELATED_BLOG_COUNT': '5',
+        'BLOG_TAG_COUNT': '5',
+        # The fake services throttle on their own; the client side limits would only
+        # measure themselves
+        'OPENAI_REQUESTS_PER_MINUTE': '0',
+        'OPENAI_TOKENS_PER_MINUTE': '0',
+        'OPENAI_CHAT_REQUESTS_PER_MINUTE': '0',
+        'OPENAI_CHAT_TOKENS_PER_MINUTE': '0',
+        'GHOST_REQUESTS_PER_MINUTE': '0',
+    }
+    values.update(settings)
+    with open(os.path.join(directory, '.env'), 'w') as f:
+        f.write('[BASIC]\n')
+        for name, value in values.items():
+            f.write(name+'='+str(value)+'\n')
+
+
+def run_script(name, directory, services):
+    # Peak RSS comes from wait4, which reports it for this child alone
+    script, arguments = SCRIPTS[name]
+    environment = dict(os.environ, OPENAI_BASE_URL=services.url+'/v1', PYTHONUNBUFFERED='1')
+    services.reset_stats()
+    with open(os.path.join(directory, name+'.out'), 'w') as output:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, os.path.join(REPO, script)] + arguments, cwd=directory, env=environment, stdout=output, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    result = services.stats()
+    result.update({
+        'script': name,
+        'exit_code': process.returncode,
+        'seconds': round(elapsed, 2),
+        'posts_per_second': round(len(services.posts) / elapsed, 1),
+        # ru_maxrss is in kilobytes on Linux, bytes on macOS
+        'peak_rss_mb': round(usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1),
+    })
+    return result
+
+
+def print_result(result):
+    requests = ', '.join(name+'='+str(count) for name, count in result['requests'].items())
+    latency = '%8s %8s' % (result['p50_ms'] if result['p50_ms'] is not None else '-', result['p99_ms'] if result['p99_ms'] is not None else '-')
+    failed = '' if result['exit_code'] == 0 else '  EXIT '+str(result['exit_code'])
+    print('%-11s %8.2f %9.1f %s %9.1f  %s%s' % (result['script'], result['seconds'], result['posts_per_second'], latency, result['peak_rss_mb'], requests, failed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the scripts against local fake Ghost and OpenAI services.')
+    parser.add_argument('--sizes', default='1000', help='comma separated corpus sizes, e.g. 1000,10000,100000')
+    parser.add_argument('--scripts', default='embed,relate,tag,vocabulary,cleanup', help='comma separated, from: '+', '.join(SCRIPTS))
+    parser.add_argument('--paragraphs', type=int, default=4, help='paragraphs per post')
+    parser.add_argument('--words', type=int, default=40, help='words per paragraph')
+    parser.add_argument('--dimensions', type=int, default=256, help='size of the fake embedding vectors')
+    parser.add_argument('--ghost-latency', type=float, default=0.005, help='seconds added to every Ghost request')
+    parser.add_argument('--openai-latency', type=float, default=0.05, help='seconds added to every OpenAI request')
+    parser.add_argument('--throttle-every', type=int, default=0, help='answer every Nth request with a 429')
+    parser.add_argument('--collide-every', type=int, default=0, help='answer every Nth PUT with a 409 update collision')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help='extra .env setting, may be repeated')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the working directories with the output and logs')
+    options = parser.parse_args()
+
+    settings = dict(setting.split('=', 1) for setting in options.env)
+    names = [name for name in options.scripts.split(',') if name]
+    for name in names:
+        if name not in SCRIPTS:
+            parser.error('unknown script '+name)
+
+    results = []
+    for size in [int(size) for size in options.sizes.split(',')]:
+        start = time.perf_counter()
+        posts = synthetic_posts(size, options.paragraphs, options.words)
+        print(str(size)+" posts generated in "+str(round(time.perf_counter() - start, 1))+"s")
+        services = FakeServices(posts, options.dimensions, options.ghost_latency, options.openai_latency, options.throttle_every, options.collide_every).start()
+        directory = tempfile.mkdtemp(prefix='ghostai-bench-'+str(size)+'-')
+        write_env(directory, services.url, settings)
+        print('%-11s %8s %9s %8s %8s %9s  %s' % ('script', 'seconds', 'posts/s', 'p50 ms', 'p99 ms', 'RSS MB', 'requests'))
+        for name in names:
+            result = run_script(name, directory, services)
+            result['posts'] = size
+            results.append(result)
+            print_result(result)
+        services.stop()
+        if options.keep:
+            print("Output and logs kept in "+directory)
+        else:
+            shutil.rmtree(directory)
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if any(result['exit_code'] != 0 for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bench_scripts import write_env
+
+# Import cost of each script: cumulative milliseconds from python -X importtime, the
+# heaviest top level imports, and the wall time of starting python and importing it.
+# Nothing is run; importing a script no longer touches the network or the output.
+#
+#   python benchmarks/bench_startup.py [repeats]
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+MODULES = ['ghost_embeddings', 'ghost_relation_tags', 'ghost_tag_blogs', 'ghost_tag_cleanup']
+
+
+def import_times(module, directory):
+    # {imported module: cumulative microseconds} for the modules imported directly by
+    # the script, and the script itself
+    environment = dict(os.environ, PYTHONPATH=REPO)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import '+module], cwd=directory, env=environment, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(result.stderr)
+    times = {}
+    children = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Modules are listed after everything they import, one level deeper
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 1:
+            children[name.strip()] = int(cumulative)
+        elif depth == 0:
+            if name.strip() == module:
+                times = dict(children, **{module: int(cumulative)})
+            children = {}
+    return times
+
+
+def wall_time(module, directory, repeats):
+    environment = dict(os.environ, PYTHONPATH=REPO)
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import '+module], cwd=directory, env=environment, check=True, capture_output=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    directory = tempfile.mkdtemp(prefix='ghostai-startup-')
+    write_env(directory, 'http://127.0.0.1:9', {})
+    try:
+        baseline = wall_time('os', directory, repeats)
+        print("python alone %.0f ms" % (baseline * 1000))
+        print('%-20s %10s %10s  %s' % ('script', 'import ms', 'wall ms', 'heaviest imports'))
+        for module in MODULES:
+            times = import_times(module, directory)
+            total = times.pop(module)
+            heaviest = sorted(times.items(), key=lambda entry: -entry[1])[:4]
+            print('%-20s %10.0f %10.0f  %s' % (module, total / 1000, wall_time(module, directory, repeats) * 1000,
+                ', '.join(name+' '+str(round(micros / 1000))+'ms' for name, micros in heaviest)))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+import threading
+import http.server
+import jwt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from concurrent.futures import ThreadPoolExecutor
+from ghost_admin import GhostAdminClient, TokenProvider
+
+# Usage: python benchmarks/bench_token.py [requests] [threads]
+ADMIN_KEY = '0123456789abcdef01234567:' + '0123456789abcdef' * 4
+
+
+def sign_every_time():
+    # What every request used to do: parse the key and sign a new token
+    key_id, secret = ADMIN_KEY.split(':')
+    iat = int(time.time())
+    token = jwt.encode({'iat': iat, 'exp': iat + 5 * 60, 'aud': '/admin/'}, bytes.fromhex(secret), algorithm='HS256',
+        headers={'alg': 'HS256', 'typ': 'JWT', 'kid': key_id})
+    return {'Authorization': 'Ghost {}'.format(token)}
+
+
+def timed(function, requests, threads):
+    start = time.perf_counter()
+    if threads <= 1:
+        for _ in range(requests):
+            function()
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(lambda _: function(), range(requests)))
+    return time.perf_counter() - start
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{"posts":[]}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    provider = TokenProvider(ADMIN_KEY)
+    print("Authorization header, "+str(requests)+" requests")
+    for label, count in (('1 thread', 1), (str(threads)+' threads', threads)):
+        before = timed(sign_every_time, requests, count)
+        after = timed(provider.authorization, requests, count)
+        print("%-10s signed per request %6.2f us, cached %6.2f us (%.0fx)" % (label, before / requests * 1e6, after / requests * 1e6, before / after))
+
+    # The same requests end to end against a local server, header added by the session
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = GhostAdminClient('http://127.0.0.1:'+str(server.server_address[1]), ADMIN_KEY, pool_size=threads)
+    url = client.api_url('posts/')
+    round_trips = max(1, requests // 10)
+    before = timed(lambda: client.session.get(url, headers=sign_every_time(), auth=lambda r: r), round_trips, threads)
+    after = timed(lambda: client.session.get(url), round_trips, threads)
+    print("%-10s signed per request %6.1f us, cached %6.1f us per round trip (%d requests)" % ('HTTP', before / round_trips * 1e6, after / round_trips * 1e6, round_trips))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
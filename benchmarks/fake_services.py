@@ -0,0 +1,374 @@
+import os
+import re
+import sys
+import json
+import time
+import base64
+import random
+import hashlib
+import threading
+import http.server
+import numpy as np
+
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+# A local stand-in for the Ghost Admin API and the OpenAI embeddings and chat
+# endpoints, so the scripts can be run and measured without a live site or a paid
+# key. Posts are synthetic; every answer is deterministic.
+TOPICS = 20
+COMMON_WORDS = ['ghost', 'post', 'content', 'reader', 'editor', 'theme', 'member', 'newsletter', 'publish',
+    'draft', 'card', 'section', 'search', 'related', 'update', 'story', 'guide', 'notes', 'review', 'week']
+TOPIC_PATTERN = re.compile(r'\btopic(\d+)\b')
+POST_PATTERN = re.compile(r'\nPost (\d+):\n')
+ADMIN_POSTS = re.compile(r'/ghost/api/admin/posts/?$')
+ADMIN_POST = re.compile(r'/ghost/api/admin/posts/([^/]+)/?$')
+ADMIN_TAGS = re.compile(r'/ghost/api/admin/tags/?$')
+ADMIN_TAG = re.compile(r'/ghost/api/admin/tags/([^/]+)/?$')
+
+
+def sample_post(paragraphs, title='Sample post'):
+    # The same post in all three formats, for the tests and the benchmarks.
+    # paragraphs: list of strings; every fifth one becomes a heading, and a toggle
+    # and an html card follow every tenth.
+    sections = []
+    cards = []
+    html = []
+    root = []
+    for i, paragraph in enumerate(paragraphs):
+        tag = 'h2' if i % 5 == 0 else 'p'
+        sections.append([1, tag, [[0, [], 0, paragraph]]])
+        html.append('<'+tag+'>'+paragraph.replace('&', '&amp;').replace('<', '&lt;')+'</'+tag+'>')
+        root.append({'type': 'heading' if tag == 'h2' else 'paragraph', 'tag': tag, 'children': [{'type': 'text', 'text': paragraph}]})
+        if i % 10 == 9:
+            toggle = {'heading': '<p>Question '+str(i)+'</p>', 'content': '<p>Answer <strong>'+str(i)+'</strong></p>'}
+            embed = {'html': '<div class="embed"><p>Embedded &amp; card '+str(i)+'</p><script>track()</script></div>'}
+            for name, payload in (('toggle', toggle), ('html', embed)):
+                sections.append([10, len(cards)])
+                cards.append([name, payload])
+                root.append(dict(payload, type=name))
+            html.append('<div class="kg-toggle-card"><h4>'+toggle['heading']+'</h4><div>'+toggle['content']+'</div></div>')
+            html.append(embed['html'])
+    mobiledoc = {'version': '0.3.1', 'atoms': [], 'cards': cards, 'markups': [], 'sections': sections}
+    lexical = {'root': {'type': 'root', 'children': root}}
+    return {
+        'mobiledoc': {'title': title, 'mobiledoc': json.dumps(mobiledoc), 'lexical': None},
+        'lexical': {'title': title, 'mobiledoc': None, 'lexical': json.dumps(lexical)},
+        'html': {'title': title, 'html': ''.join(html)},
+    }
+
+
+def synthetic_posts(count, paragraphs=4, words=40, seed=0):
+    # {id: post} with Ghost's fields. Each post belongs to one of TOPICS topics, named
+    # in its title and mixed into its words, so related posts share a topic. Half the
+    # posts are mobiledoc and half lexical, like a site that moved editors.
+    rng = random.Random(seed)
+    topic_words = [['topic'+str(topic)] + ['word'+str(topic)+'x'+str(i) for i in range(12)] for topic in range(TOPICS)]
+    posts = {}
+    for i in range(count):
+        topic = rng.randrange(TOPICS)
+        vocabulary = COMMON_WORDS + topic_words[topic] * 2
+        texts = [' '.join(rng.choice(vocabulary) for _ in range(words)) for _ in range(paragraphs)]
+        title = 'Synthetic post '+str(i)+' topic'+str(topic)
+        document = sample_post(texts, title)['lexical' if i % 2 else 'mobiledoc']
+        post_id = '%024x' % (i + 1)
+        posts[post_id] = {
+            'id': post_id,
+            'uuid': post_id,
+            'title': title,
+            'slug': 'synthetic-post-'+str(i),
+            'mobiledoc': document.get('mobiledoc'),
+            'lexical': document.get('lexical'),
+            'html': None,
+            'status': 'published',
+            'updated_at': '2024-01-01T00:00:00.000Z',
+            'tags': [],
+        }
+    return posts
+
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class FakeServices:
+    # Serves both APIs on one local port. Faults are injected by count so runs are
+    # repeatable:
+    #   ghost_latency, openai_latency: seconds added to every request
+    #   throttle_every: every Nth request gets a 429 with a short Retry-After
+    #   collide_every:  every Nth PUT finds the post saved by someone else, so Ghost
+    #                   answers 409 UpdateCollisionError
+    # Besides request counts, it keeps when each post was first listed and when the
+    # last request that finishes it arrived (its PUT, or its embedding), which gives
+    # a per-post latency for each script.
+    def __init__(self, posts, dimensions=256, ghost_latency=0.0, openai_latency=0.0, throttle_every=0, collide_every=0, seed=0):
+        self.posts = posts
+        self.dimensions = dimensions
+        self.ghost_latency = ghost_latency
+        self.openai_latency = openai_latency
+        self.throttle_every = throttle_every
+        self.collide_every = collide_every
+        self.lock = threading.Lock()
+        self.deleted_tags = set()
+        self.title_ids = {post['title'].split(' topic')[0]: post_id for post_id, post in posts.items()}
+        rng = np.random.default_rng(seed)
+        self.topic_vectors = rng.standard_normal((TOPICS, dimensions)).astype(np.float32)
+        self.reset_stats()
+        services = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out as separate writes; without this every response
+            # waits on a delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                services.handle(self, 'GET')
+
+            def do_POST(self):
+                services.handle(self, 'POST')
+
+            def do_PUT(self):
+                services.handle(self, 'PUT')
+
+            def do_DELETE(self):
+                services.handle(self, 'DELETE')
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:'+str(self.server.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_stats(self):
+        with self.lock:
+            self.counts = {}
+            self.requests = 0
+            self.puts = 0
+            self.listed = {}
+            self.finished = {}
+
+    def stats(self):
+        with self.lock:
+            latencies = [self.finished[post_id] - self.listed[post_id] for post_id in self.finished if post_id in self.listed]
+            return {
+                'requests': dict(sorted(self.counts.items())),
+                'posts_finished': len(self.finished),
+                'p50_ms': None if len(latencies) == 0 else round(percentile(latencies, 0.5) * 1000, 1),
+                'p99_ms': None if len(latencies) == 0 else round(percentile(latencies, 0.99) * 1000, 1),
+            }
+
+    def count(self, name, amount=1):
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    # -- HTTP plumbing
+
+    def handle(self, request, method):
+        url = urlparse(request.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        length = int(request.headers.get('Content-Length') or 0)
+        body = json.loads(request.rfile.read(length)) if length > 0 else None
+        is_openai = url.path.startswith('/v1/')
+        time.sleep(self.openai_latency if is_openai else self.ghost_latency)
+        with self.lock:
+            self.requests += 1
+            throttled = self.throttle_every > 0 and self.requests % self.throttle_every == 0
+            if throttled:
+                self.count('throttled')
+        if throttled:
+            return self.send(request, 429, {'errors': [{'type': 'TooManyRequestsError'}]}, {'Retry-After': '0.1'})
+        if not is_openai and not str(request.headers.get('Authorization', '')).startswith('Ghost '):
+            with self.lock:
+                self.count('unauthorized')
+            return self.send(request, 401, {'errors': [{'type': 'UnauthorizedError'}]})
+        try:
+            status, payload = self.route(method, url.path, query, body)
+        except Exception as e:
+            status, payload = 500, {'errors': [{'type': 'InternalServerError', 'message': str(e)}]}
+        self.send(request, status, payload)
+
+    def send(self, request, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(data)
+
+    def route(self, method, path, query, body):
+        if path == '/v1/embeddings' and method == 'POST':
+            return self.embeddings(body)
+        if path == '/v1/chat/completions' and method == 'POST':
+            return self.chat(body)
+        if ADMIN_POSTS.match(path) and method == 'GET':
+            return self.list_posts(query)
+        match = ADMIN_POST.match(path)
+        if match and method == 'GET':
+            return self.get_post(match.group(1), query)
+        if match and method == 'PUT':
+            return self.put_post(match.group(1), body)
+        if ADMIN_TAGS.match(path) and method == 'GET':
+            return self.list_tags(query)
+        match = ADMIN_TAG.match(path)
+        if match and method == 'DELETE':
+            with self.lock:
+                self.count('tags.delete')
+                self.deleted_tags.add(match.group(1))
+            return 204, None
+        return 404, {'errors': [{'type': 'NotFoundError'}]}
+
+    # -- Ghost Admin API
+
+    def project(self, post, query):
+        fields = query.get('fields')
+        if not fields:
+            return dict(post)
+        keep = set(fields.split(',')) | set(query.get('formats', '').split(',')) | set(query.get('include', '').split(','))
+        keep.add('id')
+        return {name: value for name, value in post.items() if name in keep}
+
+    def list_posts(self, query):
+        limit = query.get('limit', '15')
+        page = int(query.get('page', '1'))
+        with self.lock:
+            self.count('posts.list')
+            ids = list(self.posts)
+            limit = len(ids) if limit == 'all' else int(limit)
+            selected = ids[(page - 1) * limit:page * limit]
+            posts = [self.project(self.posts[post_id], query) for post_id in selected]
+            now = time.perf_counter()
+            for post_id in selected:
+                self.listed.setdefault(post_id, now)
+        pages = max(1, -(-len(ids) // max(limit, 1)))
+        pagination = {'page': page, 'limit': limit, 'pages': pages, 'total': len(ids),
+            'next': page + 1 if page < pages else None, 'prev': page - 1 if page > 1 else None}
+        return 200, {'posts': posts, 'meta': {'pagination': pagination}}
+
+    def get_post(self, post_id, query):
+        with self.lock:
+            self.count('posts.get')
+            if post_id not in self.posts:
+                return 404, {'errors': [{'type': 'NotFoundError'}]}
+            return 200, {'posts': [self.project(self.posts[post_id], query)]}
+
+    def put_post(self, post_id, body):
+        update = body['posts'][0]
+        with self.lock:
+            self.count('posts.put')
+            self.puts += 1
+            if post_id not in self.posts:
+                return 404, {'errors': [{'type': 'NotFoundError'}]}
+            post = self.posts[post_id]
+            if self.collide_every > 0 and self.puts % self.collide_every == 0:
+                post['updated_at'] = next_timestamp(post['updated_at'])
+            if update.get('updated_at') != post['updated_at']:
+                self.count('collisions')
+                return 409, {'errors': [{'type': 'UpdateCollisionError', 'message': 'Saving failed! Someone else is editing this post.'}]}
+            post['tags'] = [{'id': 'tag-'+str(tag.get('slug') or tag['name']), 'name': tag['name'], 'slug': tag.get('slug') or tag['name'],
+                'visibility': 'internal' if tag['name'].startswith('#') else 'public'} for tag in update.get('tags', [])]
+            post['updated_at'] = next_timestamp(post['updated_at'])
+            self.finished[post_id] = time.perf_counter()
+            return 200, {'posts': [dict(post)]}
+
+    def list_tags(self, query):
+        visibility = None
+        if query.get('filter', '').startswith('visibility:'):
+            visibility = query['filter'].split(':', 1)[1]
+        with self.lock:
+            self.count('tags.list')
+            tags = {}
+            for post in self.posts.values():
+                for tag in post['tags']:
+                    entry = tags.setdefault(tag['id'], dict(tag, count={'posts': 0}))
+                    entry['count']['posts'] += 1
+            result = [tag for tag_id, tag in tags.items() if tag_id not in self.deleted_tags and (visibility is None or tag['visibility'] == visibility)]
+        return 200, {'tags': result, 'meta': {'pagination': {'page': 1, 'limit': 'all', 'pages': 1, 'total': len(result)}}}
+
+    # -- OpenAI
+
+    def vector(self, text):
+        # The post's topic plus noise seeded by the text, so the same text always
+        # gets the same vector and posts on one topic come out related
+        seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+        vector = 0.8 * np.random.default_rng(seed).standard_normal(self.dimensions).astype(np.float32)
+        topic = TOPIC_PATTERN.search(text)
+        if topic is not None:
+            vector += self.topic_vectors[int(topic.group(1)) % TOPICS]
+        return vector / np.linalg.norm(vector)
+
+    def mark_finished(self, text):
+        title = text.split('\n', 1)[0].split(' topic')[0]
+        post_id = self.title_ids.get(title)
+        if post_id is not None:
+            self.finished[post_id] = time.perf_counter()
+
+    def embeddings(self, body):
+        texts = body['input'] if isinstance(body['input'], list) else [body['input']]
+        vectors = [self.vector(str(text)) for text in texts]
+        with self.lock:
+            self.count('openai.embeddings')
+            self.count('openai.embedding_inputs', len(texts))
+            for text in texts:
+                self.mark_finished(str(text))
+        if body.get('encoding_format') == 'base64':
+            data = [base64.b64encode(vector.tobytes()).decode('ascii') for vector in vectors]
+        else:
+            data = [vector.tolist() for vector in vectors]
+        return 200, {
+            'object': 'list',
+            'model': body['model'],
+            'data': [{'object': 'embedding', 'index': i, 'embedding': embedding} for i, embedding in enumerate(data)],
+            'usage': {'prompt_tokens': sum(len(str(text)) // 4 for text in texts), 'total_tokens': sum(len(str(text)) // 4 for text in texts)},
+        }
+
+    def chat(self, body):
+        prompt = body['messages'][-1]['content']
+        json_response = (body.get('response_format') or {}).get('type') == 'json_object'
+        with self.lock:
+            self.count('openai.chat')
+        if json_response:
+            # Batched tagging: one tag list per numbered post
+            parts = POST_PATTERN.split(prompt)[1:]
+            answer = {number: topic_tags(text) for number, text in zip(parts[0::2], parts[1::2])}
+            content = json.dumps(answer)
+        elif 'share one topic' in prompt:
+            topics = TOPIC_PATTERN.findall(prompt)
+            content = 'topic'+max(set(topics), key=topics.count) if len(topics) > 0 else 'general'
+        else:
+            content = ', '.join(topic_tags(prompt))
+        return 200, {
+            'id': 'chatcmpl-fake',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body['model'],
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}],
+            'usage': {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(content) // 4, 'total_tokens': (len(prompt) + len(content)) // 4},
+        }
+
+
+def topic_tags(text):
+    topic = TOPIC_PATTERN.search(text)
+    return (['topic'+topic.group(1)] if topic is not None else []) + ['synthetic', 'ghost']
+
+
+def next_timestamp(updated_at):
+    # One millisecond later, in Ghost's format
+    moment = datetime.strptime(updated_at, '%Y-%m-%dT%H:%M:%S.%fZ') + timedelta(milliseconds=1)
+    return moment.strftime('%Y-%m-%dT%H:%M:%S.') + '%03dZ' % (moment.microsecond // 1000)
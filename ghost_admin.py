@@ -0,0 +1,222 @@
+import time
+import threading
+import requests # pip install requests
+import jwt	# pip install pyjwt
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from ghost_tags import tags_equal
+from ghost_ratelimit import RateLimiter, AdaptiveConcurrency, call_with_retry
+from ghost_metrics import timer
+
+DEFAULT_PAGE_SIZE = 100
+DEFAULT_FETCH_WORKERS = 4
+# Ghost accepts Admin API tokens that expire at most 5 minutes after they were issued.
+# A token is replaced a minute before that so one never expires in flight.
+TOKEN_LIFETIME = 5 * 60
+TOKEN_REFRESH_MARGIN = 60
+
+
+class TokenProvider:
+    # Signs Admin API tokens and reuses each one until shortly before it expires, so
+    # requests do not pay for key parsing and an HMAC signature every time. Safe to
+    # share between threads: only one of them re-signs when the token runs out.
+    def __init__(self, admin_key, lifetime=TOKEN_LIFETIME, refresh_margin=TOKEN_REFRESH_MARGIN, clock=time.time):
+        # Split the key into ID and SECRET
+        self.key_id, secret = admin_key.split(':')
+        self.secret = bytes.fromhex(secret)
+        self.lifetime = lifetime
+        self.refresh_margin = refresh_margin
+        self.clock = clock
+        self.lock = threading.Lock()
+        # (header value, time to refresh), replaced as a whole so readers need no lock
+        self.current = (None, 0)
+
+    def sign(self, iat):
+        header = {'alg': 'HS256', 'typ': 'JWT', 'kid': self.key_id}
+        payload = {
+            'iat': iat,
+            'exp': iat + self.lifetime,
+            'aud': '/admin/'
+        }
+        return jwt.encode(payload, self.secret, algorithm='HS256', headers=header)
+
+    def authorization(self):
+        value, refresh_at = self.current
+        if self.clock() < refresh_at:
+            return value
+        with self.lock:
+            value, refresh_at = self.current
+            if self.clock() >= refresh_at:
+                iat = int(self.clock())
+                value = 'Ghost {}'.format(self.sign(iat))
+                self.current = (value, iat + self.lifetime - self.refresh_margin)
+            return value
+
+
+class GhostAuth(requests.auth.AuthBase):
+    # Adds the current Admin API token to every request sent through the session
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def __call__(self, request):
+        request.headers['Authorization'] = self.tokens.authorization()
+        return request
+
+
+class GhostAdminClient:
+    # Talks to the Ghost Admin API over one pooled keep-alive session
+    def __init__(self, site_url, admin_key, pool_size=16, requests_per_minute=0):
+        self.site_url = site_url.rstrip('/')
+        self.tokens = TokenProvider(admin_key)
+        self.limiter = RateLimiter(requests_per_minute)
+        # Fewer requests in flight after a 429, back up to the pool size as they succeed
+        self.concurrency = AdaptiveConcurrency(pool_size)
+        self.session = requests.Session()
+        self.session.auth = GhostAuth(self.tokens)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def api_url(self, path):
+        return self.site_url+'/ghost/api/admin/'+path.lstrip('/')
+
+    def request(self, method, path, params=None, body=None):
+        # Rate limited, and retried with backoff on 429s, 5xx and dropped connections
+        with timer('ghost_'+method.lower()):
+            return call_with_retry(lambda: self.session.request(method, self.api_url(path), params=params, json=body), self.limiter, concurrency=self.concurrency)
+
+    def get(self, path, params=None):
+        return self.request('GET', path, params)
+
+    def put(self, path, body, params=None):
+        return self.request('PUT', path, params, body)
+
+    def delete(self, path, params=None):
+        return self.request('DELETE', path, params)
+
+    def fetch_posts_page(self, page, limit=DEFAULT_PAGE_SIZE, params=None):
+        query = dict(params or {})
+        query['page'] = page
+        query['limit'] = limit
+        with timer('page_fetch'):
+            response = self.get('posts/', query)
+            response.raise_for_status()
+            return response.json()
+
+    def get_post(self, post_id, fields=('id', 'updated_at'), include=('tags',)):
+        response = self.get('posts/'+str(post_id)+'/', projection_params(fields, None, include))
+        response.raise_for_status()
+        return response.json()['posts'][0]
+
+    def update_post_tags(self, post, build_tags, collision_retries=2):
+        # Write tags using the snapshot already in hand (id, updated_at, tags), so no GET
+        # is needed first. build_tags(original_tags) returns the full new tag list. If
+        # someone else saved the post in between, Ghost rejects the stale updated_at;
+        # only then is the post fetched again and the tags rebuilt from fresh data.
+        # Returns None without writing when the post already has the desired tags.
+        for attempt in range(collision_retries + 1):
+            original_tags = post.get('tags') or []
+            tags = build_tags(original_tags)
+            if tags_equal(original_tags, tags):
+                return None
+            body = {
+                "posts":[
+                    {
+                        "tags":tags,
+                        "updated_at":post['updated_at']
+                    }
+                ]
+            }
+            response = self.put('posts/'+str(post['id'])+'/', body, {'formats': 'mobiledoc,lexical'})
+            if is_update_collision(response) and attempt < collision_retries:
+                post = self.get_post(post['id'])
+                continue
+            response.raise_for_status()
+            return response.json()['posts'][0]
+
+    def list_tags(self, fields=None, include=None, filter=None):
+        # Every tag on the site in one request, e.g. filter='visibility:public'
+        query = projection_params(fields, None, include, filter)
+        query['limit'] = 'all'
+        response = self.get('tags/', query)
+        response.raise_for_status()
+        return response.json()['tags']
+
+    def delete_tag(self, tag_id):
+        # True when the tag is gone, including when someone else deleted it first
+        response = self.delete('tags/'+str(tag_id)+'/')
+        if response.status_code == 404:
+            return True
+        response.raise_for_status()
+        return True
+
+    def list_posts(self, limit=DEFAULT_PAGE_SIZE, workers=DEFAULT_FETCH_WORKERS, fields=None, formats=None, include=None, filter=None):
+        # Projections keep the payload down to what the caller uses, e.g.
+        # fields=['id', 'updated_at'], include=['tags'], filter="updated_at:>'2024-01-01'".
+        # Format fields such as mobiledoc must be named in both fields and formats.
+        return PostListing(self, limit, workers, projection_params(fields, formats, include, filter))
+
+
+def is_update_collision(response):
+    if response.status_code == 409:
+        return True
+    if response.status_code < 400:
+        return False
+    try:
+        errors = response.json().get('errors', [])
+    except ValueError:
+        return False
+    return any(error.get('type') == 'UpdateCollisionError' for error in errors)
+
+
+def projection_params(fields=None, formats=None, include=None, filter=None):
+    params = {}
+    for name, value in (('fields', fields), ('formats', formats), ('include', include), ('filter', filter)):
+        if value is None or len(value) == 0:
+            continue
+        if not isinstance(value, str):
+            value = ','.join(value)
+        params[name] = value
+    return params
+
+
+class PostListing:
+    # Page 1 is fetched up front so callers can read the pagination totals.
+    # Iterating yields posts in listing order while the remaining pages are
+    # fetched concurrently, a bounded number of pages ahead of the consumer.
+    def __init__(self, client, limit=DEFAULT_PAGE_SIZE, workers=DEFAULT_FETCH_WORKERS, params=None):
+        self.client = client
+        self.limit = limit
+        self.workers = max(1, int(workers))
+        self.params = params
+        self.first_page = client.fetch_posts_page(1, limit, params)
+        pagination = self.first_page['meta']['pagination']
+        self.pages = int(pagination['pages'] or 1)
+        self.total = int(pagination['total'])
+
+    def __iter__(self):
+        first_page, self.first_page = self.first_page, None
+        if first_page is None:
+            first_page = self.client.fetch_posts_page(1, self.limit, self.params)
+        for post in first_page['posts']:
+            yield post
+
+        if self.pages <= 1:
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            remaining = iter(range(2, self.pages + 1))
+            pending = deque()
+            for page in remaining:
+                pending.append(executor.submit(self.client.fetch_posts_page, page, self.limit, self.params))
+                if len(pending) >= self.workers * 2:
+                    break
+            while len(pending) > 0:
+                posts = pending.popleft().result()['posts']
+                for page in remaining:
+                    pending.append(executor.submit(self.client.fetch_posts_page, page, self.limit, self.params))
+                    break
+                for post in posts:
+                    yield post
@@ -0,0 +1,240 @@
+import os
+import sys
+import time
+import numpy as np
+
+from ghost_similarity import normalize_rows, top_k_rows, DEFAULT_BLOCK_SIZE
+
+# Inverted file index: k-means splits the corpus into lists around centroids, and a
+# query only scores the posts in its `nprobe` closest lists. More lists or fewer
+# probes is faster, more probes gives better recall; nprobe == lists is exact.
+DEFAULT_NPROBE = 16
+DEFAULT_ITERATIONS = 10
+# Training uses at most this many posts per list
+TRAINING_SAMPLES_PER_LIST = 32
+# Retrain once fewer than this share of the posts were assigned by a training run
+RETRAIN_BELOW = 0.5
+
+
+def default_list_count(n):
+    return max(1, min(n, int(4 * np.sqrt(n))))
+
+
+def _nearest_centroids(normalized, centroids, block_size=DEFAULT_BLOCK_SIZE):
+    indices, _ = top_k_rows(normalized, centroids, 1, block_size=block_size)
+    return indices[:, 0]
+
+
+def train_centroids(normalized, n_lists, iterations=DEFAULT_ITERATIONS, seed=0, block_size=DEFAULT_BLOCK_SIZE):
+    # Spherical k-means on a sample of unit vectors: assign by dot product, move each
+    # centroid to the normalized mean of its members, re-seed empty lists.
+    rng = np.random.default_rng(seed)
+    n = normalized.shape[0]
+    n_lists = max(1, min(int(n_lists), n))
+    sample_size = min(n, n_lists * TRAINING_SAMPLES_PER_LIST)
+    sample = normalized[np.sort(rng.choice(n, sample_size, replace=False))] if sample_size < n else np.asarray(normalized)
+    centroids = sample[rng.choice(sample.shape[0], n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = _nearest_centroids(sample, centroids, block_size)
+        counts = np.bincount(assignment, minlength=n_lists)
+        sums = np.zeros_like(centroids)
+        filled = np.nonzero(counts)[0]
+        starts = np.concatenate([[0], np.cumsum(counts[filled])[:-1]])
+        sums[filled] = np.add.reduceat(sample[np.argsort(assignment, kind='stable')], starts, axis=0)
+        empty = np.nonzero(counts == 0)[0]
+        if len(empty) > 0:
+            sums[empty] = sample[rng.choice(sample.shape[0], len(empty), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class IVFIndex:
+    # Centroids plus the list of every post, keyed by blog id so the index survives
+    # between runs. Posts that are new or re-embedded since (different embedding store
+    # row) are assigned to their nearest centroid when the index is attached.
+    #   centroids: (lists, dim) unit vectors
+    #   lists:     blog_id -> (list number, store row it was assigned from)
+    #   trained:   number of posts the centroids were trained on
+    def __init__(self, centroids, lists=None, trained=0):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.lists = lists or {}
+        self.trained = int(trained)
+        self.vectors = None
+        self.list_offsets = None
+        self.list_rows = None
+
+    @property
+    def n_lists(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, blog_ids, versions, matrix, n_lists=None, iterations=DEFAULT_ITERATIONS, seed=0):
+        normalized = normalize_rows(matrix)
+        n_lists = n_lists or default_list_count(normalized.shape[0])
+        index = cls(train_centroids(normalized, n_lists, iterations, seed), trained=normalized.shape[0])
+        index.attach(blog_ids, versions, normalized)
+        return index
+
+    def needs_retraining(self, n):
+        return self.trained < RETRAIN_BELOW * n
+
+    def attach(self, blog_ids, versions, matrix):
+        # Point the index at the current corpus and build the inverted lists
+        self.vectors = normalize_rows(matrix)
+        assignment = np.empty(len(blog_ids), dtype=np.int64)
+        missing = []
+        lists = {}
+        for row, (blog_id, version) in enumerate(zip(blog_ids, versions)):
+            saved = self.lists.get(blog_id)
+            if saved is not None and saved[1] == int(version):
+                assignment[row] = saved[0]
+            else:
+                missing.append(row)
+        if len(missing) > 0:
+            missing = np.array(missing, dtype=np.int64)
+            assignment[missing] = _nearest_centroids(self.vectors[missing], self.centroids)
+        for row, (blog_id, version) in enumerate(zip(blog_ids, versions)):
+            lists[blog_id] = (int(assignment[row]), int(version))
+        self.lists = lists
+        self.list_rows = np.argsort(assignment, kind='stable')
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=self.n_lists))])
+        return len(missing)
+
+    def search(self, queries, k, nprobe=DEFAULT_NPROBE, exclude=None):
+        # Same contract as ghost_similarity.top_k_rows on the attached corpus: queries
+        # must be normalized, exclude[i] is a row to leave out for query i. Rows with
+        # fewer than k candidates in their probed lists are padded with index -1.
+        queries = np.atleast_2d(queries)
+        n_queries = queries.shape[0]
+        k = int(k)
+        top_indices = np.full((n_queries, k), -1, dtype=np.int64)
+        top_scores = np.full((n_queries, k), -np.inf, dtype=np.float32)
+        if k <= 0 or n_queries == 0:
+            return top_indices, top_scores
+
+        nprobe = max(1, min(int(nprobe), self.n_lists))
+        probes, _ = top_k_rows(queries, self.centroids, nprobe)
+        # Group queries by list so each list is scored with one matrix multiply
+        flat = probes.ravel()
+        order = np.argsort(flat, kind='stable')
+        probing = np.repeat(np.arange(n_queries), nprobe)[order]
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(flat, minlength=self.n_lists))])
+        exclude = np.asarray(exclude) if exclude is not None else None
+
+        for list_number in range(self.n_lists):
+            rows = self.list_rows[self.list_offsets[list_number]:self.list_offsets[list_number + 1]]
+            query_rows = probing[bounds[list_number]:bounds[list_number + 1]]
+            if len(rows) == 0 or len(query_rows) == 0:
+                continue
+            scores = queries[query_rows] @ self.vectors[rows].T
+            if exclude is not None:
+                scores[rows[np.newaxis, :] == exclude[query_rows][:, np.newaxis]] = -np.inf
+            merged_scores = np.hstack([top_scores[query_rows], scores])
+            merged_indices = np.hstack([top_indices[query_rows], np.broadcast_to(rows, scores.shape)])
+            keep = np.argpartition(-merged_scores, k - 1, axis=1)[:, :k]
+            top_scores[query_rows] = np.take_along_axis(merged_scores, keep, axis=1)
+            top_indices[query_rows] = np.take_along_axis(merged_indices, keep, axis=1)
+
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        top_indices = np.take_along_axis(top_indices, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        top_indices[np.isneginf(top_scores)] = -1
+        return top_indices, top_scores
+
+    def top_k_similar(self, k, nprobe=DEFAULT_NPROBE):
+        # Approximate all-pairs top k over the attached corpus, never matching a row with itself
+        return self.search(self.vectors, k, nprobe, exclude=np.arange(self.vectors.shape[0]))
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return None
+        data = np.load(path)
+        blog_ids = [str(blog_id) for blog_id in data['blog_ids']]
+        lists = {blog_id: (int(list_number), int(version)) for blog_id, list_number, version in zip(blog_ids, data['lists'], data['versions'])}
+        return cls(data['centroids'], lists, int(data['trained']))
+
+    def save(self, path):
+        blog_ids = list(self.lists.keys())
+        width = max([1] + [len(blog_id) for blog_id in blog_ids])
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f,
+                centroids=self.centroids,
+                trained=np.int64(self.trained),
+                blog_ids=np.array(blog_ids, dtype='<U'+str(width)),
+                lists=np.array([self.lists[blog_id][0] for blog_id in blog_ids], dtype=np.int32),
+                versions=np.array([self.lists[blog_id][1] for blog_id in blog_ids], dtype=np.int64))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+
+def recall_at_k(approximate, exact):
+    # Share of the exact top k found by the approximate search, averaged over rows
+    hits = 0
+    for found, expected in zip(approximate, exact):
+        hits += len(set(found.tolist()) & set(expected.tolist()))
+    return hits / float(max(1, exact.size))
+
+
+def recall_report(index, k, nprobes=(1, 4, DEFAULT_NPROBE, 64), sample=1000, seed=0):
+    # Compare the attached index with exact search on a sample of posts.
+    # Returns a list of (nprobe, recall, seconds per query).
+    n = index.vectors.shape[0]
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(n, min(sample, n), replace=False))
+    queries = index.vectors[rows]
+
+    start = time.perf_counter()
+    exact, _ = top_k_rows(queries, index.vectors, k, exclude=rows)
+    exact_time = (time.perf_counter() - start) / len(rows)
+    print("%d posts, %d lists, top %d, %d sampled queries" % (n, index.n_lists, k, len(rows)))
+    print("exact      %9.3f ms/query" % (exact_time * 1000))
+
+    results = []
+    for nprobe in nprobes:
+        if nprobe > index.n_lists:
+            continue
+        start = time.perf_counter()
+        approximate, _ = index.search(queries, k, nprobe, exclude=rows)
+        elapsed = (time.perf_counter() - start) / len(rows)
+        recall = recall_at_k(approximate, exact)
+        results.append((nprobe, recall, elapsed))
+        print("nprobe %-4d %9.3f ms/query  recall@%d %.3f" % (nprobe, elapsed * 1000, k, recall))
+    return results
+
+
+if __name__ == '__main__':
+    import configparser
+    from ghost_embedding_store import EmbeddingStore
+
+    command = str(sys.argv[1]).upper() if len(sys.argv) > 1 else ''
+    if command not in ("BUILD", "RECALL"):
+        print('Usage: python ghost_ann.py build [lists]')
+        print('       python ghost_ann.py recall [k]')
+        sys.exit()
+
+    config = configparser.ConfigParser()
+    config.read('./.env')
+    output_path = config['BASIC']['EMBEDDING_OUTPUT_PATH']
+    index_path = os.path.join(output_path, 'ann_index.npz')
+    store = EmbeddingStore(os.path.join(output_path, 'embeddings'))
+    blog_ids, titles, matrix = store.load()
+    versions = [store.version(blog_id) for blog_id in blog_ids]
+    if len(blog_ids) == 0:
+        sys.exit("No embedding found in "+str(output_path))
+
+    if command == "BUILD":
+        n_lists = int(sys.argv[2]) if len(sys.argv) > 2 else int(config['BASIC'].get('ANN_LISTS', 0)) or None
+        index = IVFIndex.build(blog_ids, versions, matrix, n_lists)
+        index.save(index_path)
+        print("Index with "+str(index.n_lists)+" lists built for "+str(len(blog_ids))+" posts in "+index_path)
+    else:
+        index = IVFIndex.load(index_path)
+        if index is None:
+            index = IVFIndex.build(blog_ids, versions, matrix)
+        else:
+            index.attach(blog_ids, versions, matrix)
+        k = int(sys.argv[2]) if len(sys.argv) > 2 else int(config['BASIC'].get('MAX_RELATED_BLOG_COUNT', 10))
+        recall_report(index, k)
@@ -0,0 +1,135 @@
+import logging
+
+from ghost_ratelimit import is_retryable
+
+# The embeddings endpoint accepts up to 2048 inputs per request. We stay well below
+# that so a failed batch is cheap to bisect, and cap the summed tokens per request.
+DEFAULT_BATCH_ITEMS = 100
+DEFAULT_BATCH_TOKENS = 100000
+
+# Longer posts are split into chunks of this many tokens, just under the 8191 token
+# input limit of the embedding models, so posts that fit are still sent whole.
+# Each chunk repeats the last DEFAULT_CHUNK_OVERLAP tokens of the one before.
+DEFAULT_CHUNK_TOKENS = 8000
+DEFAULT_CHUNK_OVERLAP = 200
+
+_encoding = None
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding('cl100k_base')
+        except Exception:
+            _encoding = False
+    return _encoding
+
+
+def estimate_tokens(text):
+    # Exact count with tiktoken when it is installed. Otherwise the UTF-8 length: every
+    # token covers at least one byte, so this never undercounts, even for CJK or code.
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text.encode('utf-8')) + 1
+
+
+def _character_start(data, position):
+    # Back up to the first byte of the UTF-8 character at position
+    while 0 < position < len(data) and data[position] & 0xC0 == 0x80:
+        position -= 1
+    return position
+
+
+def chunk_text(text, max_tokens=DEFAULT_CHUNK_TOKENS, overlap=DEFAULT_CHUNK_OVERLAP):
+    # Split text into overlapping pieces of at most max_tokens tokens. Text that fits
+    # comes back unchanged as a single piece.
+    overlap = max(0, min(int(overlap), int(max_tokens) // 2))
+    step = int(max_tokens) - overlap
+    encoding = _get_encoding()
+    if encoding:
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return [text]
+        chunks = []
+        for start in range(0, len(tokens), step):
+            chunks.append(encoding.decode(tokens[start:start + max_tokens]))
+            if start + max_tokens >= len(tokens):
+                break
+        return chunks
+
+    # Without tiktoken: one byte per token, cut at whitespace where possible
+    data = text.encode('utf-8')
+    if len(data) <= max_tokens:
+        return [text]
+    chunks = []
+    start = 0
+    while start < len(data):
+        end = min(len(data), start + int(max_tokens))
+        if end < len(data):
+            space = data.rfind(b' ', start + step, end)
+            end = space if space > start else _character_start(data, end)
+        chunks.append(data[start:end].decode('utf-8'))
+        if end >= len(data):
+            break
+        start = max(start + 1, _character_start(data, end - overlap))
+    return chunks
+
+
+def pool_embeddings(embeddings, weights=None):
+    # One vector for a post from its chunk vectors: the mean weighted by chunk size,
+    # scaled back to unit length like the vectors the API returns
+    if len(embeddings) == 1:
+        return list(embeddings[0])
+    # Imported here so the tagging script can batch by tokens without loading numpy
+    import numpy as np
+    vectors = np.asarray(embeddings, dtype=np.float64)
+    pooled = np.average(vectors, axis=0, weights=weights)
+    norm = np.linalg.norm(pooled)
+    if norm > 0:
+        pooled = pooled / norm
+    return pooled.tolist()
+
+
+def make_batches(items, max_items=DEFAULT_BATCH_ITEMS, max_tokens=DEFAULT_BATCH_TOKENS, count_tokens=estimate_tokens):
+    # items: iterable of dicts with a 'text' key. Yields lists of items that fit the
+    # item and token limits. A single item over the token limit goes out on its own.
+    # A max_tokens of 0 only limits the number of items.
+    batch = []
+    batch_tokens = 0
+    for item in items:
+        tokens = count_tokens(item['text'])
+        item['tokens'] = tokens
+        if len(batch) > 0 and (len(batch) >= max_items or (max_tokens > 0 and batch_tokens + tokens > max_tokens)):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(item)
+        batch_tokens += tokens
+    if len(batch) > 0:
+        yield batch
+
+
+def embed_with_bisection(batch, embed_many, on_failure=None):
+    # Embed a batch in one call. If the call is rejected, split the batch in half and
+    # try each half, so one bad input only fails itself. Rate limits, server errors
+    # and dropped connections have already been retried by embed_many, so they fail
+    # the whole batch instead of being bisected into ever more failing requests.
+    # Returns a list of (item, embedding) pairs for the items that succeeded.
+    texts = [item['text'] for item in batch]
+    try:
+        embeddings = embed_many(texts)
+        return list(zip(batch, embeddings))
+    except Exception as e:
+        if len(batch) > 1 and not is_retryable(e):
+            logging.info("Embedding batch of "+str(len(batch))+" failed, splitting: "+str(e))
+            middle = len(batch) // 2
+            return embed_with_bisection(batch[:middle], embed_many, on_failure) + embed_with_bisection(batch[middle:], embed_many, on_failure)
+        if len(batch) > 1:
+            logging.info("Embedding batch of "+str(len(batch))+" failed after retries: "+str(e))
+        if on_failure is not None:
+            for item in batch:
+                on_failure(item, e)
+        return []
@@ -0,0 +1,82 @@
+import os
+import sys
+import logging
+import threading
+import configparser
+
+from ghost_metrics import recordRunMetrics
+
+# Settings are read once per process, and clients are built the first time they are
+# used, so a run that never calls OpenAI never imports or configures it.
+CONFIG_PATH = './.env'
+
+_settings = None
+_clients = {}
+_lock = threading.Lock()
+
+
+def settings():
+    # The [BASIC] section of ./.env
+    global _settings
+    if _settings is None:
+        config = configparser.ConfigParser()
+        config.read(CONFIG_PATH)
+        if 'BASIC' not in config:
+            config['BASIC'] = {}
+        _settings = config['BASIC']
+    return _settings
+
+
+def secret(name, instructions):
+    # From ./.env, else from the environment. Stops the run when it is in neither.
+    value = settings().get(name, '')
+    if len(value) == 0:
+        print("Not finding key in config. Try environment.")
+        if name not in os.environ:
+            print("Missing "+name+". Please set the "+name+" environment variable before running the script. "+instructions)
+            sys.exit(0)
+        value = os.environ.get(name)
+    print(name+" ready")
+    return value
+
+
+def admin_client(pool_size=16):
+    # One Ghost Admin API client per process; pool_size applies to the first call
+    with _lock:
+        if 'ghost' not in _clients:
+            from ghost_admin import GhostAdminClient
+            key = secret('GHOST_ADMIN_API_KEY', "You can find it by following instructions here: https://ghost.org/docs/admin-api/")
+            _clients['ghost'] = GhostAdminClient(settings()['GHOST_SITE_URL'], key, pool_size=pool_size,
+                requests_per_minute=int(settings().get('GHOST_REQUESTS_PER_MINUTE', 0)))
+        return _clients['ghost']
+
+
+def openai_client():
+    # The openai package alone takes most of a second to import
+    with _lock:
+        if 'openai' not in _clients:
+            from openai import OpenAI
+            key = secret('OPENAI_API_KEY', "You can find it by following instructions here: https://platform.openai.com/account/api-keys")
+            # Retries are handled by call_with_retry, which also respects our rate limits
+            _clients['openai'] = OpenAI(api_key=key, max_retries=0)
+        return _clients['openai']
+
+
+def prepare_run(script, log_file):
+    # Output and log directories, the log file and the run metrics of a script
+    output_path = settings()['EMBEDDING_OUTPUT_PATH']
+    log_path = settings()['LOG_PATH']
+    for path in (output_path, log_path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+            print("Directory "+str(path)+" created.")
+
+    logging.basicConfig(
+        filename=str(log_path)+'/'+log_file,
+        level=logging.INFO,
+        format='%(asctime)s [%(levelname)s]: %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+    )
+    # Timings and counters of the run are written to the log path when it ends, and to
+    # a Prometheus textfile in METRICS_TEXTFILE_PATH when that is set
+    recordRunMetrics(script, log_path, settings().get('METRICS_TEXTFILE_PATH'))
@@ -0,0 +1,84 @@
+import numpy as np
+
+from ghost_batching import estimate_tokens
+from ghost_ratelimit import call_with_retry
+from ghost_metrics import timer, increment
+
+DEFAULT_LOCAL_DIMENSIONS = 384
+# Hashed word and word pair features before the projection
+LOCAL_HASH_FEATURES = 2 ** 20
+
+
+class EmbeddingBackend:
+    # embed(texts) returns one vector per text, in order. `model` is saved with each
+    # embedding, so switching backends or models re-embeds every post. `dimensions`
+    # is None when only the service knows it. Backends that cost money or time per
+    # call are `cacheable`, and their results go through the embedding cache.
+    model = None
+    dimensions = None
+    cacheable = False
+
+    def embed(self, texts):
+        raise NotImplementedError
+
+
+class OpenAIBackend(EmbeddingBackend):
+    cacheable = True
+
+    def __init__(self, client, model, limiter=None, concurrency=None):
+        self.client = client
+        self.model = model
+        self.limiter = limiter
+        self.concurrency = concurrency
+
+    def embed(self, texts):
+        # One request for the whole batch. Results carry the input index, so map them back by it.
+        tokens = sum(estimate_tokens(text) for text in texts)
+        with timer('embedding_call'):
+            raw_response = call_with_retry(lambda: self.client.embeddings.with_raw_response.create(input=texts, model=self.model), self.limiter, tokens, self.concurrency)
+            response = raw_response.parse()
+        increment('embedding_inputs', len(texts))
+        usage = getattr(response, 'usage', None)
+        increment('embedding_tokens', usage.total_tokens if usage is not None else tokens)
+        embeddings = [None] * len(texts)
+        for item in response.data:
+            embeddings[item.index] = item.embedding
+        return embeddings
+
+
+class HashingBackend(EmbeddingBackend):
+    # Local CPU embeddings with no network access and nothing to fit: word and word
+    # pair counts are hashed into LOCAL_HASH_FEATURES features, weighted with
+    # 1 + log(count), and projected to `dimensions` by a fixed sparse random
+    # projection, which roughly preserves cosine similarity. Posts that share words
+    # come out related, which is enough for staging sites and CI, but unlike a
+    # language model it knows nothing about meaning.
+    def __init__(self, dimensions=DEFAULT_LOCAL_DIMENSIONS, seed=0):
+        from scipy import sparse
+        from sklearn.feature_extraction.text import HashingVectorizer
+        from sklearn.random_projection import SparseRandomProjection
+
+        self.dimensions = int(dimensions)
+        self.model = 'local-hashing-'+str(self.dimensions)
+        self.vectorizer = HashingVectorizer(n_features=LOCAL_HASH_FEATURES, ngram_range=(1, 2), alternate_sign=False, norm=None, stop_words='english')
+        # The projection only depends on the input width and the seed
+        self.projection = SparseRandomProjection(self.dimensions, dense_output=True, random_state=seed)
+        self.projection.fit(sparse.csr_matrix((1, LOCAL_HASH_FEATURES), dtype=np.float64))
+
+    def embed(self, texts):
+        with timer('embedding_call'):
+            counts = self.vectorizer.transform(texts)
+            counts.data = 1.0 + np.log(counts.data)
+            vectors = np.asarray(self.projection.transform(counts), dtype=np.float32)
+        increment('embedding_inputs', len(texts))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return (vectors / norms).tolist()
+
+
+def backend_for_model(model, make_client=None, limiter=None, concurrency=None):
+    # The backend that produced embeddings saved with this model name. make_client()
+    # returns the OpenAI client and is only called for OpenAI models.
+    if model.startswith('local-hashing-'):
+        return HashingBackend(int(model[len('local-hashing-'):]))
+    return OpenAIBackend(make_client(), model, limiter, concurrency)
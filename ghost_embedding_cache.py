@@ -0,0 +1,105 @@
+import os
+import sys
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+import numpy as np
+
+# Entries kept before the least recently used ones are evicted. An ada-002 vector
+# takes 6KB, so the default is about 300MB on disk.
+DEFAULT_CACHE_ENTRIES = 50000
+DEFAULT_CACHE_PATH = './cache/embeddings.sqlite'
+
+
+def text_key(model, text):
+    # Whitespace and Unicode normalization form do not change what the model sees
+    normalized = unicodedata.normalize('NFC', ' '.join(text.split()))
+    return model + ':' + hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    # Content-addressed embeddings in SQLite, keyed by model and text hash, so text
+    # that was embedded once is never paid for again, whatever post or output
+    # directory it comes from. Safe to share between threads.
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_CACHE_ENTRIES):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.max_entries = int(max_entries)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)')
+        self._db.commit()
+        self.count = self._db.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+
+    def get_many(self, model, texts):
+        # List with the cached vector of each text, or None where it is not cached
+        keys = [text_key(model, text) for text in texts]
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                rows = self._db.execute('SELECT key, vector FROM embeddings WHERE key IN ('+','.join('?' * len(part))+')', part)
+                for key, vector in rows:
+                    found[key] = vector
+            if len(found) > 0:
+                now = time.time()
+                self._db.executemany('UPDATE embeddings SET last_used = ? WHERE key = ?', [(now, key) for key in found])
+                self._db.commit()
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return [np.frombuffer(found[key], dtype=np.float32).tolist() if key in found else None for key in keys]
+
+    def put_many(self, model, texts, embeddings):
+        now = time.time()
+        rows = [(text_key(model, text), np.asarray(embedding, dtype=np.float32).tobytes(), now) for text, embedding in zip(texts, embeddings)]
+        with self._lock:
+            cursor = self._db.executemany('INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)', rows)
+            self.count += cursor.rowcount
+            if self.max_entries > 0 and self.count > self.max_entries:
+                excess = self.count - self.max_entries
+                self._db.execute('DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)', (excess,))
+                self.count -= excess
+            self._db.commit()
+
+    def report(self):
+        lookups = self.hits + self.misses
+        rate = 100.0 * self.hits / lookups if lookups > 0 else 0.0
+        return "Embedding cache: "+str(self.hits)+" hits, "+str(self.misses)+" misses ("+str(round(rate, 1))+"% hit rate), "+str(self.count)+" entries"
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM embeddings')
+            self._db.commit()
+            self.count = 0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+if __name__ == '__main__':
+    import configparser
+
+    command = str(sys.argv[1]).upper() if len(sys.argv) > 1 else ''
+    if command not in ("STATS", "CLEAR"):
+        print('Usage: python ghost_embedding_cache.py stats')
+        print('       python ghost_embedding_cache.py clear')
+        sys.exit()
+
+    config = configparser.ConfigParser()
+    config.read('./.env')
+    cache = EmbeddingCache(config['BASIC'].get('EMBEDDING_CACHE_PATH', DEFAULT_CACHE_PATH) if 'BASIC' in config else DEFAULT_CACHE_PATH)
+    if command == "CLEAR":
+        cache.clear()
+        print("Embedding cache cleared")
+    else:
+        print(str(cache.count)+" cached embeddings in "+cache.path+", "+str(round(os.path.getsize(cache.path) / 1e6, 1))+" MB")
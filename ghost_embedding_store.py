@@ -0,0 +1,305 @@
+import os
+import sys
+import re
+import json
+import threading
+import configparser
+import numpy as np
+
+# On-disk layout of a store directory:
+#   vectors.f32  raw float32 rows, appended only, memory-mapped on load
+#   index.jsonl  one JSON record per line: a 'put' points a blog id to a row,
+#                a 'delete' is a tombstone. The last record for an id wins.
+#   meta.json    vector dimension, and the next version after a compaction
+#
+# Every vector written gets a new version. Unlike its row, the version survives
+# compaction, so the neighbour table and the ANN index can tell re-embedded posts by it.
+VECTOR_FILE = 'vectors.f32'
+INDEX_FILE = 'index.jsonl'
+META_FILE = 'meta.json'
+
+LEGACY_CSV_PATTERN = re.compile(r'blog-([\d\w]*)-embedding.csv')
+
+
+class EmbeddingStore:
+    def __init__(self, path):
+        self.path = path
+        self.vector_path = os.path.join(path, VECTOR_FILE)
+        self.index_path = os.path.join(path, INDEX_FILE)
+        self.meta_path = os.path.join(path, META_FILE)
+        self.dim = None
+        self.records = {}
+        self._row_count = 0
+        self._next_version = 0
+        self._lock = threading.Lock()
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._load_meta()
+        self._load_index()
+
+    def _load_meta(self):
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            self.dim = int(meta['dim'])
+            self._next_version = int(meta.get('next_version', 0))
+            self._repair_vectors()
+
+    def _write_meta(self):
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'dim': self.dim, 'dtype': 'float32', 'next_version': self._next_version}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.meta_path)
+
+    def _repair_vectors(self):
+        # A crash in the middle of an append can leave a partial row behind. Drop it.
+        if not os.path.exists(self.vector_path):
+            self._row_count = 0
+            return
+        row_bytes = self.dim * 4
+        size = os.path.getsize(self.vector_path)
+        if size % row_bytes != 0:
+            with open(self.vector_path, 'r+b') as f:
+                f.truncate(size - size % row_bytes)
+        self._row_count = size // row_bytes
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        # Cut a torn trailing line so the next append starts on a fresh line
+        with open(self.index_path, 'r+b') as f:
+            data = f.read()
+            if len(data) > 0 and not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+        with open(self.index_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn trailing line from an interrupted append
+                    continue
+                blog_id = record['blog_id']
+                if record.get('op') == 'delete':
+                    self.records.pop(blog_id, None)
+                elif record['row'] < self._row_count:
+                    self.records.pop(blog_id, None)
+                    self.records[blog_id] = record
+        for record in self.records.values():
+            self._next_version = max(self._next_version, record_version(record) + 1)
+        self._next_version = max(self._next_version, self._row_count)
+
+    def _append_index(self, records):
+        lines = ''.join(json.dumps(record) + '\n' for record in records)
+        with open(self.index_path, 'a') as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, blog_id):
+        return str(blog_id) in self.records
+
+    def ids(self):
+        return list(self.records.keys())
+
+    def get(self, blog_id):
+        return self.records.get(str(blog_id))
+
+    def version(self, blog_id):
+        return record_version(self.records[str(blog_id)])
+
+    def append_many(self, items):
+        # items: iterable of dicts with blog_id, title, embedding and optional extra fields.
+        # Vectors are written and synced before their index records, so a crash can only
+        # leave unreferenced rows behind, never an index record pointing at missing data.
+        items = list(items)
+        if len(items) == 0:
+            return
+        with self._lock:
+            vectors = np.asarray([item['embedding'] for item in items], dtype=np.float32)
+            if vectors.ndim != 2:
+                raise ValueError('Embeddings must be one-dimensional vectors of the same length')
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+                self._write_meta()
+            elif vectors.shape[1] != self.dim:
+                raise ValueError('Embedding dimension '+str(vectors.shape[1])+' does not match store dimension '+str(self.dim))
+
+            with open(self.vector_path, 'ab') as f:
+                f.write(vectors.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+            records = []
+            for offset, item in enumerate(items):
+                record = {key: value for key, value in item.items() if key != 'embedding'}
+                record['op'] = 'put'
+                record['blog_id'] = str(item['blog_id'])
+                record['row'] = self._row_count + offset
+                record['version'] = self._next_version + offset
+                records.append(record)
+            self._append_index(records)
+            self._row_count += len(items)
+            self._next_version += len(items)
+
+            for record in records:
+                self.records.pop(record['blog_id'], None)
+                self.records[record['blog_id']] = record
+
+    def append(self, blog_id, title, embedding, content_hash='', **extra):
+        item = dict(extra)
+        item.update({'blog_id': str(blog_id), 'title': title, 'embedding': embedding, 'content_hash': content_hash})
+        self.append_many([item])
+
+    def update_metadata(self, updates):
+        # updates: list of (blog_id, {field: value}). Changes index fields such as
+        # updated_at without writing a new vector, so the row stays the same.
+        with self._lock:
+            records = []
+            for blog_id, fields in updates:
+                blog_id = str(blog_id)
+                if blog_id not in self.records:
+                    continue
+                record = dict(self.records[blog_id])
+                record.update(fields)
+                record['op'] = 'put'
+                records.append(record)
+            if len(records) == 0:
+                return
+            self._append_index(records)
+            for record in records:
+                self.records[record['blog_id']] = record
+
+    def delete(self, blog_id):
+        blog_id = str(blog_id)
+        with self._lock:
+            if blog_id not in self.records:
+                return False
+            self._append_index([{'op': 'delete', 'blog_id': blog_id}])
+            del self.records[blog_id]
+        return True
+
+    def vectors(self):
+        # Memory-mapped view of every row ever written, including superseded ones
+        if self.dim is None or self._row_count == 0:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        return np.memmap(self.vector_path, dtype=np.float32, mode='r', shape=(self._row_count, self.dim))
+
+    def load(self):
+        # Returns (blog_ids, titles, matrix) for the live posts. When nothing has been
+        # replaced or deleted, the matrix is the memory map itself and no copy is made.
+        blog_ids = list(self.records.keys())
+        titles = [self.records[blog_id].get('title', '') for blog_id in blog_ids]
+        rows = np.fromiter((self.records[blog_id]['row'] for blog_id in blog_ids), dtype=np.int64, count=len(blog_ids))
+        vectors = self.vectors()
+        if len(rows) == vectors.shape[0] and np.array_equal(rows, np.arange(len(rows))):
+            return blog_ids, titles, vectors
+        return blog_ids, titles, np.asarray(vectors[rows])
+
+    def compact(self):
+        # Rewrite the store with only live rows, dropping superseded vectors and tombstones.
+        # Versions are kept, and the next one is saved since the rows no longer tell it.
+        with self._lock:
+            blog_ids = list(self.records.keys())
+            if self.dim is None:
+                return 0
+            self._write_meta()
+            vectors = self.vectors()
+            tmp_vector_path = self.vector_path + '.tmp'
+            tmp_index_path = self.index_path + '.tmp'
+            records = []
+            with open(tmp_vector_path, 'wb') as vector_file:
+                for row, blog_id in enumerate(blog_ids):
+                    record = dict(self.records[blog_id])
+                    vector_file.write(np.asarray(vectors[record['row']], dtype=np.float32).tobytes())
+                    record['version'] = record_version(record)
+                    record['row'] = row
+                    records.append(record)
+                vector_file.flush()
+                os.fsync(vector_file.fileno())
+            with open(tmp_index_path, 'w') as index_file:
+                index_file.write(''.join(json.dumps(record) + '\n' for record in records))
+                index_file.flush()
+                os.fsync(index_file.fileno())
+            del vectors
+            os.replace(tmp_vector_path, self.vector_path)
+            os.replace(tmp_index_path, self.index_path)
+            self._row_count = len(records)
+            self.records = {record['blog_id']: record for record in records}
+            return len(records)
+
+
+def record_version(record):
+    # Records written before versions were added use their row, which was unique then
+    return record.get('version', record['row'])
+
+
+def findLegacyEmbeddingFiles(csv_path):
+    if not os.path.exists(csv_path):
+        return []
+    legacy_files = []
+    for file in os.scandir(csv_path):
+        match = LEGACY_CSV_PATTERN.search(file.name)
+        if match:
+            legacy_files.append((match.group(1), file.path))
+    return legacy_files
+
+
+def migrateLegacyEmbeddings(csv_path, store, batch_size=500):
+    # Import per-post blog-<id>-embedding.csv files into the store. The CSV files are left in place.
+    import pandas as pd
+
+    pending = []
+    migrated = 0
+    for blog_id, file_path in findLegacyEmbeddingFiles(csv_path):
+        if blog_id in store:
+            continue
+        try:
+            blog_df = pd.read_csv(file_path)
+            embedding = json.loads(blog_df['embedding'][0])
+        except Exception as e:
+            print("Failed to migrate "+str(file_path)+": "+str(e))
+            continue
+        pending.append({'blog_id': blog_id, 'title': str(blog_df['title'][0]), 'embedding': embedding, 'content_hash': ''})
+        if len(pending) >= batch_size:
+            store.append_many(pending)
+            migrated += len(pending)
+            pending = []
+    store.append_many(pending)
+    migrated += len(pending)
+    return migrated
+
+
+def openEmbeddingStore(output_path):
+    # The store lives next to the legacy CSV files. An empty store picks up any
+    # existing CSV embeddings so upgrading does not pay for embeddings twice.
+    store = EmbeddingStore(os.path.join(output_path, 'embeddings'))
+    if len(store) == 0 and len(findLegacyEmbeddingFiles(output_path)) > 0:
+        print("Migrating legacy CSV embeddings in "+str(output_path)+" to the embedding store")
+        migrated = migrateLegacyEmbeddings(output_path, store)
+        print(str(migrated)+" embeddings migrated")
+    return store
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or str(sys.argv[1]).upper() not in ("MIGRATE", "COMPACT"):
+        print('Usage: python ghost_embedding_store.py migrate [csv_directory]')
+        print('       python ghost_embedding_store.py compact')
+        sys.exit()
+
+    config = configparser.ConfigParser()
+    config.read('./.env')
+    output_path = config['BASIC']['EMBEDDING_OUTPUT_PATH']
+    store = EmbeddingStore(os.path.join(output_path, 'embeddings'))
+
+    if str(sys.argv[1]).upper() == "MIGRATE":
+        csv_path = sys.argv[2] if len(sys.argv) > 2 else output_path
+        migrated = migrateLegacyEmbeddings(csv_path, store)
+        print(str(migrated)+" embeddings migrated from "+str(csv_path)+", "+str(len(store))+" in store")
+    else:
+        print(str(store.compact())+" embeddings kept after compaction")
@@ -1,233 +1,289 @@
 import os
 import sys
-import re
-import json
+import hashlib
 import requests # pip install requests
-import jwt	# pip install pyjwt
-import configparser
-import pandas as pd
-import numpy as np
-from openai import OpenAI
-
 import logging
 
-from datetime import datetime as date
-from openai import OpenAI
-
-config = configparser.ConfigParser()
-config.read('./.env')
-key = ""
-try:
-    key = config['BASIC']['GHOST_ADMIN_API_KEY']
-except KeyError as e:
-    print("Not finding key in config. Try environment.")
-
-if len(key) == 0:
-    if 'GHOST_ADMIN_API_KEY' not in os.environ:
-        print("Missing GHOST_ADMIN_API_KEY. Please set the GHOST_ADMIN_API_KEY environment variable before running the script. You can find it by following instructions here: https://ghost.org/docs/admin-api/")
-        exit(0)
-    else:
-        key = os.environ.get('GHOST_ADMIN_API_KEY')
-
-print("GHOST_ADMIN_API_KEY ready")
-openai_key = ""
-try:
-    openai_key = config['BASIC']['OPENAI_API_KEY']
-except KeyError as e:
-    print("Not finding key in config. Try environment.")
-
-if len(openai_key) == 0:
-    if 'OPENAI_API_KEY' not in os.environ:
-        print("Missing OPENAI_API_KEY. Please set the OPENAI_API_KEY environment variable before running the script. You can find it by following instructions here: https://platform.openai.com/account/api-keys")
-        exit(0)
+from ghost_embedding_store import EmbeddingStore, openEmbeddingStore
+from ghost_embedding_cache import EmbeddingCache, DEFAULT_CACHE_PATH, DEFAULT_CACHE_ENTRIES
+from ghost_admin import DEFAULT_PAGE_SIZE, DEFAULT_FETCH_WORKERS
+from ghost_batching import make_batches, embed_with_bisection, chunk_text, pool_embeddings, DEFAULT_BATCH_ITEMS, DEFAULT_BATCH_TOKENS, DEFAULT_CHUNK_TOKENS, DEFAULT_CHUNK_OVERLAP
+from ghost_ratelimit import RateLimiter, AdaptiveConcurrency
+from ghost_embedding_backends import OpenAIBackend, HashingBackend, DEFAULT_LOCAL_DIMENSIONS
+from ghost_pipeline import Stage, run_pipeline
+from ghost_text import extract_text, CONTENT_FORMATS
+from ghost_journal import openRunJournal, resume_requested, EMBEDDED
+from ghost_metrics import timer
+from ghost_config import settings, admin_client, openai_client, prepare_run
+
+DEFAULT_EMBEDDING_MODEL = "text-embedding-ada-002"
+DEFAULT_EMBEDDING_CONCURRENCY = 2
+DEFAULT_EXTRACTION_WORKERS = 2
+DEFAULT_OPENAI_REQUESTS_PER_MINUTE = 3000
+DEFAULT_OPENAI_TOKENS_PER_MINUTE = 1000000
+DEFAULT_LOCAL_BATCH_ITEMS = 500
+
+config = settings()
+url = config['GHOST_SITE_URL']
+output_path = config['EMBEDDING_OUTPUT_PATH']
+page_size = config.get('GHOST_PAGE_SIZE', str(DEFAULT_PAGE_SIZE))
+fetch_workers = int(config.get('GHOST_FETCH_WORKERS', DEFAULT_FETCH_WORKERS))
+post_filter = config.get('GHOST_POST_FILTER', None)
+
+# openai, or local for CPU embeddings that need no API key or network access
+embedding_backend_name = config.get('EMBEDDING_BACKEND', 'openai').lower()
+batch_items = int(config.get('EMBEDDING_BATCH_SIZE', DEFAULT_BATCH_ITEMS))
+batch_tokens = int(config.get('EMBEDDING_BATCH_TOKENS', DEFAULT_BATCH_TOKENS))
+embedding_model = config.get('EMBEDDING_MODEL', DEFAULT_EMBEDDING_MODEL)
+embedding_concurrency = int(config.get('EMBEDDING_CONCURRENCY', DEFAULT_EMBEDDING_CONCURRENCY))
+extraction_workers = int(config.get('EXTRACTION_WORKERS', DEFAULT_EXTRACTION_WORKERS))
+chunk_tokens = int(config.get('EMBEDDING_CHUNK_TOKENS', DEFAULT_CHUNK_TOKENS))
+chunk_overlap = int(config.get('EMBEDDING_CHUNK_OVERLAP', DEFAULT_CHUNK_OVERLAP))
+# Also keep the vector of every chunk of a long post, in output/chunks
+keep_chunks = config.get('EMBEDDING_KEEP_CHUNKS', 'false').lower() in ('1', 'true', 'yes')
+# Kept outside the output directory so rebuilding it does not pay for the same text
+# again. An empty EMBEDDING_CACHE_PATH turns the cache off.
+embedding_cache_path = config.get('EMBEDDING_CACHE_PATH', DEFAULT_CACHE_PATH)
+
+# Set by main()
+embedding_backend = None
+embedding_cache = None
+resume = False
+# Ids of posts with a chunk that failed to embed; the run stays resumable while there are any
+embedding_failures = set()
+
+
+def createEmbeddingBackend():
+    global batch_items, batch_tokens
+    if embedding_backend_name == 'local':
+        # Whole batches are embedded in process, so the OpenAI item and token limits do not apply
+        batch_items = int(config.get('EMBEDDING_BATCH_SIZE', DEFAULT_LOCAL_BATCH_ITEMS))
+        batch_tokens = 0
+        return HashingBackend(int(config.get('LOCAL_EMBEDDING_DIMENSIONS', DEFAULT_LOCAL_DIMENSIONS)))
+    openai_limiter = RateLimiter(
+        int(config.get('OPENAI_REQUESTS_PER_MINUTE', DEFAULT_OPENAI_REQUESTS_PER_MINUTE)),
+        int(config.get('OPENAI_TOKENS_PER_MINUTE', DEFAULT_OPENAI_TOKENS_PER_MINUTE)))
+    # Fewer requests in flight after a 429, back up to EMBEDDING_CONCURRENCY as they succeed
+    openai_concurrency = AdaptiveConcurrency(embedding_concurrency)
+    return OpenAIBackend(openai_client(), embedding_model, openai_limiter, openai_concurrency)
+
+
+def embedBatch(batch):
+    # Chunks embedded before, by any post or output directory, come from the cache,
+    # looked up once per batch. Only the rest go to the backend, and only they are
+    # split up if the backend rejects one of them.
+    # Returns (item, embedding) pairs for the chunks that have an embedding.
+    cache = embedding_cache if embedding_backend.cacheable else None
+    if cache is None:
+        return embed_with_bisection(batch, embedding_backend.embed, logEmbeddingFailure)
+    embeddings = cache.get_many(embedding_model, [item['text'] for item in batch])
+    results = [(item, embedding) for item, embedding in zip(batch, embeddings) if embedding is not None]
+    missing = [item for item, embedding in zip(batch, embeddings) if embedding is None]
+    if len(missing) == 0:
+        return results
+    embedded = embed_with_bisection(missing, embedding_backend.embed, logEmbeddingFailure)
+    cache.put_many(embedding_model, [item['text'] for item, _ in embedded], [embedding for _, embedding in embedded])
+    return results + embedded
+
+def extractPostContent(post):
+    try:
+        with timer('extraction'):
+            return extract_text(post)
+    except Exception as e:
+        print('Blog failed to parse content due to error:')
+        print(e)
+        logging.info('Blog failed to parse content due to error:')
+        logging.info(e)
+        logging.info('ID:'+post['id']+'\nTitle:'+str(post['title']))
+        print("Skip to next blog.")
+        return None
+
+def contentHash(postContent):
+    return hashlib.sha256(postContent.encode('utf-8')).hexdigest()
+
+def preparePost(post, store, metadata_updates, embedded_ids=()):
+    # Returns one item per chunk of the post's text when its embedding is missing or
+    # stale, otherwise []. A post is only re-embedded when its fingerprint changed:
+    # extracted text hash, updated_at and embedding model. An unchanged updated_at
+    # skips extraction entirely.
+    id = post['id']
+    if id in embedded_ids:
+        return []
+    record = store.get(id)
+    if record is not None and record.get('model') == embedding_model and record.get('updated_at') == post['updated_at']:
+        return []
+
+    print("Parsing blog-"+str(id))
+    logging.info("Parsing blog-"+str(id))
+    postContent = extractPostContent(post)
+    if postContent is None:
+        return []
+
+    if len(postContent) > 0:
+        content_hash = contentHash(postContent)
+        if record is not None:
+            # Embeddings migrated from CSV files have no text hash yet, and anything
+            # embedded before fingerprints were recorded used the default model
+            previous_hash = record.get('content_hash') or content_hash
+            previous_model = record.get('model', DEFAULT_EMBEDDING_MODEL)
+        if record is not None and previous_hash == content_hash and previous_model == embedding_model:
+            # Saved without a text change: keep the vector, record the new fingerprint
+            metadata_updates.append((id, {'content_hash': content_hash, 'updated_at': post['updated_at'], 'model': embedding_model}))
+            return []
+        if record is not None:
+            print("blog-"+str(id)+" content changed, re-embedding")
+            logging.info("blog-"+str(id)+" content changed, re-embedding")
+        chunks = chunk_text(postContent, chunk_tokens, chunk_overlap)
+        if len(chunks) > 1:
+            logging.info("blog-"+str(id)+" split into "+str(len(chunks))+" chunks")
+        return [{'blog_id': id, 'title': post['title'], 'text': chunk, 'chunk': i, 'chunks': len(chunks), 'content_hash': content_hash, 'updated_at': post['updated_at']} for i, chunk in enumerate(chunks)]
     else:
-        openai_key = os.environ.get('OPENAI_API_KEY')
-
-print("OPENAI_API_KEY ready")
-
-
-client = OpenAI(api_key=openai_key)
-
-url = config['BASIC']['GHOST_SITE_URL']
-log_path = config['BASIC']['LOG_PATH']
-output_path = config['BASIC']['EMBEDDING_OUTPUT_PATH']
-max_related_count = int(config['BASIC']['MAX_RELATED_BLOG_COUNT'])
-
-if not os.path.exists(output_path):
-    os.makedirs(output_path)
-    print("Directory "+str(output_path)+" created.")
-#else:
-#    print("Directory "+str(output_path)+" already exists.")
-
-if not os.path.exists(log_path):
-    os.makedirs(log_path)
-    print("Directory "+str(log_path)+" created.")
-#else:
-#    print("Directory "+str(log_path)+" already exists.")
-
-# Configure logging
-logging.basicConfig(
-    filename=str(log_path)+'/embedding.log',
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s]: %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-)
-
-
-def get_embedding(text_input, model="text-embedding-ada-002"):
-    response = client.embeddings.create(input=[text_input], model=model)
-    embedding = response.data[0].embedding
-    return embedding
-
-def fetchBlogPage(page):
-    # Split the key into ID and SECRET
-    id, secret = key.split(':')
-
-    # Prepare header and payload
-    iat = int(date.now().timestamp())
-
-    header = {'alg': 'HS256', 'typ': 'JWT', 'kid': id}
-    payload = {
-        'iat': iat,
-        'exp': iat + 5 * 60,
-        'aud': '/admin/'
-    }
-
-    # Create the token (including decoding secret)
-    token = jwt.encode(payload, bytes.fromhex(secret), algorithm='HS256', headers=header)
-
-    # Make an authenticated request to list all posts
-    headers = {'Authorization': 'Ghost {}'.format(token)}
-    geturl = url+'/ghost/api/admin/posts/?page='+str(page)
-
-    return requests.get(geturl, headers=headers)
-
-def getAllBlogIDs():
-    files = os.scandir(output_path)
-    blog_ids = []
-    for file in files:
-        if re.search('blog-([\d\w]*)-embedding.csv', file.name):
-            blog_id = re.search('blog-([\d\w]*)-embedding.csv', file.name).group(1)
-            blog_ids.append(blog_id)
-    return blog_ids
-
+        print("blog-"+str(id)+" content failed to load. Skip to next blog.")
+        logging.info("blog-"+str(id)+" content failed to load. Skip to next blog.")
+        logging.info('ID:'+id+'\nTitle:'+str(post['title']))
+        return []
+
+def logEmbeddingFailure(item, e):
+    embedding_failures.add(item['blog_id'])
+    print('Blog failed to convert due to error:')
+    print(e)
+    print('ID:'+item['blog_id']+'\nTitle:'+str(item['title'])+'\nChunk:'+str(item['chunk']+1)+' of '+str(item['chunks']))
+    logging.info('Blog failed to convert due to error:')
+    logging.info(e)
+    logging.info('ID:'+item['blog_id']+'\nTitle:'+str(item['title'])+'\nChunk:'+str(item['chunk']+1)+' of '+str(item['chunks']))
+    logging.info('Post content:'+str(item['text'][:1000]))
+
+def saveChunkEmbeddings(chunk_store, blog_id, parts, previous_count):
+    # Chunk vectors are stored as '<blog id>#<chunk>'; drop chunks a shorter new version no longer has
+    chunk_store.append_many([{
+        'blog_id': str(blog_id)+'#'+str(item['chunk']),
+        'post_id': blog_id,
+        'chunk': item['chunk'],
+        'title': item['title'],
+        'embedding': embedding,
+        'tokens': item['tokens'],
+    } for item, embedding in parts])
+    for chunk in range(len(parts), previous_count):
+        chunk_store.delete(str(blog_id)+'#'+str(chunk))
 
 def generateEmbeddingsForAllBlogs():
-    response = fetchBlogPage(1)
-
-    if int(response.status_code) != 200:
+    try:
+        listing = admin_client().list_posts(page_size, fetch_workers, fields=['id', 'title', 'updated_at'] + list(CONTENT_FORMATS), formats=CONTENT_FORMATS, filter=post_filter)
+    except requests.exceptions.RequestException as e:
+        logging.info("Failed to load blog list: "+str(e))
         sys.exit('Failed to load blog list, please check ./.env to make sure all keys are set.')
 
-    total_page = int(response.json()['meta']['pagination']['pages'])
-    total_blog = int(response.json()['meta']['pagination']['total'])
-    print(str(total_page)+' pages to load')
-    print(str(total_blog)+' blogs to load')
-
-    for page in range(1,total_page+1):
-        response = fetchBlogPage(page).json()
-        posts = response['posts']
+    print(str(listing.pages)+' pages to load')
+    print(str(listing.total)+' blogs to load')
+    embedPosts(listing)
+
+def embedPosts(listing, visit=None):
+    # visit(post), when given, sees every listed post in the extraction workers, so
+    # a caller sharing the listing can pick out what else it needs
+    store = openEmbeddingStore(output_path)
+    if store.dim is not None and embedding_backend.dimensions is not None and store.dim != embedding_backend.dimensions:
+        sys.exit("The embeddings in "+str(output_path)+" have "+str(store.dim)+" dimensions, "+embedding_model+" makes "+str(embedding_backend.dimensions)+". Use a separate EMBEDDING_OUTPUT_PATH for each backend.")
+
+    chunk_store = EmbeddingStore(os.path.join(output_path, 'chunks')) if keep_chunks else None
+    journal = openRunJournal(output_path, 'embeddings', embedding_model, resume)
+    embedded_ids = set(journal.completed(EMBEDDED))
+
+    count = 0
+    chunk_count = 0
+    token_count = 0
+    metadata_updates = []
+    # Chunks of long posts can come back in different batches. A post is written once
+    # all of its chunks are embedded; posts with a failed chunk never complete.
+    collected = {}
+
+    def extract(post):
+        if visit is not None:
+            visit(post)
+        return preparePost(post, store, metadata_updates, embedded_ids)
+
+    # listing -> extract (threads) -> batch -> embed (concurrent requests) -> write (here).
+    # Bounded queues between stages provide the backpressure.
+    stages = [
+        Stage('extract', extract, extraction_workers),
+        Stage('batch', lambda items: make_batches(items, batch_items, batch_tokens), stream=True),
+        Stage('embed', lambda batch: [(batch, embedBatch(batch))], embedding_concurrency),
+    ]
+    for batch, results in run_pipeline(listing, stages):
+        completed = []
+        for item, embedding in results:
+            parts = collected.setdefault(item['blog_id'], [])
+            parts.append((item, embedding))
+            if len(parts) == item['chunks']:
+                del collected[item['blog_id']]
+                parts.sort(key=lambda part: part[0]['chunk'])
+                completed.append(parts)
+
+        posts = []
+        for parts in completed:
+            item = parts[0][0]
+            tokens = [part_item['tokens'] for part_item, _ in parts]
+            if chunk_store is not None:
+                previous = store.get(item['blog_id'])
+                saveChunkEmbeddings(chunk_store, item['blog_id'], parts, previous.get('chunks', 0) if previous is not None else 0)
+            posts.append({
+                'blog_id': item['blog_id'],
+                'title': item['title'],
+                'embedding': pool_embeddings([embedding for _, embedding in parts], tokens),
+                'content_hash': item['content_hash'],
+                'updated_at': item['updated_at'],
+                'model': embedding_model,
+                'chunks': len(parts),
+                'tokens': sum(tokens),
+            })
+            chunk_count += len(parts)
+            token_count += sum(tokens)
+        store.append_many(posts)
+        journal.record_many([post['blog_id'] for post in posts], EMBEDDED)
         for post in posts:
-            postContent = ""
-            id = post['id']
-            print("Parsing blog-"+str(id))
-            logging.info("Parsing blog-"+str(id))
-            embedding_file_path = output_path+"/blog-"+str(id)+"-embedding.csv"
-            if not os.path.exists(embedding_file_path):
-                title = post['title']
-                postContent = postContent + str(title) + '\n'
-
-                if post['mobiledoc'] == None:
-                    print("Blog failed to parse content due to missing 'mobiledoc' data.")
-                    logging.info("Blog failed to parse content due to missing 'mobiledoc' data.")
-                    logging.info("Blog post content:"+str(post))
-                    print("Skip to next blog.")
-                    continue
-
-                try:
-                    mobiledoc = json.loads(post['mobiledoc'])
-                except Exception as e:
-                    #Do a simple retry
-                    print('Blog failed to parse mobiledoc data due to error:')
-                    print(e)
-                    logging.info('Blog failed to parse mobiledoc data due to error:')
-                    logging.info(e)
-                    print("Skip to next blog.")
-                    continue
-
-
-                cards = mobiledoc['cards']
-                for card in cards:
-                    if card[0] == 'toggle':
-                        headContent = card[1]['heading']
-                        headContent = headContent.replace('<p>','')
-                        headContent = headContent.replace('</p>','\n')
-                        content = card[1]['content']
-                        content = content.replace('<p>','')
-                        content = content.replace('</p>','\n')
-                        postContent = postContent + headContent + '\n' + content + '\n'
-                    elif card[0] == 'html':
-                        htmlString = card[1]['html']
-                        postContent = postContent + htmlString + '\n'
-
-                sections = mobiledoc['sections']
-                for section in sections:
-                    if int(section[0]) == 1:
-                        paragraph = list(section[2])
-                        if len(paragraph) > 0:
-                            if len(paragraph[0]) > 3:
-                                postContent = postContent + str(paragraph[0][3])
-
-                html = ""
-                if 'html' in post:
-                    html = json.loads(post['html'])
-                    postContent = postContent + str(html)
-
-                if len(postContent) > 0:
-                    try:
-                        embedding = get_embedding(postContent)
-                    except Exception as e:
-                        #Do a simple retry
-                        try:
-                            embedding = get_embedding(postContent)
-                        except Exception as e:
-                            print('Blog failed to convert due to error:')
-                            print(e)
-                            print('ID:'+id+'\nTitle:'+title)
-                            print('Post content:'+str(postContent))
-                            print('Original mobiledoc:'+str(mobiledoc))
-                            print('Original cards:'+str(cards))
-                            print('Original html:'+str(html))
-                            print('Original post:')
-                            print(post)
-                            logging.info('Blog failed to convert due to error:')
-                            logging.info(e)
-                            logging.info('ID:'+id+'\nTitle:'+title)
-                            logging.info('Post content:'+str(postContent))
-                            logging.info('Original mobiledoc:'+str(mobiledoc))
-                            logging.info('Original cards:'+str(cards))
-                            logging.info('Original html:'+str(html))
-                            logging.info('Original post:')
-                            logging.info(post)
-                            continue
-
-
-                    newdf = pd.DataFrame({"blog_id":[id],"title":[title],"embedding":[embedding]})
-                    newdf.to_csv(embedding_file_path,index=None)
-                    print("blog-"+str(id)+" embedding generated")
-                    logging.info("blog-"+str(id)+" embedding generated")
-                    #logging.info('Embedded content:'+str(postContent))
-                else:
-                    print("blog-"+str(id)+" content failed to load. Skip to next blog.")
-                    logging.info("blog-"+str(id)+" content failed to load. Skip to next blog.")
-                    logging.info('ID:'+id+'\nTitle:'+title)
-                    logging.info('Post content:'+str(postContent))
-                    logging.info('Original mobiledoc:'+str(mobiledoc))
-                    logging.info('Original cards:'+str(cards))
-                    logging.info('Original html:'+str(html))
-                    logging.info('Original post:')
-                    logging.info(post)
-            #else:
-                #print("blog-"+str(id)+" embedding existed")
-
-
-generateEmbeddingsForAllBlogs()
+            print("blog-"+str(post['blog_id'])+" embedding generated")
+            logging.info("blog-"+str(post['blog_id'])+" embedding generated from "+str(post['chunks'])+" chunks, "+str(post['tokens'])+" tokens")
+        count += len(posts)
+        print(str(len(results))+" of "+str(len(batch))+" chunks in the batch embedded")
+
+    store.update_metadata(metadata_updates)
+    failed_ids = embedding_failures | set(collected)
+    if len(failed_ids) > 0:
+        print(str(len(failed_ids))+" blogs not saved because a chunk failed to embed, they will be retried on the next run")
+        logging.info(str(len(failed_ids))+" blogs not saved because a chunk failed to embed: "+', '.join(sorted(failed_ids)))
+    else:
+        journal.finish()
+    print("Total "+str(count)+" blog embedded, "+str(len(failed_ids))+" failed, "+str(len(metadata_updates))+" unchanged after edits.")
+    print(str(chunk_count)+" chunks, "+str(token_count)+" tokens embedded.")
+    logging.info("Total "+str(count)+" blog embedded, "+str(len(failed_ids))+" failed, "+str(len(metadata_updates))+" unchanged after edits.")
+    logging.info(str(chunk_count)+" chunks, "+str(token_count)+" tokens embedded.")
+    if embedding_cache is not None:
+        print(embedding_cache.report())
+        logging.info(embedding_cache.report())
+
+
+def configure(arguments):
+    # Everything main() sets up except logging, also used by ghostai.py pipeline
+    global embedding_backend, embedding_cache, embedding_model, embedding_concurrency, resume
+    if embedding_backend_name not in ('openai', 'local'):
+        sys.exit("Unknown EMBEDDING_BACKEND '"+embedding_backend_name+"', use openai or local.")
+    if '--concurrency' in arguments:
+        embedding_concurrency = int(arguments[arguments.index('--concurrency') + 1])
+    # Pick up the last interrupted run, skipping posts it already embedded
+    resume = resume_requested(arguments)
+
+    embedding_backend = createEmbeddingBackend()
+    embedding_model = embedding_backend.model
+    if len(embedding_cache_path) > 0 and embedding_backend_name == 'openai':
+        embedding_cache = EmbeddingCache(embedding_cache_path, int(config.get('EMBEDDING_CACHE_ENTRIES', DEFAULT_CACHE_ENTRIES)))
+
+
+def main(arguments=None):
+    arguments = sys.argv[1:] if arguments is None else list(arguments)
+    admin_client()
+    prepare_run('embeddings', 'embedding.log')
+    configure(arguments)
+    generateEmbeddingsForAllBlogs()
+
+
+if __name__ == '__main__':
+    main()
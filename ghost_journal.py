@@ -0,0 +1,120 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import threading
+
+# Stages worth skipping on a resumed run. Listing and extracting posts is cheap next
+# to the model calls and writes, so those are redone.
+#   EMBEDDED: the post's embedding is in the store (ghost_embeddings.py)
+#   TAGGED:   the chat model's tags for the post (ghost_tag_blogs.py)
+#   WRITTEN:  the post's tags are saved in Ghost (every script that writes tags)
+EMBEDDED = 'embedded'
+TAGGED = 'tagged'
+WRITTEN = 'written'
+
+JOURNAL_FILE = 'journal.sqlite'
+
+
+class RunJournal:
+    # Durable record of what a run has done, one row per post and stage, so a run
+    # that dies part way can be resumed without redoing that work. A run is found
+    # again by script and mode (e.g. 'relation_tags', 'full'); only runs that never
+    # finished are resumed. Safe to share between threads.
+    def __init__(self, path, script, mode='', resume=False):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.script = script
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY AUTOINCREMENT, script TEXT NOT NULL, mode TEXT NOT NULL, started REAL NOT NULL, finished REAL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS steps (run_id INTEGER NOT NULL, post_id TEXT NOT NULL, stage TEXT NOT NULL, value TEXT, at REAL NOT NULL, PRIMARY KEY (run_id, post_id, stage))')
+        self._db.commit()
+
+        self.run_id = None
+        self.resumed = False
+        if resume:
+            row = self._db.execute('SELECT run_id FROM runs WHERE script = ? AND mode = ? AND finished IS NULL ORDER BY run_id DESC LIMIT 1', (script, mode)).fetchone()
+            if row is not None:
+                self.run_id = row[0]
+                self.resumed = True
+        if self.run_id is None:
+            cursor = self._db.execute('INSERT INTO runs (script, mode, started) VALUES (?, ?, ?)', (script, mode, time.time()))
+            self.run_id = cursor.lastrowid
+            self._db.commit()
+
+    def record(self, post_id, stage, value=None):
+        # value is anything JSON can hold, handed back by completed()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO steps (run_id, post_id, stage, value, at) VALUES (?, ?, ?, ?, ?)',
+                (self.run_id, str(post_id), stage, json.dumps(value), time.time()))
+            self._db.commit()
+
+    def record_many(self, post_ids, stage):
+        # Several posts in one transaction, with no value
+        now = time.time()
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO steps (run_id, post_id, stage, value, at) VALUES (?, ?, ?, ?, ?)',
+                [(self.run_id, str(post_id), stage, 'null', now) for post_id in post_ids])
+            self._db.commit()
+
+    def completed(self, stage):
+        # {post id: recorded value} for every post this run took through the stage
+        with self._lock:
+            rows = self._db.execute('SELECT post_id, value FROM steps WHERE run_id = ? AND stage = ?', (self.run_id, stage)).fetchall()
+        return {post_id: json.loads(value) for post_id, value in rows}
+
+    def finish(self):
+        # Nothing left to resume: the steps are dropped, the run is kept for `runs`
+        with self._lock:
+            self._db.execute('DELETE FROM steps WHERE run_id = ?', (self.run_id,))
+            self._db.execute('UPDATE runs SET finished = ? WHERE run_id = ?', (time.time(), self.run_id))
+            self._db.commit()
+
+    def report(self):
+        with self._lock:
+            rows = self._db.execute('SELECT stage, COUNT(*) FROM steps WHERE run_id = ? GROUP BY stage ORDER BY stage', (self.run_id,)).fetchall()
+        counts = ', '.join(str(count)+" "+stage for stage, count in rows) or 'nothing recorded'
+        return ("Resumed" if self.resumed else "Started")+" run "+str(self.run_id)+" ("+self.script+(" "+self.mode if self.mode else "")+"): "+counts
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def openRunJournal(output_path, script, mode='', resume=False):
+    journal = RunJournal(os.path.join(output_path, JOURNAL_FILE), script, mode, resume)
+    if resume and not journal.resumed:
+        print("No unfinished "+script+(" "+mode if mode else "")+" run to resume, starting a new one")
+    print(journal.report())
+    return journal
+
+
+def resume_requested(arguments):
+    return any(str(argument).upper() in ('--RESUME', 'RESUME') for argument in arguments)
+
+
+if __name__ == '__main__':
+    import configparser
+
+    command = str(sys.argv[1]).upper() if len(sys.argv) > 1 else ''
+    if command != "RUNS":
+        print('Usage: python ghost_journal.py runs')
+        sys.exit()
+
+    config = configparser.ConfigParser()
+    config.read('./.env')
+    path = os.path.join(config['BASIC']['EMBEDDING_OUTPUT_PATH'], JOURNAL_FILE)
+    if not os.path.exists(path):
+        sys.exit("No run journal in "+path)
+    db = sqlite3.connect(path)
+    for run_id, script, mode, started, finished in db.execute('SELECT run_id, script, mode, started, finished FROM runs ORDER BY run_id'):
+        steps = db.execute('SELECT stage, COUNT(*) FROM steps WHERE run_id = ? GROUP BY stage ORDER BY stage', (run_id,)).fetchall()
+        state = 'finished' if finished is not None else 'unfinished, '+(', '.join(str(count)+" "+stage for stage, count in steps) or 'nothing recorded')
+        print(str(run_id)+"  "+time.strftime('%Y-%m-%d %H:%M', time.localtime(started))+"  "+script+(" "+mode if mode else "")+"  "+state)
@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import atexit
+import bisect
+import logging
+import threading
+
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds in seconds, from 1ms to about 20 minutes, each
+# about 1.6 times the last. Quantiles are read off the buckets, so they are upper
+# bounds within that factor.
+BUCKETS = tuple(round(0.001 * 1.6 ** i, 6) for i in range(31))
+METRIC_PREFIX = 'ghostai_'
+
+# What the scripts record. Timings, in seconds:
+#   page_fetch      one page of the post listing
+#   extraction      text of one post
+#   embedding_call  one batch sent to the embedding backend
+#   chat_call       one chat completion
+#   similarity      related posts or vocabulary tags for the whole site
+#   ghost_get, ghost_put, ghost_delete
+#                   one Admin API request, retries included
+# Counters: embedding_inputs, embedding_tokens, chat_prompt_tokens,
+# chat_completion_tokens, retries, throttled (429 answers), and tag_writes_changed,
+# tag_writes_skipped, tag_writes_failed.
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, fraction):
+        if self.count == 0:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count > 0:
+                return round(min(BUCKETS[index], self.max) if index < len(BUCKETS) else self.max, 6)
+        return round(self.max, 6)
+
+
+class Metrics:
+    # Counters and timing histograms by name, safe to share between threads
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def summary(self):
+        with self._lock:
+            return {
+                'started': self.started,
+                'seconds': round(time.time() - self.started, 3),
+                'counters': dict(sorted(self.counters.items())),
+                'timings': {name: {
+                    'count': histogram.count,
+                    'total_seconds': round(histogram.sum, 3),
+                    'mean_seconds': round(histogram.sum / histogram.count, 6),
+                    'p50_seconds': histogram.quantile(0.5),
+                    'p99_seconds': histogram.quantile(0.99),
+                    'max_seconds': round(histogram.max, 6),
+                } for name, histogram in sorted(self.histograms.items())},
+            }
+
+    def report(self):
+        # One line per timing, most total time first, then the counters
+        summary = self.summary()
+        lines = ["Run took "+str(round(summary['seconds'], 1))+"s"]
+        for name, timing in sorted(summary['timings'].items(), key=lambda entry: -entry[1]['total_seconds']):
+            lines.append("  %-15s %8d calls %10.1fs total  p50 %8.1fms  p99 %8.1fms" % (name, timing['count'], timing['total_seconds'], timing['p50_seconds'] * 1000, timing['p99_seconds'] * 1000))
+        if len(summary['counters']) > 0:
+            lines.append("  "+', '.join(name+"="+str(value) for name, value in summary['counters'].items()))
+        return '\n'.join(lines)
+
+    def textfile(self, labels):
+        # Prometheus text exposition format, for node_exporter's textfile collector
+        label_text = ','.join(name+'="'+str(value).replace('\\', '\\\\').replace('"', '\\"')+'"' for name, value in sorted(labels.items()))
+        with self._lock:
+            lines = []
+            for name, value in sorted(self.counters.items()):
+                metric = METRIC_PREFIX+name+'_total'
+                lines.append('# TYPE '+metric+' counter')
+                lines.append(metric+'{'+label_text+'} '+str(value))
+            for name, histogram in sorted(self.histograms.items()):
+                metric = METRIC_PREFIX+name+'_seconds'
+                lines.append('# TYPE '+metric+' histogram')
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.buckets):
+                    cumulative += count
+                    lines.append(metric+'_bucket{'+label_text+',le="'+repr(bound)+'"} '+str(cumulative))
+                lines.append(metric+'_bucket{'+label_text+',le="+Inf"} '+str(histogram.count))
+                lines.append(metric+'_sum{'+label_text+'} '+repr(histogram.sum))
+                lines.append(metric+'_count{'+label_text+'} '+str(histogram.count))
+            now = time.time()
+            for name, value in (('run_duration_seconds', now - self.started), ('run_finished_timestamp_seconds', now)):
+                lines.append('# TYPE '+METRIC_PREFIX+name+' gauge')
+                lines.append(METRIC_PREFIX+name+'{'+label_text+'} '+repr(round(value, 3)))
+        return '\n'.join(lines)+'\n'
+
+
+# Shared by every module of a run
+registry = Metrics()
+
+
+def increment(name, amount=1):
+    registry.increment(name, amount)
+
+
+def observe(name, seconds):
+    registry.observe(name, seconds)
+
+
+def timer(name):
+    return registry.timer(name)
+
+
+def write_atomically(path, text):
+    # The textfile collector may read at any moment, so never leave a partial file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def writeRunMetrics(script, log_path, textfile_path=None):
+    summary = dict(registry.summary(), script=script)
+    write_atomically(os.path.join(log_path, script+'-metrics.json'), json.dumps(summary, indent=2)+'\n')
+    if textfile_path:
+        if not os.path.exists(textfile_path):
+            os.makedirs(textfile_path)
+        write_atomically(os.path.join(textfile_path, METRIC_PREFIX+script+'.prom'), registry.textfile({'script': script}))
+    report = registry.report()
+    print(report)
+    logging.info(report)
+
+
+def recordRunMetrics(script, log_path, textfile_path=None):
+    # Write the summary when the script exits, also when it stops with an error.
+    # textfile_path is a directory for a Prometheus textfile, or None.
+    atexit.register(writeRunMetrics, script, log_path, textfile_path)
@@ -0,0 +1,143 @@
+import os
+import numpy as np
+
+from ghost_similarity import normalize_rows, top_k_rows, top_k_similar, DEFAULT_BLOCK_SIZE
+
+
+class NeighbourTable:
+    # Persisted top-k related posts for every post, so a run after a few posts
+    # changed only pays for those posts' rows instead of the whole N x N matrix.
+    #   neighbours: blog_id -> (list of related blog ids, float32 scores), best first
+    #   versions:   blog_id -> embedding store row the list was computed from
+    #   pending:    blog ids whose tags still need writing (failed on a previous run)
+    def __init__(self, k, neighbours=None, versions=None, pending=None):
+        self.k = int(k)
+        self.neighbours = neighbours or {}
+        self.versions = versions or {}
+        self.pending = set(pending or [])
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return None
+        data = np.load(path)
+        blog_ids = [str(blog_id) for blog_id in data['blog_ids']]
+        neighbour_ids = data['neighbour_ids']
+        scores = data['scores']
+        counts = data['counts']
+        neighbours = {}
+        for i, blog_id in enumerate(blog_ids):
+            count = int(counts[i])
+            neighbours[blog_id] = ([str(related) for related in neighbour_ids[i, :count]], scores[i, :count].copy())
+        versions = dict(zip(blog_ids, (int(row) for row in data['versions'])))
+        return cls(int(data['k']), neighbours, versions, [str(blog_id) for blog_id in data['pending']])
+
+    def save(self, path):
+        blog_ids = list(self.neighbours.keys())
+        width = max([1] + [len(blog_id) for blog_id in blog_ids])
+        neighbour_ids = np.full((len(blog_ids), self.k), '', dtype='<U'+str(width))
+        scores = np.zeros((len(blog_ids), self.k), dtype=np.float32)
+        counts = np.zeros(len(blog_ids), dtype=np.int32)
+        for i, blog_id in enumerate(blog_ids):
+            related, related_scores = self.neighbours[blog_id]
+            counts[i] = len(related)
+            neighbour_ids[i, :len(related)] = related
+            scores[i, :len(related)] = related_scores
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f,
+                k=np.int32(self.k),
+                blog_ids=np.array(blog_ids, dtype='<U'+str(width)),
+                versions=np.array([self.versions[blog_id] for blog_id in blog_ids], dtype=np.int64),
+                neighbour_ids=neighbour_ids,
+                scores=scores,
+                counts=counts,
+                pending=np.array(sorted(self.pending), dtype='<U'+str(width)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def build(cls, blog_ids, versions, matrix, k, block_size=DEFAULT_BLOCK_SIZE, index=None, nprobe=None):
+        # Full O(N^2) computation, or an approximate one through an attached
+        # ghost_ann.IVFIndex, which can return fewer than k posts for a row
+        table = cls(k)
+        if index is not None:
+            top_indices, top_scores = index.top_k_similar(k, nprobe) if nprobe else index.top_k_similar(k)
+        else:
+            top_indices, top_scores = top_k_similar(matrix, k, block_size)
+        for row, blog_id in enumerate(blog_ids):
+            found = top_indices[row] >= 0
+            table.neighbours[blog_id] = ([blog_ids[i] for i in top_indices[row][found]], top_scores[row][found])
+            table.versions[blog_id] = int(versions[row])
+        return table
+
+    def update(self, blog_ids, versions, matrix, block_size=DEFAULT_BLOCK_SIZE):
+        # Bring the table up to date with the current corpus and return the ids whose
+        # related list changed. New or re-embedded posts get a fresh row and are offered
+        # to every other post's list; lists that contained a deleted or re-embedded
+        # post are recomputed. Cost is O((touched + affected) x N), not O(N^2).
+        normalized = normalize_rows(matrix)
+        position = {blog_id: i for i, blog_id in enumerate(blog_ids)}
+        current = {blog_id: int(version) for blog_id, version in zip(blog_ids, versions)}
+
+        deleted = [blog_id for blog_id in self.neighbours if blog_id not in current]
+        touched = [blog_id for blog_id in blog_ids if self.versions.get(blog_id) != current[blog_id]]
+        gone = set(deleted) | set(blog_id for blog_id in touched if blog_id in self.neighbours)
+
+        for blog_id in deleted:
+            del self.neighbours[blog_id]
+            del self.versions[blog_id]
+            self.pending.discard(blog_id)
+
+        before = {blog_id: list(related) for blog_id, (related, _) in self.neighbours.items()}
+        touched_set = set(touched)
+        dirty = []
+        if len(gone) > 0:
+            for blog_id, (related, _) in self.neighbours.items():
+                if blog_id not in touched_set and any(related_id in gone for related_id in related):
+                    dirty.append(blog_id)
+        dirty_set = set(dirty)
+
+        k = min(self.k, len(blog_ids) - 1)
+        if len(touched) > 0 and k > 0:
+            # Lowest score still in each list; a touched post with a higher similarity
+            # enters that list. Full lists only, shorter lists accept anything.
+            thresholds = np.full(len(blog_ids), -np.inf, dtype=np.float32)
+            for blog_id, (related, scores) in self.neighbours.items():
+                if blog_id in position and len(related) >= k:
+                    thresholds[position[blog_id]] = scores[k - 1]
+            skip_columns = np.array([position[blog_id] for blog_id in touched_set | dirty_set], dtype=np.int64)
+
+            touched_rows = np.array([position[blog_id] for blog_id in touched], dtype=np.int64)
+            offers = {}
+            for start in range(0, len(touched_rows), block_size):
+                rows = touched_rows[start:start + block_size]
+                block = normalized[rows] @ normalized.T
+                candidates = block > thresholds[np.newaxis, :]
+                candidates[:, skip_columns] = False
+                for row_offset, column in zip(*np.nonzero(candidates)):
+                    offers.setdefault(int(column), []).append((blog_ids[rows[row_offset]], float(block[row_offset, column])))
+
+            for column, offered in offers.items():
+                blog_id = blog_ids[column]
+                related, scores = self.neighbours[blog_id]
+                merged = list(zip(scores.tolist(), related)) + [(score, related_id) for related_id, score in offered]
+                merged.sort(key=lambda item: -item[0])
+                merged = merged[:k]
+                self.neighbours[blog_id] = ([related_id for _, related_id in merged], np.array([score for score, _ in merged], dtype=np.float32))
+
+        recompute = touched + [blog_id for blog_id in dirty if blog_id not in touched_set]
+        if len(recompute) > 0:
+            rows = np.array([position[blog_id] for blog_id in recompute], dtype=np.int64)
+            top_indices, top_scores = top_k_rows(normalized[rows], normalized, self.k, exclude=rows, block_size=block_size)
+            for i, blog_id in enumerate(recompute):
+                self.neighbours[blog_id] = ([blog_ids[j] for j in top_indices[i]], top_scores[i])
+                self.versions[blog_id] = current[blog_id]
+
+        changed = set(touched)
+        for blog_id, (related, _) in self.neighbours.items():
+            if blog_id not in changed and before.get(blog_id) != related:
+                changed.add(blog_id)
+        return changed
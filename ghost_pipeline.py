@@ -0,0 +1,97 @@
+import queue
+import threading
+
+# Items waiting between two stages. Full queues block the stage in front of them,
+# so a slow stage (usually the network) holds back everything upstream.
+DEFAULT_QUEUE_SIZE = 64
+
+_END = object()
+
+
+class Stage:
+    # fn(item) returns an iterable of zero or more outputs, and runs on `workers` threads.
+    # With stream=True, fn(items) takes the whole input iterator instead (e.g. to group
+    # items into batches) and always runs on a single thread.
+    def __init__(self, name, fn, workers=1, stream=False):
+        self.name = name
+        self.fn = fn
+        self.workers = 1 if stream else max(1, int(workers))
+        self.stream = stream
+
+
+def run_pipeline(source, stages, queue_size=DEFAULT_QUEUE_SIZE):
+    # Feed source through the stages on background threads and yield what the last
+    # stage produces. The first exception in any stage stops the pipeline and is
+    # raised here.
+    queues = [queue.Queue(queue_size) for _ in range(len(stages) + 1)]
+    stop = threading.Event()
+    errors = []
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def items(q):
+        while not stop.is_set():
+            try:
+                item = q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _END:
+                # Leave the marker for the other workers of this stage
+                put(q, _END)
+                return
+            yield item
+
+    def guarded(fn):
+        def run(*args):
+            try:
+                fn(*args)
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+        return run
+
+    def produce():
+        for item in source:
+            if not put(queues[0], item):
+                return
+        put(queues[0], _END)
+
+    threads = [threading.Thread(target=guarded(produce), name='pipeline-source', daemon=True)]
+    for index, stage in enumerate(stages):
+        input_queue = queues[index]
+        output_queue = queues[index + 1]
+        remaining = [stage.workers]
+        lock = threading.Lock()
+
+        def work(stage=stage, input_queue=input_queue, output_queue=output_queue, remaining=remaining, lock=lock):
+            outputs = stage.fn(items(input_queue)) if stage.stream else (output for item in items(input_queue) for output in stage.fn(item))
+            for output in outputs:
+                if not put(output_queue, output):
+                    return
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last and not stop.is_set():
+                put(output_queue, _END)
+
+        for worker in range(stage.workers):
+            threads.append(threading.Thread(target=guarded(work), name='pipeline-'+stage.name+'-'+str(worker), daemon=True))
+
+    for thread in threads:
+        thread.start()
+    try:
+        for item in items(queues[-1]):
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if len(errors) > 0:
+        raise errors[0]
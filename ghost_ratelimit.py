@@ -0,0 +1,233 @@
+import re
+import time
+import random
+import logging
+import threading
+
+from contextlib import contextmanager
+from ghost_metrics import increment
+
+DEFAULT_RETRIES = 6
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 60.0
+
+# 409 is left out on purpose: Ghost uses it for update collisions, which need fresh data, not a retry
+RETRYABLE_STATUS = (408, 425, 429, 500, 502, 503, 504)
+
+_DURATION_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_DURATION_UNITS = {'ms': 0.001, 's': 1.0, 'm': 60.0, 'h': 3600.0}
+
+
+class TokenBucket:
+    # Allows `rate_per_minute` units per minute with bursts up to `capacity`.
+    # A rate of 0 disables the bucket.
+    def __init__(self, rate_per_minute, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate_per_minute) / 60.0
+        self.capacity = float(capacity if capacity is not None else max(1.0, self.rate))
+        self.available = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        # Blocks until `amount` units are available, then takes them. Requests larger
+        # than the bucket wait for a full bucket and drive it negative. A pause holds
+        # callers back even when the rate is 0.
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = self.clock()
+                wait = self.blocked_until - now
+                if wait <= 0 and self.rate <= 0:
+                    return waited
+                self._refill(now)
+                if wait <= 0:
+                    needed = min(amount, self.capacity)
+                    if self.available >= needed:
+                        self.available -= amount
+                        return waited
+                    wait = (needed - self.available) / self.rate
+            self.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds):
+        # Hold every caller back, e.g. until the server says the window resets
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, self.clock() + seconds)
+            self.available = min(self.available, 0.0)
+
+
+class RateLimiter:
+    # Requests per minute plus, for OpenAI, tokens per minute
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0, clock=time.monotonic, sleep=time.sleep):
+        self.requests = TokenBucket(requests_per_minute, clock=clock, sleep=sleep)
+        self.tokens = TokenBucket(tokens_per_minute, clock=clock, sleep=sleep)
+
+    def acquire(self, tokens=0):
+        self.requests.acquire(1)
+        if tokens > 0:
+            self.tokens.acquire(tokens)
+
+    def update_from_headers(self, headers):
+        # OpenAI reports what is left in the current window. When either budget is
+        # exhausted, hold everyone until that window resets instead of sending
+        # requests that will come back as 429s.
+        if headers is None:
+            return
+        for kind, bucket in (('requests', self.requests), ('tokens', self.tokens)):
+            remaining = headers.get('x-ratelimit-remaining-'+kind)
+            reset = parse_duration(headers.get('x-ratelimit-reset-'+kind))
+            if remaining is not None and reset is not None:
+                try:
+                    if float(remaining) <= 0:
+                        bucket.pause(reset)
+                except ValueError:
+                    pass
+
+
+class AdaptiveConcurrency:
+    # Caps the number of calls in flight. The cap halves on every rate limit response
+    # and grows back by one after `increase_after` successes in a row (AIMD).
+    def __init__(self, maximum, minimum=1, increase_after=10):
+        self.maximum = max(1, int(maximum))
+        self.minimum = max(1, min(int(minimum), self.maximum))
+        self.limit = self.maximum
+        self.increase_after = increase_after
+        self.active = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    def record_success(self):
+        with self.condition:
+            self.successes += 1
+            if self.successes >= self.increase_after and self.limit < self.maximum:
+                self.limit += 1
+                self.successes = 0
+                self.condition.notify_all()
+
+    def record_throttle(self):
+        with self.condition:
+            self.successes = 0
+            if self.limit > self.minimum:
+                self.limit = max(self.minimum, self.limit // 2)
+                logging.info("Rate limited, concurrency reduced to "+str(self.limit))
+
+
+def parse_duration(value):
+    # '20ms', '1.5s', '6m0s' -> seconds. Plain numbers are seconds.
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    matches = _DURATION_PATTERN.findall(value)
+    if len(matches) == 0:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in matches)
+
+
+def response_details(outcome):
+    # (status code, headers) from a requests/httpx response or from an exception
+    # carrying one (requests.HTTPError, openai.APIStatusError). Connection errors
+    # and timeouts have neither.
+    response = getattr(outcome, 'response', None) if isinstance(outcome, BaseException) else outcome
+    status = getattr(outcome, 'status_code', None)
+    if response is not None:
+        status = getattr(response, 'status_code', status)
+    headers = getattr(response, 'headers', None) if response is not None else None
+    return status, headers
+
+
+def is_retryable(outcome):
+    status, _ = response_details(outcome)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    if isinstance(outcome, BaseException):
+        # No response at all: connection reset, DNS hiccup, read timeout...
+        name = type(outcome).__name__
+        return 'Connection' in name or 'Timeout' in name
+    return False
+
+
+def retry_delay(outcome, attempt, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY):
+    # Server hints win: Retry-After, then the x-ratelimit reset of an exhausted budget.
+    # Otherwise exponential backoff with full jitter.
+    _, headers = response_details(outcome)
+    if headers is not None:
+        retry_after = parse_duration(headers.get('retry-after-ms'))
+        if retry_after is not None:
+            return min(max_delay, retry_after / 1000.0)
+        retry_after = parse_duration(headers.get('retry-after'))
+        if retry_after is not None:
+            return min(max_delay, retry_after)
+        for kind in ('requests', 'tokens'):
+            remaining = headers.get('x-ratelimit-remaining-'+kind)
+            reset = parse_duration(headers.get('x-ratelimit-reset-'+kind))
+            if remaining is not None and reset is not None and str(remaining) == '0':
+                return min(max_delay, reset)
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+def call_with_retry(fn, limiter=None, tokens=0, concurrency=None, retries=DEFAULT_RETRIES, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY, sleep=time.sleep):
+    # Call fn() under the rate limiter and retry rate limits, server errors and
+    # connection failures. fn may raise or return a response; a response with a
+    # retryable status is retried too and the last one is returned as is.
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire(tokens)
+        try:
+            if concurrency is not None:
+                with concurrency.slot():
+                    outcome = fn()
+            else:
+                outcome = fn()
+            failed = False
+        except Exception as e:
+            outcome = e
+            failed = True
+
+        status, headers = response_details(outcome)
+        if limiter is not None:
+            limiter.update_from_headers(headers)
+        if concurrency is not None:
+            if status == 429:
+                concurrency.record_throttle()
+            elif not failed and (status is None or status < 400):
+                concurrency.record_success()
+
+        if not is_retryable(outcome) or attempt >= retries:
+            if failed:
+                raise outcome
+            return outcome
+
+        delay = retry_delay(outcome, attempt, base_delay, max_delay)
+        increment('retries')
+        if status == 429:
+            increment('throttled')
+        logging.info("Retrying in "+str(round(delay, 2))+"s after "+(str(status) if status is not None else type(outcome).__name__))
+        if status == 429 and limiter is not None:
+            limiter.requests.pause(delay)
+        sleep(delay)
+        attempt += 1
@@ -1,234 +1,248 @@
 import os
 import sys
-import re
-import json
+import csv
 import requests # pip install requests
-import jwt	# pip install pyjwt
-import configparser
-import pandas as pd
-import numpy as np
-import openai
 import logging
 
-from datetime import datetime as date
-from openai import OpenAI
-from scipy.spatial.distance import cosine
-
-config = configparser.ConfigParser()
-config.read('./.env')
-key = ""
-try:
-    key = config['BASIC']['GHOST_ADMIN_API_KEY']
-except KeyError as e:
-    print("Not finding key in config. Try environment.")
-
-if len(key) == 0:
-    if 'GHOST_ADMIN_API_KEY' not in os.environ:
-        print("Missing GHOST_ADMIN_API_KEY. Please set the GHOST_ADMIN_API_KEY environment variable before running the script. You can find it by following instructions here: https://ghost.org/docs/admin-api/")
-        exit(0)
-    else:
-        key = os.environ.get('GHOST_ADMIN_API_KEY')
-
-print("GHOST_ADMIN_API_KEY ready")
-
-url = config['BASIC']['GHOST_SITE_URL']
-log_path = config['BASIC']['LOG_PATH']
-output_path = config['BASIC']['EMBEDDING_OUTPUT_PATH']
-max_related_count = int(config['BASIC']['MAX_RELATED_BLOG_COUNT'])
-
-
-if not os.path.exists(output_path):
-    os.makedirs(output_path)
-    print("Directory '{output_path}' created.")
-#else:
-#    print("Directory '{output_path}' already exists.")
-
-if not os.path.exists(log_path):
-    os.makedirs(log_path)
-    print("Directory '{log_path}' created.")
-#else:
-#    print("Directory '{log_path}' already exists.")
-
-# Configure logging
-logging.basicConfig(
-    filename=str(log_path)+'/relation_tags.log',
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s]: %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-)
-
-def getAllBlogIDs():
-    files = os.scandir(output_path)
-    blog_ids = []
-    for file in files:
-        if re.search('blog-([\d\w]*)-embedding.csv', file.name):
-            blog_id = re.search('blog-([\d\w]*)-embedding.csv', file.name).group(1)
-            blog_ids.append(blog_id)
-    return blog_ids
+from ghost_neighbours import NeighbourTable
+from ghost_ann import IVFIndex
+from ghost_embedding_store import openEmbeddingStore
+from ghost_journal import openRunJournal, resume_requested, WRITTEN
+from ghost_metrics import timer
+from ghost_tags import WriteSummary, with_related_tags, CHANGED, SKIPPED, FAILED
+from ghost_admin import DEFAULT_PAGE_SIZE, DEFAULT_FETCH_WORKERS
+from ghost_config import settings, admin_client, prepare_run
+
+config = settings()
+url = config['GHOST_SITE_URL']
+output_path = config['EMBEDDING_OUTPUT_PATH']
+max_related_count = int(config['MAX_RELATED_BLOG_COUNT'])
+page_size = config.get('GHOST_PAGE_SIZE', str(DEFAULT_PAGE_SIZE))
+fetch_workers = int(config.get('GHOST_FETCH_WORKERS', DEFAULT_FETCH_WORKERS))
+
+neighbour_table_path = output_path+"/neighbours.npz"
+
+# exact (default) or ivf, an approximate index for sites where an all-pairs run is too slow
+neighbour_search = config.get('NEIGHBOUR_SEARCH', 'exact').upper()
+ann_index_path = output_path+"/ann_index.npz"
+ann_lists = int(config.get('ANN_LISTS', 0))
+ann_nprobe = int(config.get('ANN_NPROBE', 0))
+
+# Set by main()
+embedding_store = None
+full_rebuild = False
+resume = False
 
 def readEmbedding():
-    df = pd.DataFrame({"blog_id":[],"title":[]})
-    blog_ids = getAllBlogIDs()
-
-    for blog_id in blog_ids:
-        embedding_file_path = output_path+"/blog-"+str(blog_id)+"-embedding.csv"
-        if os.path.exists(embedding_file_path):
-            print("found embedding for blog-"+str(blog_id))
-            blog_df = pd.read_csv(embedding_file_path)
-            blog_df['embedding'] = blog_df['embedding'].apply(np.array) #sanity checks, make sure it's an array of strings
-            blog_df['embedding'] = blog_df['embedding'].apply(eval) #sanity checks, make sure it's an array of strings
-            newdf = pd.DataFrame({"blog_id":str(blog_id),"title":blog_df['title'],"embedding":blog_df['embedding']})
-            df = pd.concat([df,newdf],ignore_index=True)
-        else:
-            logging.info("Missing embedding or blog_id for topic-"+str(blog_id))
-            print("Missing embedding or blog_id for topic-"+str(blog_id))
-    return df
-
-def ghost_update_internal_tags(url,blog_id,tags):
-    # Split the key into ID and SECRET
-    id, secret = key.split(':')
-
-    # Prepare header and payload
-    iat = int(date.now().timestamp())
-
-    header = {'alg': 'HS256', 'typ': 'JWT', 'kid': id}
-    payload = {
-        'iat': iat,
-        'exp': iat + 5 * 60,
-        'aud': '/admin/'
-    }
-
-    # Create the token (including decoding secret)
-    token = jwt.encode(payload, bytes.fromhex(secret), algorithm='HS256', headers=header)
-
-    # Make an authenticated request to create a post
-    geturl = url+'/ghost/api/admin/posts/'+blog_id
-    headers = {'Authorization': 'Ghost {}'.format(token)}
-
+    # One memory map for the whole corpus instead of a file per post
+    blog_ids, titles, matrix = embedding_store.load()
+    print(str(len(blog_ids))+" embeddings loaded")
+    return blog_ids, titles, matrix
+
+def cleanupMissingBlog(blog_id):
+    print("Clean up missing blog cache:")
+    logging.info("Clean up missing cache:")
+
+    if embedding_store.delete(blog_id):
+        print(f"Embedding for blog-{blog_id} successfully cleaned.")
+        logging.info(f"Embedding for blog-{blog_id} successfully cleaned.")
+
+    missing_embedding_file_path = output_path+"/blog-"+str(blog_id)+"-embedding.csv"
+    if os.path.isfile(missing_embedding_file_path):
+        try:
+            os.remove(missing_embedding_file_path)
+            print(f"Cache file '{missing_embedding_file_path}' successfully cleaned.")
+            logging.info(f"Cache file '{missing_embedding_file_path}' successfully cleaned.")
+        except OSError as e:
+            print("Error deleting cache file: {e}")
+
+    missing_relation_file_path = output_path+"/blog-"+str(blog_id)+"-relations.csv"
+    if os.path.isfile(missing_relation_file_path):
+        try:
+            os.remove(missing_relation_file_path)
+            print(f"Cache file '{missing_relation_file_path}' successfully cleaned.")
+            logging.info(f"Cache file '{missing_relation_file_path}' successfully cleaned.")
+        except OSError as e:
+            print("Error deleting cache file: {e}")
+
+def readRelatedIds(relation_file_path):
+    # Related ids from the last run, in rank order, or None if there is no previous run
+    if not os.path.exists(relation_file_path):
+        return None
     try:
-        r = requests.get(geturl, headers=headers)
-        r.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        logging.info("Get blog tag failed due to http error: " + str(e))
-        if e.response.status_code == 404:
-            print("Clean up missing blog cache:")
-            logging.info("Clean up missing cache:")
-
-            missing_embedding_file_path = output_path+"/blog-"+str(blog_id)+"-embedding.csv"
-            if os.path.isfile(missing_embedding_file_path):
-                try:
-                    os.remove(missing_embedding_file_path)
-                    print(f"Cache file '{missing_embedding_file_path}' successfully cleaned.")
-                    logging.info(f"Cache file '{missing_embedding_file_path}' successfully cleaned.")
-                except OSError as e:
-                    print("Error deleting cache file: {e}")
-
-            missing_relation_file_path = output_path+"/blog-"+str(blog_id)+"-relations.csv"
-            if os.path.isfile(missing_relation_file_path):
-                try:
-                    os.remove(missing_relation_file_path)
-                    print(f"Cache file '{missing_relation_file_path}' successfully cleaned.")
-                    logging.info(f"Cache file '{missing_relation_file_path}' successfully cleaned.")
-                except OSError as e:
-                    print("Error deleting cache file: {e}")
-        else:
-            logging.info(f"An HTTP error occurred: {e}")
-        return False
-    except Exception as e:
-        print("Get blog tag failed due to exception: " + str(e))
-        return False
-
-    #print(r.json()['posts'][0]['updated_at'])
-    updated_at = r.json()['posts'][0]['updated_at']
-    original_tags =r.json()['posts'][0]['tags']
-
-    # Make an authenticated request to edit an item
-    headers = {'Authorization': 'Ghost {}'.format(token)}
-    # DEBUG
-    editurl = url+'/ghost/api/admin/posts/'+blog_id+'/?formats=mobiledoc%2Clexical'
-
-
-    tag_dict_array = []
-    for original_tag in original_tags:
-        tag_dict = {'name':str(original_tag['name']),'slug':str(original_tag['slug'])}
-        if original_tag['name'][0] != '#':
-            tag_dict_array.append(tag_dict)
-
-    for tag in tags:
-        tag_dict = {'name':'#'+str(tag),'slug':str(tag)}
-        duplicate_tag = False
-        for original_tag in tag_dict_array:
-            if original_tag['name'] == '#'+str(tag):
-                duplicate_tag = True
-        if duplicate_tag == False:
-            tag_dict_array.append(tag_dict)
-
-    #print(tag_dict_array)
-
-    body = {
-        "posts":[
-            {
-                "tags":tag_dict_array,
-                "updated_at":updated_at
-            }
-        ]
-    }
+        with open(relation_file_path, newline='') as f:
+            return [row['blog_id'] for row in csv.DictReader(f)]
+    except Exception:
+        return None
+
+def writeRelations(relation_file_path, rows, related_ids, titles, related_scores):
+    # Same layout as the pandas CSVs of earlier versions: embedding row as the index,
+    # then blog_id, title and similarities
+    with open(relation_file_path, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['', 'blog_id', 'title', 'similarities'])
+        for row, related_id, title, score in zip(rows, related_ids, titles, related_scores):
+            writer.writerow([row, related_id, title, score])
+
+def fetchPostSnapshots():
+    # One projected listing gives every post's tags and updated_at, so tag writes
+    # do not need a GET per post. No GHOST_POST_FILTER here: a post missing from
+    # this listing is treated as deleted. Fetched on every run, so deletions are
+    # noticed even when no embedding changed.
+    try:
+        listing = admin_client().list_posts(page_size, fetch_workers, fields=['id', 'updated_at'], include=['tags'])
+    except requests.exceptions.RequestException as e:
+        logging.info("Failed to load blog list: "+str(e))
+        sys.exit('Failed to load blog list, please check ./.env to make sure all keys are set.')
+    return {post['id']: post for post in listing}
+
+def removeDeletedBlogs(snapshots):
+    # Blogs deleted in Ghost since their embedding was made. Dropping them from the
+    # store makes the neighbour table forget them and recompute the lists they were in.
+    deleted_ids = [blog_id for blog_id in embedding_store.ids() if blog_id not in snapshots]
+    for blog_id in deleted_ids:
+        print("blog-"+str(blog_id)+" no longer exists")
+        logging.info("blog-"+str(blog_id)+" no longer exists")
+        cleanupMissingBlog(blog_id)
+    return deleted_ids
+
+def ghost_update_internal_tags(url,blog_id,tags,post=None):
+    def build_tags(original_tags):
+        return with_related_tags(original_tags, tags)
 
     try:
-        r = requests.put(editurl, json=body, headers=headers)
-        r.raise_for_status()
+        if post is None:
+            post = admin_client().get_post(blog_id)
+        if admin_client().update_post_tags(post, build_tags) is None:
+            return SKIPPED
     except requests.exceptions.HTTPError as e:
         print("Update tag failed due to http error: " + str(e))
         if e.response.status_code == 404:
             logging.info("Error: Page not found (404)")
+            cleanupMissingBlog(blog_id)
         else:
             logging.info(f"An HTTP error occurred: {e}")
-        return False
+        return FAILED
     except Exception as e:
         print("Update tag failed due to exception: " + str(e))
-        return False
-
-    #print(r.json()['posts'][0]['tags'])
-    return True
+        return FAILED
+
+    return CHANGED
+
+def openAnnIndex(blog_ids, versions, matrix):
+    # Approximate search for full rebuilds on large sites. The index is kept between
+    # runs and retrained when it was trained on too few of the current posts.
+    if neighbour_search != "IVF":
+        return None
+    index = None
+    if not full_rebuild:
+        index = IVFIndex.load(ann_index_path)
+    if index is None or index.needs_retraining(len(blog_ids)) or (ann_lists > 0 and index.n_lists != ann_lists):
+        print("Training approximate index for "+str(len(blog_ids))+" blogs")
+        logging.info("Training approximate index for "+str(len(blog_ids))+" blogs")
+        index = IVFIndex.build(blog_ids, versions, matrix, ann_lists or None)
+    else:
+        assigned = index.attach(blog_ids, versions, matrix)
+        logging.info(str(assigned)+" blogs added to the approximate index")
+    index.save(ann_index_path)
+    return index
+
+def updateNeighbours(blog_ids, matrix):
+    # The saved neighbour table brought up to date with the embeddings, and the ids
+    # of the blogs whose related posts changed
+    versions = [embedding_store.version(blog_id) for blog_id in blog_ids]
+    table = None
+    if not full_rebuild:
+        table = NeighbourTable.load(neighbour_table_path)
+    if table is None or table.k != max_related_count:
+        print("Computing related posts for all "+str(len(blog_ids))+" blogs")
+        with timer('similarity'):
+            table = NeighbourTable.build(blog_ids, versions, matrix, max_related_count, index=openAnnIndex(blog_ids, versions, matrix), nprobe=ann_nprobe)
+        affected_ids = list(blog_ids)
+    else:
+        with timer('similarity'):
+            changed_ids = table.update(blog_ids, versions, matrix) | table.pending
+        affected_ids = [blog_id for blog_id in blog_ids if blog_id in changed_ids]
+        print(str(len(affected_ids))+" of "+str(len(blog_ids))+" blogs have new related posts")
+    logging.info(str(len(affected_ids))+" blogs have new related posts")
+    return table, affected_ids
+
+def openRelationJournal(table, affected_ids):
+    # The journal of this kind of run, and the affected blogs an interrupted run has
+    # not written yet
+    journal = openRunJournal(output_path, 'relation_tags', 'full' if full_rebuild else 'update', resume)
+    written = journal.completed(WRITTEN)
+    if len(written) > 0:
+        # Only skipped while the related posts are still the ones that were written
+        remaining_ids = [blog_id for blog_id in affected_ids if written.get(blog_id) != table.neighbours[blog_id][0]]
+        print(str(len(affected_ids) - len(remaining_ids))+" blogs were written by the interrupted run")
+        affected_ids = remaining_ids
+    return journal, affected_ids
+
+def saveRelations(blog_id, related_ids, related_scores, titles, position):
+    relation_file_path = output_path+"/blog-"+str(blog_id)+"-relations.csv"
+    if readRelatedIds(relation_file_path) != related_ids:
+        rows = [position[related_id] for related_id in related_ids]
+        writeRelations(relation_file_path, rows, related_ids, [titles[row] for row in rows], related_scores)
+        print("Generated relation for blog-"+str(blog_id)+" successful")
+        logging.info("Generated relation for blog-"+str(blog_id)+" successful")
 
 def setupRelationship():
-    total_df = readEmbedding()
-
-    files = os.scandir(output_path)
-
-    blog_ids = getAllBlogIDs()
-
-    for blog_id in blog_ids:
-        similar_df = total_df
-        embedding_file_path = output_path+"/blog-"+str(blog_id)+"-embedding.csv"
-        if os.path.exists(embedding_file_path):
-            #print("found embedding for blog-"+str(blog_id))
-            blog_df = pd.read_csv(embedding_file_path)
-            blog_df['embedding'] = blog_df['embedding'].apply(np.array) #sanity checks, make sure it's an array of strings
-            blog_df['embedding'] = blog_df['embedding'].apply(eval) #sanity checks, make sure it's an array of strings
-            blog_df = pd.DataFrame({"blog_id":str(blog_id),"title":blog_df['title'],"embedding":blog_df['embedding']})
-            similar_df["similarities"] = similar_df['embedding'].apply(lambda x: cosine(blog_df['embedding'][0], x))
-            #print(similar_df)
-            similar_df = similar_df.drop(similar_df[(similar_df.blog_id == str(blog_id))].index)
-            similar_df = similar_df.drop(columns=['embedding'])
-            top_results = similar_df.sort_values("similarities", ascending=False).head(max_related_count)
-            #top_title_list = top_results.loc[:, 'title'].tolist()
-            logging.info(top_results)
-            top_results.to_csv(output_path+"/blog-"+str(blog_id)+"-relations.csv")
-            print("Generated relation for blog-"+str(blog_id)+" successful")
-            logging.info("Generated relation for blog-"+str(blog_id)+" successful")
-            related_ids = top_results['blog_id'].tolist()
-            #print(related_ids)
-            if ghost_update_internal_tags(url,blog_id,related_ids):
-                print("Updated tags for blog-"+str(blog_id)+" successful")
-                logging.info("Updated tags for blog-"+str(blog_id)+" successful")
-            else:
-                #print("Failed to update tags. If this issue persists, please clean up output path and run the script again.")
-                logging.info("Failed to update tags. If this issue persists, please clean up output path and run the script again.")
+    snapshots = fetchPostSnapshots()
+    removeDeletedBlogs(snapshots)
+    blog_ids, titles, matrix = readEmbedding()
+    if len(blog_ids) == 0:
+        print("No embedding found in "+str(output_path))
+        return
+
+    table, affected_ids = updateNeighbours(blog_ids, matrix)
+    journal, affected_ids = openRelationJournal(table, affected_ids)
+    summary = WriteSummary()
+    position = {blog_id: row for row, blog_id in enumerate(blog_ids)}
+    failed_ids = set()
+
+    for blog_id in affected_ids:
+        related_ids, related_scores = table.neighbours[blog_id]
+        saveRelations(blog_id, related_ids, related_scores, titles, position)
+        result = summary.record(ghost_update_internal_tags(url,blog_id,related_ids,snapshots[blog_id]))
+        if result != FAILED:
+            journal.record(blog_id, WRITTEN, related_ids)
+        if result == CHANGED:
+            print("Updated tags for blog-"+str(blog_id)+" successful")
+            logging.info("Updated tags for blog-"+str(blog_id)+" successful")
+        elif result == SKIPPED:
+            logging.info("Tags for blog-"+str(blog_id)+" already up to date")
         else:
-            print("Missing embedding for blog-"+str(blog_id))
-            logging.info("Missing embedding for blog-"+str(blog_id))
-
-setupRelationship()
-
-
+            failed_ids.add(blog_id)
+            #print("Failed to update tags. If this issue persists, please clean up output path and run the script again.")
+            logging.info("Failed to update tags. If this issue persists, please clean up output path and run the script again.")
+
+    # Failed writes are retried on the next run even if nothing else changed
+    table.pending = failed_ids
+    table.save(neighbour_table_path)
+    summary.report()
+    if len(failed_ids) == 0:
+        journal.finish()
+
+def configure(arguments):
+    # Options of a run, without its logging; ghostai.py pipeline calls this directly
+    global embedding_store, full_rebuild, resume
+    embedding_store = openEmbeddingStore(output_path)
+
+    full_rebuild = "FULL" in arguments
+    if full_rebuild:
+        print("Recomputing related posts for all blogs")
+        logging.info("Recomputing related posts for all blogs")
+
+    # Pick up the last interrupted run of the same kind, skipping posts it already wrote
+    resume = resume_requested(arguments)
+
+def main(arguments=None):
+    arguments = [str(argument).upper() for argument in (sys.argv[1:] if arguments is None else arguments)]
+    prepare_run('relation_tags', 'relation_tags.log')
+    configure(arguments)
+    setupRelationship()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import numpy as np
+
+# Rows of the similarity matrix computed per matrix multiply. 1024 x 30k float32
+# is ~120MB, which keeps memory bounded on large sites.
+DEFAULT_BLOCK_SIZE = 1024
+
+
+def normalize_rows(matrix):
+    # Unit-length rows turn cosine similarity into a plain dot product
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k_rows(queries, corpus, k, exclude=None, block_size=DEFAULT_BLOCK_SIZE):
+    # queries and corpus must already be normalized.
+    # exclude[i] is the corpus row to leave out for query i (usually itself), or -1.
+    # Returns (indices, scores), each shaped (len(queries), k), best match first.
+    queries = np.atleast_2d(queries)
+    n_queries = queries.shape[0]
+    n_corpus = corpus.shape[0]
+    k = min(int(k), n_corpus - (1 if exclude is not None else 0))
+    if k <= 0 or n_queries == 0:
+        return np.empty((n_queries, 0), dtype=np.int64), np.empty((n_queries, 0), dtype=np.float32)
+
+    top_indices = np.empty((n_queries, k), dtype=np.int64)
+    top_scores = np.empty((n_queries, k), dtype=np.float32)
+
+    for start in range(0, n_queries, block_size):
+        stop = min(start + block_size, n_queries)
+        block = queries[start:stop] @ corpus.T
+        if exclude is not None:
+            rows = np.arange(stop - start)
+            cols = np.asarray(exclude[start:stop])
+            valid = cols >= 0
+            block[rows[valid], cols[valid]] = -np.inf
+
+        if k < n_corpus:
+            candidates = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        else:
+            candidates = np.tile(np.arange(n_corpus), (stop - start, 1))
+        candidate_scores = np.take_along_axis(block, candidates, axis=1)
+        order = np.argsort(-candidate_scores, axis=1, kind='stable')
+        top_indices[start:stop] = np.take_along_axis(candidates, order, axis=1)
+        top_scores[start:stop] = np.take_along_axis(candidate_scores, order, axis=1)
+
+    return top_indices, top_scores
+
+
+def top_k_similar(matrix, k, block_size=DEFAULT_BLOCK_SIZE):
+    # All-pairs top k for every row of matrix, never matching a row with itself
+    normalized = normalize_rows(matrix)
+    return top_k_rows(normalized, normalized, k, exclude=np.arange(normalized.shape[0]), block_size=block_size)
@@ -1,340 +1,380 @@
 import os
 import sys
-import re
-import json
 import requests # pip install requests
-import jwt	# pip install pyjwt
-import configparser
-import pandas as pd
-import numpy as np
-from openai import OpenAI
-
-
 import logging
 
-from datetime import datetime as date
-from openai import OpenAI
-
-
-config = configparser.ConfigParser()
-config.read('./.env')
-key = ""
-try:
-    key = config['BASIC']['GHOST_ADMIN_API_KEY']
-except KeyError as e:
-    print("Not finding key in config. Try environment.")
-
-if len(key) == 0:
-    if 'GHOST_ADMIN_API_KEY' not in os.environ:
-        print("Missing GHOST_ADMIN_API_KEY. Please set the GHOST_ADMIN_API_KEY environment variable before running the script. You can find it by following instructions here: https://ghost.org/docs/admin-api/")
-        exit(0)
-    else:
-        key = os.environ.get('GHOST_ADMIN_API_KEY')
-
-print("GHOST_ADMIN_API_KEY ready")
-openai_key = ""
-try:
-    openai_key = config['BASIC']['OPENAI_API_KEY']
-except KeyError as e:
-    print("Not finding key in config. Try environment.")
-
-if len(openai_key) == 0:
-    if 'OPENAI_API_KEY' not in os.environ:
-        print("Missing OPENAI_API_KEY. Please set the OPENAI_API_KEY environment variable before running the script. You can find it by following instructions here: https://platform.openai.com/account/api-keys")
-        exit(0)
-    else:
-        openai_key = os.environ.get('OPENAI_API_KEY')
-
-print("OPENAI_API_KEY ready")
-client = OpenAI(api_key=openai_key)
-
-url = config['BASIC']['GHOST_SITE_URL']
-log_path = config['BASIC']['LOG_PATH']
-output_path = config['BASIC']['EMBEDDING_OUTPUT_PATH']
-max_related_count = int(config['BASIC']['MAX_RELATED_BLOG_COUNT'])
-blog_tag_count = int(config['BASIC']['BLOG_TAG_COUNT'])
+from ghost_tags import WriteSummary, with_generated_tags, qualify_tags, batch_tag_prompt, parse_batch_tags, CHANGED, SKIPPED, FAILED
+from ghost_batching import estimate_tokens
+from ghost_ratelimit import RateLimiter, AdaptiveConcurrency, call_with_retry
+from ghost_pipeline import Stage, run_pipeline
+from ghost_admin import DEFAULT_PAGE_SIZE, DEFAULT_FETCH_WORKERS
+from ghost_text import extract_text, CONTENT_FORMATS
+from ghost_journal import openRunJournal, resume_requested, TAGGED, WRITTEN
+from ghost_metrics import timer, increment
+from ghost_config import settings, admin_client, openai_client, prepare_run
+
+DEFAULT_CHAT_REQUESTS_PER_MINUTE = 3500
+DEFAULT_CHAT_TOKENS_PER_MINUTE = 90000
+# Posts tagged per chat request, requests in flight, and characters of each post sent
+DEFAULT_TAG_BATCH_SIZE = 10
+DEFAULT_TAG_CONCURRENCY = 4
+DEFAULT_TAG_POST_CHARS = 2500
+DEFAULT_EXTRACTION_WORKERS = 2
+# Output budget: a tag with its quotes and comma, plus the JSON key and brackets per post
+TOKENS_PER_TAG = 8
+TOKENS_PER_POST = 16
+
+config = settings()
+url = config['GHOST_SITE_URL']
+output_path = config['EMBEDDING_OUTPUT_PATH']
+page_size = config.get('GHOST_PAGE_SIZE', str(DEFAULT_PAGE_SIZE))
+fetch_workers = int(config.get('GHOST_FETCH_WORKERS', DEFAULT_FETCH_WORKERS))
+post_filter = config.get('GHOST_POST_FILTER', None)
+
+blog_tag_count = int(config['BLOG_TAG_COUNT'])
+openai_limiter = RateLimiter(
+    int(config.get('OPENAI_CHAT_REQUESTS_PER_MINUTE', DEFAULT_CHAT_REQUESTS_PER_MINUTE)),
+    int(config.get('OPENAI_CHAT_TOKENS_PER_MINUTE', DEFAULT_CHAT_TOKENS_PER_MINUTE)))
+tag_batch_size = max(1, int(config.get('TAG_BATCH_SIZE', DEFAULT_TAG_BATCH_SIZE)))
+tag_concurrency = int(config.get('TAG_CONCURRENCY', DEFAULT_TAG_CONCURRENCY))
+tag_post_chars = int(config.get('TAG_POST_CHARS', DEFAULT_TAG_POST_CHARS))
+extraction_workers = int(config.get('EXTRACTION_WORKERS', DEFAULT_EXTRACTION_WORKERS))
+# Fewer requests in flight after a 429, back up to TAG_CONCURRENCY as they succeed
+openai_concurrency = AdaptiveConcurrency(tag_concurrency)
 
 prompt = "Please find "+str(blog_tag_count)+" tags of the following paragraphs, separated by commas, each tag with only one word. Paragraph:"
 prompt += '\n'
 
 #print("Prompt: " + prompt)
 
+# clusters (name clusters of the stored embeddings), ghost (the site's public tags)
+# or the path of a text file with one tag per line
+vocabulary_source = config.get('TAG_VOCABULARY_SOURCE', 'clusters')
+vocabulary_clusters = int(config.get('TAG_CLUSTERS', 0))
+# TAG_SCORE_MARGIN, read when the vocabulary is used; the default lives with the vocabulary
+vocabulary_margin = config.get('TAG_SCORE_MARGIN', '')
+vocabulary_path = output_path+"/tag_vocabulary.npz"
 
-if not os.path.exists(output_path):
-    os.makedirs(output_path)
-    print("Directory "+str(output_path)+" created.")
-#else:
-#    print("Directory "+str(output_path)+" already exists.")
-
-if not os.path.exists(log_path):
-    os.makedirs(log_path)
-    print("Directory "+str(log_path)+" created.")
-#else:
-#    print("Directory "+str(log_path)+" already exists.")
-
-# Configure logging
-logging.basicConfig(
-    filename=str(log_path)+'/tagging.log',
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s]: %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-)
-
+# Set by main()
 reset_all = False
-if len(sys.argv) > 1:
-    if str(sys.argv[1]).upper() == "RESET":
-        reset_all = True
-
-
-if reset_all:
-    print("Resetting all tags")
-    logging.info("Resetting all tags")
-else:
-    print("Generate tags for new blogs")
-    logging.info("Generate tags for new blogs")
-
-def fetchBlogPage(page):
-    # Split the key into ID and SECRET
-    id, secret = key.split(':')
-
-    # Prepare header and payload
-    iat = int(date.now().timestamp())
-
-    header = {'alg': 'HS256', 'typ': 'JWT', 'kid': id}
-    payload = {
-        'iat': iat,
-        'exp': iat + 5 * 60,
-        'aud': '/admin/'
-    }
-
-    # Create the token (including decoding secret)
-    token = jwt.encode(payload, bytes.fromhex(secret), algorithm='HS256', headers=header)
-
-    # Make an authenticated request to list all posts
-    headers = {'Authorization': 'Ghost {}'.format(token)}
-    geturl = url+'/ghost/api/admin/posts/?page='+str(page)
-
-    return requests.get(geturl, headers=headers)
+resume = False
+tag_mode = 'llm'
+rebuild_vocabulary = False
+journal = None
+written_ids = set()
+journaled_tags = {}
+# Ids of posts the model gave no tags for; the run stays resumable while there are any
+tagging_failures = []
+
+def chatCompletion(prompt, max_tokens, json_response=False):
+    # Reserve the prompt and the whole output budget against the tokens per minute limit
+    options = {'response_format': {"type": "json_object"}} if json_response else {}
+    with timer('chat_call'):
+        raw_response = call_with_retry(lambda: openai_client().chat.completions.with_raw_response.create(model="gpt-3.5-turbo",
+        messages=[
+          {"role": "user", "content": prompt},
+        ],
+        temperature=0.4,
+        max_tokens=max_tokens,
+        top_p=1,
+        frequency_penalty=0.2,
+        presence_penalty=1.6,
+        **options), openai_limiter, estimate_tokens(prompt) + max_tokens, openai_concurrency)
+        completion = raw_response.parse()
+    if completion.usage is not None:
+        increment('chat_prompt_tokens', completion.usage.prompt_tokens)
+        increment('chat_completion_tokens', completion.usage.completion_tokens)
+    return completion.choices[0].message.content
 
 def tagContent(prompt, content):
     prompt += content
     if len(prompt) > 10000:
         prompt = prompt[:10000]
 
-    completion = client.chat.completions.create(model="gpt-3.5-turbo",
-    messages=[
-      {"role": "user", "content": prompt},
-    ],
-    temperature=0.4,
-    max_tokens=1000,
-    top_p=1,
-    frequency_penalty=0.2,
-    presence_penalty=1.6)
-
-    result = completion.choices[0].message.content
+    result = chatCompletion(prompt, blog_tag_count * TOKENS_PER_TAG + TOKENS_PER_POST)
     result = result.lstrip()
     logging.info('Generate Tag Result:'+str(result))
-    #print(result)
-
 
     tags = result.replace("\n",",")
     tags = tags.split(",")
-    #print(tags)
-
-    qualified_tags = []
-    for tag in tags:
-        tag_words = tag.lstrip()
-        if len(tag_words) > 0:
-            wordscount = tag_words.split(" ")
-            if len(wordscount) <= 2:
-                qualified_tags.append(tag_words.upper())
-
-
-    #print(qualified_tags)
-
-    #final_tags = ', '.join(qualified_tags)
-    #print(final_tags)
-    return qualified_tags
-
-def ghost_update_public_tags(site_url,blog_id,tags):
-
-    # Split the key into ID and SECRET
-    id, secret = key.split(':')
-
-    # Prepare header and payload
-    iat = int(date.now().timestamp())
+    return qualify_tags(tags)
 
-    header = {'alg': 'HS256', 'typ': 'JWT', 'kid': id}
-    payload = {
-        'iat': iat,
-        'exp': iat + 5 * 60,
-        'aud': '/admin/'
-    }
-
-    # Create the token (including decoding secret)
-    token = jwt.encode(payload, bytes.fromhex(secret), algorithm='HS256', headers=header)
-
-    # Make an authenticated request to create a post
-    geturl = site_url+'/ghost/api/admin/posts/'+blog_id
-    headers = {'Authorization': 'Ghost {}'.format(token)}
-
-    try:
-        r = requests.get(geturl, headers=headers)
-        r.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        # catastrophic error. bail.
-        raise SystemExit(e)
-
-    #print(r.json()['posts'][0]['updated_at'])
-    updated_at = r.json()['posts'][0]['updated_at']
-    original_tags =r.json()['posts'][0]['tags']
-
-    # Make an authenticated request to edit an item
-    headers = {'Authorization': 'Ghost {}'.format(token)}
-    editurl = site_url+'/ghost/api/admin/posts/'+blog_id+'/?formats=mobiledoc%2Clexical'
-
-
-    tag_dict_array = []
-
-    for original_tag in original_tags:
-        tag_dict = {'name':str(original_tag['name']),'slug':str(original_tag['slug'])}
-        if original_tag['name'][0] == '#':
-            tag_dict_array.append(tag_dict)
-
-    for original_tag in original_tags:
-        tag_dict = {'name':str(original_tag['name']),'slug':str(original_tag['slug'])}
-        if original_tag['name'][0] != '#':
-            logging.info("Find existing tags:"+original_tag['name'])
-            if reset_all:
-                logging.info('over ride new tags')
-            else:
-                tag_dict_array.append(tag_dict)
-
-    for tag in tags:
-        tag_dict = {'name':str(tag),'slug':str(tag)}
-        duplicate_tag = False
-        for original_tag in tag_dict_array:
-            if original_tag['name'] == str(tag):
-                logging.info("Find duplicated tags:"+original_tag['name'])
-                duplicate_tag = True
-        if duplicate_tag == False:
-            tag_dict_array.append(tag_dict)
-
-
-    logging.info('Updated tags:'+str(tag_dict_array)) 
-
-    body = {
-        "posts":[
-            {
-                "tags":tag_dict_array,
-                "updated_at":updated_at
-            }
-        ]
-    }
+def tagContents(contents):
+    # Tags for several posts in one request, {index in contents: tags}. Posts the
+    # answer leaves out or garbles are missing from the result.
+    prompt = batch_tag_prompt([content[:tag_post_chars] for content in contents], blog_tag_count)
+    result = chatCompletion(prompt, len(contents) * (blog_tag_count * TOKENS_PER_TAG + TOKENS_PER_POST), json_response=True)
+    logging.info('Generate Tag Result:'+str(result))
+    return {number - 1: tags for number, tags in parse_batch_tags(result, len(contents)).items()}
+
+def logTaggingFailure(item, e):
+    print('Blog failed to convert due to error:')
+    print(e)
+    print('ID:'+item['id']+'\nTitle'+str(item['post']['title']))
+    logging.info('Blog failed to tag due to error:')
+    logging.info(e)
+    logging.info('ID:'+item['id']+'\nTitle'+str(item['post']['title']))
+    logging.info('Post content:'+str(item['text'][:1000]))
+
+def tagBatch(batch):
+    # Returns [(item, tags)] for the posts that got tags. Posts with tags from an
+    # interrupted run keep them; the rest go out as one request, and posts missing
+    # from its answer are tagged one by one. New tags are journaled before they are
+    # written, so a crash in between does not pay for them again.
+    results = {index: item['tags'] for index, item in enumerate(batch) if 'tags' in item}
+    untagged = [index for index in range(len(batch)) if index not in results]
+    if len(untagged) > 1:
+        answer = {}
+        try:
+            answer = tagContents([batch[index]['text'] for index in untagged])
+        except Exception as e:
+            print("Batch of "+str(len(untagged))+" posts failed to tag, tagging them one by one: "+str(e))
+            logging.info("Batch of "+str(len(untagged))+" posts failed to tag, tagging them one by one: "+str(e))
+        if len(answer) < len(untagged):
+            logging.info(str(len(untagged) - len(answer))+" of "+str(len(untagged))+" posts missing from the batch answer")
+        for number, tags in answer.items():
+            results[untagged[number]] = tags
+    for index in untagged:
+        item = batch[index]
+        if index not in results:
+            try:
+                results[index] = tagContent(prompt, item['text'])
+            except Exception as e:
+                logTaggingFailure(item, e)
+                tagging_failures.append(item['id'])
+                continue
+        journal.record(item['id'], TAGGED, results[index])
+    return [(batch[index], results[index]) for index in sorted(results)]
+
+def ghost_update_public_tags(site_url,blog_id,tags,post=None):
+    if post is None:
+        try:
+            post = admin_client().get_post(blog_id)
+        except requests.exceptions.RequestException as e:
+            print("Get blog tags failed due to request: " + str(e))
+            logging.info("Get blog tags failed due to request: " + str(e))
+            return FAILED
+
+    def build_tags(original_tags):
+        return with_generated_tags(original_tags, tags, reset_all)
 
     try:
-        r = requests.put(editurl, json=body, headers=headers)
-        r.raise_for_status()
+        if admin_client().update_post_tags(post, build_tags) is None:
+            return SKIPPED
     except requests.exceptions.RequestException as e:
         print("Update tag failed due to request: " + str(e))
-        return False
+        return FAILED
     except Exception as e:
         print("Update tag failed: " + str(e))
+        return FAILED
+    return CHANGED
+
+def saveGeneratedTags(post, qualified_tags, tagging_file_path, summary):
+    id = post['id']
+    print("blog-"+str(id)+" tags generated: "+str(', '.join(qualified_tags)))
+    logging.info("blog-"+str(id)+" tags generated")
+
+    result = summary.record(ghost_update_public_tags(url,id,qualified_tags,post))
+    if result == FAILED:
+        print("Updated blog id:"+post['id']+" tags failed.")
+        logging.info("Updated blog id:"+post['id']+" tags failed.")
         return False
-    #print(r.json()['posts'][0]['tags'])
+    recordGeneratedTags(id, qualified_tags, tagging_file_path)
     return True
 
-def generateAndUpdateTagsForAllBlogs():
-    response = fetchBlogPage(1)
+def recordGeneratedTags(id, qualified_tags, tagging_file_path):
+    # After the tags are on the post: the tag file marks it done for later runs
+    print("Updated blog id:"+id+" tags, tags recorded in "+tagging_file_path)
+    logging.info("Updated blog id:"+id+" tags, tags recorded in "+tagging_file_path)
+    f = open(tagging_file_path, "w")
+    f.write(str(', '.join(qualified_tags)))
+    f.close()
+    journal.record(id, WRITTEN)
+
+def tagsWritten(id, tagging_file_path):
+    # Written by this run before it was interrupted, or by an earlier run unless resetting
+    return id in written_ids or (not reset_all and os.path.exists(tagging_file_path))
+
+def labelCluster(titles):
+    # One chat call names a whole cluster of posts
+    cluster_prompt = "The following blog posts share one topic. Give one tag for that topic, with only one word. Answer with the tag only.\n"
+    cluster_prompt += ''.join("- "+str(title)+"\n" for title in titles)
+    result = chatCompletion(cluster_prompt, TOKENS_PER_TAG + TOKENS_PER_POST)
+    qualified_tags = qualify_tags(result.replace("\n", ",").split(","))
+    logging.info("Cluster of "+str(titles[:3])+" labelled "+str(qualified_tags))
+    return qualified_tags[0] if len(qualified_tags) > 0 else None
+
+def vocabularyNames():
+    if vocabulary_source.lower() == 'ghost':
+        return [tag['name'] for tag in admin_client().list_tags(fields=['name'], filter='visibility:public')]
+    with open(vocabulary_source) as f:
+        return [line.strip() for line in f if len(line.strip()) > 0]
+
+def openTagVocabulary(model, titles, matrix):
+    from ghost_tag_vocabulary import TagVocabulary
+    from ghost_embedding_backends import backend_for_model
+    # Built once and kept in the output directory; rebuilt on request or when the
+    # embeddings were made by another model
+    vocabulary = None if rebuild_vocabulary else TagVocabulary.load(vocabulary_path)
+    if vocabulary is not None and vocabulary.model == model:
+        return vocabulary
+    if vocabulary_source.lower() == 'clusters':
+        print("Naming clusters of "+str(len(titles))+" blogs")
+        vocabulary = TagVocabulary.from_clusters(matrix, titles, labelCluster, vocabulary_clusters or None, model)
+    else:
+        names = vocabularyNames()
+        print("Embedding "+str(len(names))+" tags from "+vocabulary_source)
+        backend = backend_for_model(model, openai_client)
+        vocabulary = TagVocabulary.from_names(names, backend.embed, model)
+    vocabulary.save(vocabulary_path)
+    print("Tag vocabulary: "+', '.join(vocabulary.names))
+    logging.info("Tag vocabulary: "+', '.join(vocabulary.names))
+    return vocabulary
+
+def vocabularyTags():
+    # {blog id: tags} for every stored embedding, and the vocabulary they came from
+    # numpy and the embedding store are only needed in this mode
+    from ghost_embedding_store import openEmbeddingStore
+    from ghost_tag_vocabulary import DEFAULT_SCORE_MARGIN
+    margin = float(vocabulary_margin) if len(vocabulary_margin) > 0 else DEFAULT_SCORE_MARGIN
+    store = openEmbeddingStore(output_path)
+    blog_ids, titles, matrix = store.load()
+    if len(blog_ids) == 0:
+        sys.exit("No embedding found in "+str(output_path)+", run ghost_embeddings.py first.")
+    model = store.get(blog_ids[0]).get('model', 'text-embedding-ada-002')
+    vocabulary = openTagVocabulary(model, titles, matrix)
+    with timer('similarity'):
+        assigned = dict(zip(blog_ids, vocabulary.assign(matrix, blog_tag_count, margin)))
+    return assigned, vocabulary
+
+def assignTagsFromVocabulary():
+    assigned, vocabulary = vocabularyTags()
 
-    if int(response.status_code) != 200:
+    try:
+        listing = admin_client().list_posts(page_size, fetch_workers, fields=['id', 'title', 'updated_at'], include=['tags'], filter=post_filter)
+    except requests.exceptions.RequestException as e:
+        logging.info("Failed to load blog list: "+str(e))
         sys.exit('Failed to load blog list, please check ./.env to make sure all keys are set.')
 
-    total_page = int(response.json()['meta']['pagination']['pages'])
-    total_blog = int(response.json()['meta']['pagination']['total'])
-    print(str(total_page)+' pages to load')
-    print(str(total_blog)+' blogs to load')
+    count = 0
+    summary = WriteSummary()
+    for post in listing:
+        id = post['id']
+        tagging_file_path = output_path+"/blog-"+str(id)+"-tags.txt"
+        if tagsWritten(id, tagging_file_path):
+            continue
+        if id not in assigned or len(assigned[id]) == 0:
+            print("blog-"+str(id)+" has no embedding yet, run ghost_embeddings.py first.")
+            continue
+        if saveGeneratedTags(post, assigned[id], tagging_file_path, summary):
+            count += 1
+    print("Total "+str(count)+" blog tagged from "+str(len(vocabulary))+" vocabulary tags.")
+    logging.info("Total "+str(count)+" blog tagged from "+str(len(vocabulary))+" vocabulary tags.")
+    summary.report()
+    if summary.counts[FAILED] == 0:
+        journal.finish()
+
+def prepareTagging(post):
+    # [item] with the post's text when it needs tags, otherwise []
+    id = post['id']
+    tagging_file_path = output_path+"/blog-"+str(id)+"-tags.txt"
+    if id in written_ids:
+        return []
+    if id in journaled_tags:
+        return [{'id': id, 'post': post, 'tags': journaled_tags[id], 'tagging_file_path': tagging_file_path}]
+    if not reset_all and os.path.exists(tagging_file_path):
+        print("blog-"+str(id)+" tags existed")
+        return []
+    if reset_all and os.path.exists(tagging_file_path):
+        print("Blog id:"+post['id']+" tags existed but require reset.")
+        logging.info("Blog id:"+post['id']+" tags existed but require reset.")
+
+    try:
+        with timer('extraction'):
+            postContent = extract_text(post)
+    except Exception as e:
+        print('Blog failed to convert due to error:')
+        print(e)
+        print('ID:'+id+'\nTitle'+str(post['title']))
+        logging.info('Blog failed to tag due to error:')
+        logging.info(e)
+        logging.info('ID:'+id+'\nTitle'+str(post['title']))
+        return []
+    return [{'id': id, 'post': post, 'text': postContent, 'tagging_file_path': tagging_file_path}]
+
+def groupTaggingItems(items):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= tag_batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+def generateAndUpdateTagsForAllBlogs():
+    try:
+        listing = admin_client().list_posts(page_size, fetch_workers, fields=['id', 'title', 'updated_at'] + list(CONTENT_FORMATS), formats=CONTENT_FORMATS, include=['tags'], filter=post_filter)
+    except requests.exceptions.RequestException as e:
+        logging.info("Failed to load blog list: "+str(e))
+        sys.exit('Failed to load blog list, please check ./.env to make sure all keys are set.')
+
+    print(str(listing.pages)+' pages to load')
+    print(str(listing.total)+' blogs to load')
 
     count = 0
-    for page in range(1,total_page+1):
-        response = fetchBlogPage(page).json()
-        posts = response['posts']
-        for post in posts:
-            postContent = ""
-            id = post['id']
-            tagging_file_path = output_path+"/blog-"+str(id)+"-tags.txt"
-            needs_tagging = False
-            if reset_all or not os.path.exists(tagging_file_path):
-                needs_tagging = True
-
-            if reset_all and os.path.exists(tagging_file_path):
-                print("Blog id:"+post['id']+" tags existed but require reset.")
-                logging.info("Blog id:"+post['id']+" tags existed but require reset.")
-
-            if needs_tagging:
-                title = post['title']
-                mobiledoc = json.loads(post['mobiledoc'])
-                cards = mobiledoc['cards']
-                for card in cards:
-                    if card[0] == 'toggle':
-                        headContent = card[1]['heading']
-                        headContent = headContent.replace('<p>','')
-                        headContent = headContent.replace('</p>','\n')
-                        content = card[1]['content']
-                        content = content.replace('<p>','')
-                        content = content.replace('</p>','\n')
-                        postContent = postContent + headContent + '\n' + content + '\n'
-                    elif card[0] == 'html':
-                        htmlString = card[1]['html']
-                        postContent = postContent + htmlString + '\n'
-
-                sections = mobiledoc['sections']
-                for section in sections:
-                    if int(section[0]) == 1:
-                        paragraph = list(section[2])
-                        if len(paragraph) > 0:
-                            if len(paragraph[0]) > 3:
-                                postContent = postContent + str(paragraph[0][3])
-
-                try:
-                    qualified_tags = tagContent(prompt, postContent)
-                except Exception as e:
-                    try:
-                        qualified_tags = tagContent(prompt, postContent)
-                    except Exception as e:
-                        print('Blog failed to convert due to error:')
-                        print(e)
-                        print('ID:'+id+'\nTitle'+title)
-                        print('Post content:'+str(postContent))
-                        print('Original mobiledoc:'+str(mobiledoc))
-                        print('Original cards:'+str(cards))
-                        logging.info('Blog failed to tag due to error:')
-                        logging.info(e)
-                        logging.info('ID:'+id+'\nTitle'+title)
-                        logging.info('Post content:'+str(postContent))
-                        logging.info('Original mobiledoc:'+str(mobiledoc))
-                        logging.info('Original cards:'+str(cards))
-                        continue
-
-                print("blog-"+str(id)+" tags generated: "+str(', '.join(qualified_tags)))
-                logging.info("blog-"+str(id)+" tags generated")
-                logging.info('Tagging content:'+str(postContent))
-
-                if ghost_update_public_tags(url,id,qualified_tags):
-                    print("Updated blog id:"+post['id']+" tags, tags recorded in "+tagging_file_path)
-                    logging.info("Updated blog id:"+post['id']+" tags, tags recorded in "+tagging_file_path)
-                    f = open(tagging_file_path, "w")
-                    f.write(str(', '.join(qualified_tags)))
-                    f.close()
-                    count += 1
-                else:
-                    print("Updated blog id:"+post['id']+" tags failed.")
-                    logging.info("Updated blog id:"+post['id']+" tags failed.")
-
-            else:
-                print("blog-"+str(id)+" tags existed")
+    summary = WriteSummary()
+    # listing -> select and extract -> batch -> tag (concurrent requests) -> write (here)
+    stages = [
+        Stage('extract', prepareTagging, extraction_workers),
+        Stage('batch', groupTaggingItems, stream=True),
+        Stage('tag', tagBatch, tag_concurrency),
+    ]
+    for item, qualified_tags in run_pipeline(listing, stages):
+        if saveGeneratedTags(item['post'], qualified_tags, item['tagging_file_path'], summary):
+            count += 1
+
     print("Total "+str(count)+" blog tagged.")
     logging.info("Total "+str(count)+" blog tagged.")
+    summary.report()
+    if summary.counts[FAILED] == 0 and len(tagging_failures) == 0:
+        journal.finish()
+
+
+def configure(arguments):
+    # Read the options and open the journal; shared with ghostai.py pipeline
+    global reset_all, resume, tag_mode, rebuild_vocabulary, journal, written_ids, journaled_tags
+    reset_all = "RESET" in arguments
+    # Pick up the last interrupted run of the same kind: posts it wrote are skipped and
+    # tags the model already gave it are not asked for again
+    resume = resume_requested(arguments)
+    # llm asks the chat model for tags for every post; vocabulary assigns tags from a fixed
+    # set by embedding similarity, with model calls only to name the set
+    tag_mode = 'vocabulary' if 'VOCABULARY' in arguments else config.get('TAG_MODE', 'llm').lower()
+    rebuild_vocabulary = 'REBUILD' in arguments
+
+    if reset_all:
+        print("Resetting all tags")
+        logging.info("Resetting all tags")
+    else:
+        print("Generate tags for new blogs")
+        logging.info("Generate tags for new blogs")
+
+    journal = openRunJournal(output_path, 'tag_blogs', tag_mode+(' reset' if reset_all else ''), resume)
+    written_ids = set(journal.completed(WRITTEN))
+    journaled_tags = journal.completed(TAGGED)
+
+def main(arguments=None):
+    arguments = [str(argument).upper() for argument in (sys.argv[1:] if arguments is None else arguments)]
+    admin_client()
+    prepare_run('tag_blogs', 'tagging.log')
+    configure(arguments)
+
+    if tag_mode == 'vocabulary':
+        assignTagsFromVocabulary()
+    else:
+        generateAndUpdateTagsForAllBlogs()
 
 
-generateAndUpdateTagsForAllBlogs()
+if __name__ == '__main__':
+    main()
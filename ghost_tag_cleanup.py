@@ -1,144 +1,36 @@
 import os
 import sys
-import re
-import json
 import requests # pip install requests
-import jwt	# pip install pyjwt
-import configparser
-import pandas as pd
-import numpy as np
 import logging
 
-from datetime import datetime as date
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ghost_tags import WriteSummary, tags_equal, CHANGED, SKIPPED, FAILED
+from ghost_admin import DEFAULT_PAGE_SIZE, DEFAULT_FETCH_WORKERS
+from ghost_journal import openRunJournal, WRITTEN
+from ghost_config import settings, admin_client, prepare_run
 
+DEFAULT_CLEANUP_WORKERS = 8
 
-config = configparser.ConfigParser()
-config.read('./.env')
-key = ""
 
-try:
-    key = config['BASIC']['GHOST_ADMIN_API_KEY']
-except KeyError as e:
-    print("Not finding key in config. Try environment.")
+config = settings()
+url = config['GHOST_SITE_URL']
+output_path = config['EMBEDDING_OUTPUT_PATH']
+page_size = config.get('GHOST_PAGE_SIZE', str(DEFAULT_PAGE_SIZE))
+fetch_workers = int(config.get('GHOST_FETCH_WORKERS', DEFAULT_FETCH_WORKERS))
+post_filter = config.get('GHOST_POST_FILTER', None)
 
-if len(key) == 0:
-    if 'GHOST_ADMIN_API_KEY' not in os.environ:
-        print("Missing GHOST_ADMIN_API_KEY. Please set the GHOST_ADMIN_API_KEY environment variable before running the script. You can find it by following instructions here: https://ghost.org/docs/admin-api/")
-        exit(0)
-    else:
-        key = os.environ.get('GHOST_ADMIN_API_KEY')
-
-print("GHOST_ADMIN_API_KEY ready")
-
-
-url = config['BASIC']['GHOST_SITE_URL']
-log_path = config['BASIC']['LOG_PATH']
-output_path = config['BASIC']['EMBEDDING_OUTPUT_PATH']
-max_related_count = int(config['BASIC']['MAX_RELATED_BLOG_COUNT'])
-
-if not os.path.exists(output_path):
-    os.makedirs(output_path)
-    print("Directory "+str(output_path)+" created.")
-#else:
-#    print("Directory "+str(output_path)+" already exists.")
-
-if not os.path.exists(log_path):
-    os.makedirs(log_path)
-    print("Directory "+str(log_path)+" created.")
-#else:
-#    print("Directory "+str(log_path)+" already exists.")
-
-# Configure logging
-logging.basicConfig(
-    filename=str(log_path)+'/tagging.log',
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s]: %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-)
+cleanup_workers = int(config.get('CLEANUP_WORKERS', DEFAULT_CLEANUP_WORKERS))
 
+# Set from the command line by main()
 clean_internal = False
 clean_public = False
-if len(sys.argv) > 1:
-    if str(sys.argv[1]).upper() == "BOTH":
-        print('Clean up both public and internal tags')
-        logging.info('Clean up both public and internal tags')
-        clean_internal = True
-        clean_public = True
-    elif str(sys.argv[1]).upper() == "INTERNAL":
-        clean_internal = True
-        print('Clean up internal tags')
-        logging.info('Clean up internal tags')
-    elif str(sys.argv[1]).upper() == "PUBLIC":
-        clean_public = True
-        print('Clean up public tags')
-        logging.info('Clean up public tags')
-
-if not clean_public and not clean_internal:
-    print('Please choose at least one clean up type: both / internal / public')
-    sys.exit()
-
-def fetchBlogPage(page):
-    # Split the key into ID and SECRET
-    id, secret = key.split(':')
-
-    # Prepare header and payload
-    iat = int(date.now().timestamp())
-
-    header = {'alg': 'HS256', 'typ': 'JWT', 'kid': id}
-    payload = {
-        'iat': iat,
-        'exp': iat + 5 * 60,
-        'aud': '/admin/'
-    }
-
-    # Create the token (including decoding secret)
-    token = jwt.encode(payload, bytes.fromhex(secret), algorithm='HS256', headers=header)
-
-    # Make an authenticated request to list all posts
-    headers = {'Authorization': 'Ghost {}'.format(token)}
-    geturl = url+'/ghost/api/admin/posts/?page='+str(page)
-
-    return requests.get(geturl, headers=headers)
-
-
-def ghost_cleanup_tags(site_url,blog_id):
-
-    # Split the key into ID and SECRET
-    id, secret = key.split(':')
-
-    # Prepare header and payload
-    iat = int(date.now().timestamp())
-
-    header = {'alg': 'HS256', 'typ': 'JWT', 'kid': id}
-    payload = {
-        'iat': iat,
-        'exp': iat + 5 * 60,
-        'aud': '/admin/'
-    }
-
-    # Create the token (including decoding secret)
-    token = jwt.encode(payload, bytes.fromhex(secret), algorithm='HS256', headers=header)
-
-    # Make an authenticated request to create a post
-    geturl = site_url+'/ghost/api/admin/posts/'+blog_id
-    headers = {'Authorization': 'Ghost {}'.format(token)}
-
-    try:
-        r = requests.get(geturl, headers=headers)
-        r.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        # catastrophic error. bail.
-        raise SystemExit(e)
-
-    #print(r.json()['posts'][0]['updated_at'])
-    updated_at = r.json()['posts'][0]['updated_at']
-    original_tags =r.json()['posts'][0]['tags']
-
-    # Make an authenticated request to edit an item
-    headers = {'Authorization': 'Ghost {}'.format(token)}
-    editurl = site_url+'/ghost/api/admin/posts/'+blog_id+'/?formats=mobiledoc%2Clexical'
-
+# Also delete tags of the cleaned kind that no post uses any more
+delete_orphans = False
+# Posts finished by an interrupted run are skipped unless asked to start over
+restart = False
+cleanup_mode = None
 
+def cleanedTags(original_tags):
     tag_dict_array = []
 
     if not clean_internal:
@@ -153,53 +45,155 @@ def ghost_cleanup_tags(site_url,blog_id):
             if original_tag['name'][0] != '#':
                 tag_dict_array.append(tag_dict)
 
-    logging.info('Updated tags:'+str(tag_dict_array))
+    return tag_dict_array
 
-    body = {
-        "posts":[
-            {
-                "tags":tag_dict_array,
-                "updated_at":updated_at
-            }
-        ]
-    }
+def ghost_cleanup_tags(site_url,blog_id,post=None):
+    if post is None:
+        try:
+            post = admin_client().get_post(blog_id)
+        except requests.exceptions.RequestException as e:
+            print("Get blog tags failed due to request: " + str(e))
+            logging.info("Get blog tags failed due to request: " + str(e))
+            return FAILED
 
     try:
-        r = requests.put(editurl, json=body, headers=headers)
-        r.raise_for_status()
+        if admin_client().update_post_tags(post, cleanedTags) is None:
+            return SKIPPED
     except requests.exceptions.RequestException as e:
         print("Update tag failed due to request: " + str(e))
-        return False
+        return FAILED
     except Exception as e:
         print("Update tag failed: " + str(e))
-        return False
-    #print(r.json()['posts'][0]['tags'])
-    return True
-
-response = fetchBlogPage(1)
-
-if int(response.status_code) != 200:
-    sys.exit('Failed to load blog list, please check ./.env to make sure all keys are set.')
-
-total_page = int(response.json()['meta']['pagination']['pages'])
-total_blog = int(response.json()['meta']['pagination']['total'])
-print(str(total_page)+' pages to load')
-print(str(total_blog)+' blogs to load')
-
-count = 0
-for page in range(1,total_page+1):
-    response = fetchBlogPage(page).json()
-    posts = response['posts']
-    for post in posts:
+        return FAILED
+    return CHANGED
+
+def planCleanup(listing, done, summary):
+    # One pass over the projected listing: only posts that carry tags of the cleaned
+    # kind need a write
+    plan = []
+    for post in listing:
         id = post['id']
-        ghost_cleanup_tags(url,id)
         tagging_file_path = output_path+"/blog-"+str(id)+"-tags.txt"
         if clean_public and os.path.exists(tagging_file_path):
             os.remove(tagging_file_path)
             logging.info("Also deleted existing tag file for blog-"+str(id)+".")
-        print("Blog-"+str(id)+"cleaned up")
+        if id in done:
+            continue
+        original_tags = post.get('tags') or []
+        if tags_equal(original_tags, cleanedTags(original_tags)):
+            summary.record(SKIPPED)
+            logging.info("Blog-"+str(id)+" has no tags to clean up")
+            continue
+        plan.append(post)
+    return plan
+
+def executeCleanup(plan, summary, journal):
+    # Writes run on a bounded pool; each one is journaled as it finishes so an
+    # interrupted run can pick up where it stopped
+    count = 0
+    with ThreadPoolExecutor(max_workers=cleanup_workers) as executor:
+        futures = {executor.submit(ghost_cleanup_tags, url, post['id'], post): post['id'] for post in plan}
+        for future in as_completed(futures):
+            id = futures[future]
+            result = summary.record(future.result())
+            if result != FAILED:
+                journal.record(id, WRITTEN)
+            if result == CHANGED:
+                count += 1
+                print("Blog-"+str(id)+" cleaned up")
+            elif result == FAILED:
+                print("Blog-"+str(id)+" failed to clean up, it will be retried on the next run")
+                logging.info("Blog-"+str(id)+" failed to clean up")
+    return count
+
+def deleteOrphanTags():
+    # Tags of the cleaned kind that no post uses after the cleanup
+    visibility = None if clean_public and clean_internal else ('visibility:public' if clean_public else 'visibility:internal')
+    try:
+        tags = admin_client().list_tags(include=['count.posts'], filter=visibility)
+    except requests.exceptions.RequestException as e:
+        print("Failed to load tags: "+str(e))
+        logging.info("Failed to load tags: "+str(e))
+        return
+    orphans = [tag for tag in tags if (tag.get('count') or {}).get('posts', 0) == 0]
+    print(str(len(orphans))+" of "+str(len(tags))+" tags are no longer used by any post")
+
+    summary = WriteSummary('tag_deletes')
+    with ThreadPoolExecutor(max_workers=cleanup_workers) as executor:
+        futures = {executor.submit(admin_client().delete_tag, tag['id']): tag for tag in orphans}
+        for future in as_completed(futures):
+            tag = futures[future]
+            try:
+                future.result()
+                summary.record(CHANGED)
+                logging.info("Deleted tag "+str(tag['name']))
+            except requests.exceptions.RequestException as e:
+                summary.record(FAILED)
+                print("Delete tag "+str(tag['name'])+" failed: "+str(e))
+                logging.info("Delete tag "+str(tag['name'])+" failed: "+str(e))
+    summary.report('Tag deletes')
+
+def cleanupAllBlogs():
+    try:
+        listing = admin_client().list_posts(page_size, fetch_workers, fields=['id', 'updated_at'], include=['tags'], filter=post_filter)
+    except requests.exceptions.RequestException as e:
+        logging.info("Failed to load blog list: "+str(e))
+        sys.exit('Failed to load blog list, please check ./.env to make sure all keys are set.')
+
+    print(str(listing.pages)+' pages to load')
+    print(str(listing.total)+' blogs to load')
+
+    summary = WriteSummary()
+    journal = openRunJournal(output_path, 'cleanup', cleanup_mode, resume=not restart)
+    done = set(journal.completed(WRITTEN))
+    plan = planCleanup(listing, done, summary)
+    print(str(len(plan))+" of "+str(listing.total)+" blogs have tags to clean up")
+    logging.info(str(len(plan))+" of "+str(listing.total)+" blogs have tags to clean up")
+    count = executeCleanup(plan, summary, journal)
+
+    print("Total "+str(count)+" blog tag cleaned up.")
+    logging.info("Total "+str(count)+" blog tag cleaned up.")
+    summary.report()
+
+    if summary.counts[FAILED] == 0:
+        journal.finish()
+        if delete_orphans:
+            deleteOrphanTags()
+    elif delete_orphans:
+        print("Not deleting unused tags until every blog is cleaned up")
+
+def main(arguments=None):
+    global clean_internal, clean_public, delete_orphans, restart, cleanup_mode
+    arguments = [str(argument).upper() for argument in (sys.argv[1:] if arguments is None else arguments)]
+    prepare_run('cleanup', 'tagging.log')
+
+    kind = arguments[0] if len(arguments) > 0 else ''
+    if kind == "BOTH":
+        print('Clean up both public and internal tags')
+        logging.info('Clean up both public and internal tags')
+        clean_internal = True
+        clean_public = True
+    elif kind == "INTERNAL":
+        clean_internal = True
+        print('Clean up internal tags')
+        logging.info('Clean up internal tags')
+    elif kind == "PUBLIC":
+        clean_public = True
+        print('Clean up public tags')
+        logging.info('Clean up public tags')
+
+    if not clean_public and not clean_internal:
+        print('Please choose at least one clean up type: both / internal / public')
+        sys.exit()
 
+    options = arguments[1:]
+    delete_orphans = "ORPHANS" in options
+    restart = "RESTART" in options
+    cleanup_mode = 'both' if clean_public and clean_internal else ('public' if clean_public else 'internal')
+    # Writes run cleanup_workers at a time, so the connection pool has to hold that many
+    admin_client(max(16, cleanup_workers))
+    cleanupAllBlogs()
 
-print("Total "+str(count)+" blog tag cleaned up.")
-logging.info("Total "+str(count)+" blog tagged.")
 
+if __name__ == '__main__':
+    main()
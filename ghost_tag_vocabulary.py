@@ -0,0 +1,87 @@
+import os
+import numpy as np
+
+from ghost_similarity import normalize_rows, top_k_rows
+from ghost_ann import train_centroids
+
+# Posts shown to the model when naming a cluster: the ones closest to its centroid
+LABEL_SAMPLE_POSTS = 12
+# A post gets tags scoring within this much of its best tag, up to the tag count
+DEFAULT_SCORE_MARGIN = 0.05
+
+
+def default_cluster_count(n):
+    return max(2, min(200, int(np.sqrt(n))))
+
+
+class TagVocabulary:
+    # A fixed set of public tags, each with a unit vector in the same space as the
+    # post embeddings. Posts are tagged by similarity to those vectors, so tagging
+    # needs no model call per post.
+    #   names:     tag names
+    #   centroids: (tags, dim) unit vectors
+    #   model:     embedding model the vectors belong to
+    def __init__(self, names, centroids, model=None):
+        self.names = list(names)
+        self.centroids = normalize_rows(centroids) if len(self.names) > 0 else np.empty((0, 0), dtype=np.float32)
+        self.model = model
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_clusters(cls, matrix, titles, label_cluster, n_clusters=None, model=None, seed=0):
+        # k-means over the post embeddings, then one label_cluster(titles) call per
+        # cluster to name it from the titles of its most central posts. Clusters that
+        # get the same name are merged.
+        normalized = normalize_rows(matrix)
+        n_clusters = n_clusters or default_cluster_count(normalized.shape[0])
+        centroids = train_centroids(normalized, n_clusters, seed=seed)
+        assignment, _ = top_k_rows(normalized, centroids, 1)
+        assignment = assignment[:, 0]
+
+        merged = {}
+        for cluster in range(centroids.shape[0]):
+            members = np.nonzero(assignment == cluster)[0]
+            if len(members) == 0:
+                continue
+            central = members[np.argsort(-(normalized[members] @ centroids[cluster]))[:LABEL_SAMPLE_POSTS]]
+            name = label_cluster([titles[row] for row in central])
+            if not name:
+                continue
+            merged[name] = merged.get(name, 0) + centroids[cluster] * len(members)
+        names = list(merged.keys())
+        return cls(names, np.asarray([merged[name] for name in names], dtype=np.float32), model)
+
+    @classmethod
+    def from_names(cls, names, embed, model=None):
+        # An existing tag list: each tag's vector is the embedding of its name
+        names = list(dict.fromkeys(name for name in names if name))
+        if len(names) == 0:
+            return cls([], [], model)
+        return cls(names, np.asarray(embed(names), dtype=np.float32), model)
+
+    def assign(self, matrix, count, margin=DEFAULT_SCORE_MARGIN):
+        # Tags for every row of matrix in one matrix multiply: up to `count` tags
+        # scoring within `margin` of the row's best tag, best first
+        if len(self.names) == 0 or matrix.shape[0] == 0:
+            return [[] for _ in range(matrix.shape[0])]
+        indices, scores = top_k_rows(normalize_rows(matrix), self.centroids, count)
+        keep = scores >= scores[:, :1] - margin
+        return [[self.names[i] for i in row_indices[row_keep]] for row_indices, row_keep in zip(indices, keep)]
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return None
+        data = np.load(path)
+        model = str(data['model']) if str(data['model']) else None
+        return cls([str(name) for name in data['names']], data['centroids'], model)
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, names=np.array(self.names, dtype=str), centroids=self.centroids, model=np.array(self.model or ''))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
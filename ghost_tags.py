@@ -0,0 +1,143 @@
+import json
+import logging
+
+from ghost_metrics import increment
+
+CHANGED = 'changed'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+def tag_names(tags):
+    return [str(tag['name']) for tag in tags]
+
+
+def tags_equal(current_tags, desired_tags):
+    # Ghost only cares about which tags a post has and which public tag comes first
+    # (the primary tag). Reordering the rest, e.g. when related post scores shift,
+    # is not worth a write. Names are compared case-insensitively like Ghost does.
+    current = [name.lower() for name in tag_names(current_tags)]
+    desired = [name.lower() for name in tag_names(desired_tags)]
+    return primary_tag(current) == primary_tag(desired) and set(current) == set(desired)
+
+
+def primary_tag(names):
+    for name in names:
+        if not name.startswith('#'):
+            return name
+    return None
+
+
+def with_related_tags(original_tags, related_ids):
+    # The post's public tags, then one internal tag per related post. Internal tags
+    # from an earlier run are replaced.
+    tag_dict_array = []
+    for original_tag in original_tags:
+        tag_dict = {'name':str(original_tag['name']),'slug':str(original_tag['slug'])}
+        if original_tag['name'][0] != '#':
+            tag_dict_array.append(tag_dict)
+
+    for tag in related_ids:
+        tag_dict = {'name':'#'+str(tag),'slug':str(tag)}
+        duplicate_tag = False
+        for original_tag in tag_dict_array:
+            if original_tag['name'] == '#'+str(tag):
+                duplicate_tag = True
+        if duplicate_tag == False:
+            tag_dict_array.append(tag_dict)
+    return tag_dict_array
+
+
+def with_generated_tags(original_tags, tags, replace_public=False):
+    # The post's internal tags, its public tags unless replace_public, then the
+    # generated tags it does not have yet
+    tag_dict_array = []
+
+    for original_tag in original_tags:
+        tag_dict = {'name':str(original_tag['name']),'slug':str(original_tag['slug'])}
+        if original_tag['name'][0] == '#':
+            tag_dict_array.append(tag_dict)
+
+    for original_tag in original_tags:
+        tag_dict = {'name':str(original_tag['name']),'slug':str(original_tag['slug'])}
+        if original_tag['name'][0] != '#':
+            logging.info("Find existing tags:"+original_tag['name'])
+            if replace_public:
+                logging.info('over ride new tags')
+            else:
+                tag_dict_array.append(tag_dict)
+
+    for tag in tags:
+        tag_dict = {'name':str(tag),'slug':str(tag)}
+        duplicate_tag = False
+        for original_tag in tag_dict_array:
+            if original_tag['name'] == str(tag):
+                logging.info("Find duplicated tags:"+original_tag['name'])
+                duplicate_tag = True
+        if duplicate_tag == False:
+            tag_dict_array.append(tag_dict)
+
+    logging.info('Updated tags:'+str(tag_dict_array))
+    return tag_dict_array
+
+
+class WriteSummary:
+    # Counts what happened to each planned tag write, also as '<metric>_<result>'
+    # run metrics
+    def __init__(self, metric='tag_writes'):
+        self.counts = {CHANGED: 0, SKIPPED: 0, FAILED: 0}
+        self.metric = metric
+
+    def record(self, result):
+        self.counts[result] += 1
+        increment(self.metric+'_'+result)
+        return result
+
+    def report(self, label='Tag writes'):
+        message = label+": "+str(self.counts[CHANGED])+" changed, "+str(self.counts[SKIPPED])+" skipped (already up to date), "+str(self.counts[FAILED])+" failed."
+        print(message)
+        logging.info(message)
+        return message
+
+
+def qualify_tags(tags):
+    # Generated tags worth keeping: one or two words, upper case
+    qualified_tags = []
+    for tag in tags:
+        tag_words = str(tag).strip()
+        if len(tag_words) > 0 and len(tag_words.split(" ")) <= 2:
+            qualified_tags.append(tag_words.upper())
+    return qualified_tags
+
+
+def batch_tag_prompt(texts, tag_count):
+    # One prompt for several posts. Posts are numbered from 1 and the answer is a
+    # JSON object keyed by those numbers, which survive the round trip better than
+    # Ghost's 24 character ids.
+    parts = ["Please find "+str(tag_count)+" tags for each of the following posts, each tag with only one word. "
+        "Answer with a JSON object that maps each post number to its list of tags, like {\"1\": [\"tag\", ...], \"2\": [...]}.\n"]
+    for number, text in enumerate(texts, 1):
+        parts.append("\nPost "+str(number)+":\n"+text+"\n")
+    return ''.join(parts)
+
+
+def parse_batch_tags(content, count):
+    # {post number: qualified tags} for every post in 1..count with a usable answer.
+    # Posts that are missing or malformed are left out, so the caller can retry them.
+    try:
+        answer = json.loads(content)
+    except ValueError:
+        return {}
+    if not isinstance(answer, dict):
+        return {}
+    results = {}
+    for number in range(1, count + 1):
+        tags = answer.get(str(number))
+        if isinstance(tags, str):
+            tags = tags.replace("\n", ",").split(",")
+        if not isinstance(tags, list):
+            continue
+        qualified_tags = qualify_tags(tag for tag in tags if isinstance(tag, str))
+        if len(qualified_tags) > 0:
+            results[number] = qualified_tags
+    return results
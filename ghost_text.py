@@ -0,0 +1,174 @@
+import re
+import json
+
+from html import unescape
+
+# Post formats requested from the Admin API for text extraction. Ghost 5 stores a
+# post in either mobiledoc or lexical and leaves the other one null.
+CONTENT_FORMATS = ('mobiledoc', 'lexical')
+
+# Block level HTML tags end a line, everything else is dropped in place
+_BLOCK_TAGS = frozenset(['p', 'div', 'br', 'hr', 'li', 'ul', 'ol', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'blockquote', 'pre', 'figure', 'figcaption', 'table', 'tr', 'section', 'article', 'header', 'footer', 'aside'])
+_CELL_TAGS = frozenset(['td', 'th'])
+
+# One pass over the markup: comments, script/style elements with their contents, or a tag
+_HTML_TOKEN = re.compile(r'<!--.*?-->|<(script|style)\b[^>]*>.*?</\1\s*>|<(/?)([a-zA-Z][a-zA-Z0-9-]*)[^>]*>', re.S | re.I)
+
+# Card payload fields holding HTML and plain text. Mobiledoc and lexical use the
+# same names for most cards; lexical calls the code card 'codeblock'.
+_CARD_HTML_FIELDS = {
+    'html': ('html',),
+    'toggle': ('heading', 'content'),
+    'callout': ('calloutText',),
+    'image': ('caption',),
+    'gallery': ('caption',),
+    'video': ('caption',),
+    'embed': ('caption',),
+    'bookmark': ('caption',),
+}
+_CARD_TEXT_FIELDS = {
+    'markdown': ('markdown',),
+    'code': ('code',),
+    'codeblock': ('code',),
+    'image': ('alt',),
+    'bookmark': ('metadata.title', 'metadata.description'),
+}
+
+# Lexical nodes that flow inside a line; any other node with children ends one
+_LEXICAL_INLINE = frozenset(['text', 'extended-text', 'link', 'autolink', 'hashtag', 'tab', 'linebreak'])
+
+
+def _replace_tag(match):
+    name = match.group(3)
+    if name is None:
+        return ' '
+    name = name.lower()
+    if name in _BLOCK_TAGS:
+        return '\n'
+    if name in _CELL_TAGS:
+        return ' '
+    return ''
+
+
+def html_to_text(html):
+    # Strip tags and comments, drop script/style, decode entities. Whitespace is
+    # left for normalize_text.
+    if not html:
+        return ''
+    text = _HTML_TOKEN.sub(_replace_tag, html)
+    if '&' in text:
+        text = unescape(text)
+    return text
+
+
+def normalize_text(text):
+    # Collapse runs of whitespace, drop empty lines and a line repeating the one before
+    lines = []
+    previous = None
+    for line in text.split('\n'):
+        line = ' '.join(line.split())
+        if len(line) > 0 and line != previous:
+            lines.append(line)
+            previous = line
+    return '\n'.join(lines)
+
+
+def _payload_value(payload, field):
+    value = payload
+    for key in field.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value if isinstance(value, str) else None
+
+
+def _card_text(name, payload, out):
+    if not isinstance(payload, dict):
+        return
+    for field in _CARD_HTML_FIELDS.get(name, ()):
+        value = _payload_value(payload, field)
+        if value:
+            out.append(html_to_text(value))
+    for field in _CARD_TEXT_FIELDS.get(name, ()):
+        value = _payload_value(payload, field)
+        if value:
+            out.append(value)
+
+
+def _mobiledoc_markers(markers, atoms, out):
+    # Marker: [type, opened markups, closed markup count, value]. Type 0 is text,
+    # type 1 points at an atom whose second field is its text.
+    for marker in markers:
+        if len(marker) < 4:
+            continue
+        if marker[0] == 1:
+            if 0 <= marker[3] < len(atoms):
+                out.append(str(atoms[marker[3]][1]))
+        else:
+            out.append(str(marker[3]))
+
+
+def mobiledoc_text(mobiledoc, out):
+    cards = mobiledoc.get('cards', [])
+    atoms = mobiledoc.get('atoms', [])
+    for section in mobiledoc.get('sections', []):
+        kind = section[0]
+        if kind == 1:
+            _mobiledoc_markers(section[2], atoms, out)
+        elif kind == 3:
+            for item in section[2]:
+                _mobiledoc_markers(item, atoms, out)
+                out.append('\n')
+        elif kind == 10:
+            if 0 <= section[1] < len(cards):
+                card = cards[section[1]]
+                _card_text(card[0], card[1] if len(card) > 1 else None, out)
+        out.append('\n')
+
+
+def lexical_text(lexical, out):
+    stack = [(lexical.get('root', {}), False)]
+    while len(stack) > 0:
+        node, closing = stack.pop()
+        if closing:
+            out.append('\n')
+            continue
+        kind = node.get('type')
+        if 'text' in node and kind in ('text', 'extended-text'):
+            out.append(node['text'])
+        elif kind == 'linebreak':
+            out.append('\n')
+        elif kind == 'tab':
+            out.append(' ')
+        children = node.get('children')
+        if children:
+            if kind not in _LEXICAL_INLINE:
+                stack.append((node, True))
+            stack.extend((child, False) for child in reversed(children))
+        elif kind not in _LEXICAL_INLINE and kind not in ('paragraph', 'heading', 'quote', 'list', 'listitem', 'root'):
+            _card_text(kind, node, out)
+            out.append('\n')
+
+
+def _document(value):
+    # The Admin API returns mobiledoc and lexical as JSON strings
+    if isinstance(value, str):
+        return json.loads(value)
+    return value
+
+
+def extract_text(post):
+    # Plain text of a post: title, then the body from its mobiledoc or lexical
+    # document, or from its HTML when neither is present. Raises ValueError when the
+    # post has no body at all or its document is not valid JSON.
+    out = [str(post.get('title') or ''), '\n']
+    if post.get('mobiledoc'):
+        mobiledoc_text(_document(post['mobiledoc']), out)
+    elif post.get('lexical'):
+        lexical_text(_document(post['lexical']), out)
+    elif post.get('html'):
+        out.append(html_to_text(post['html']))
+    else:
+        raise ValueError("Post has no mobiledoc, lexical or html content")
+    return normalize_text(''.join(out))
@@ -0,0 +1,254 @@
+import sys
+import argparse
+import requests # pip install requests
+import logging
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ghost_tags import WriteSummary, with_related_tags, with_generated_tags, CHANGED, SKIPPED, FAILED
+from ghost_admin import DEFAULT_PAGE_SIZE, DEFAULT_FETCH_WORKERS
+from ghost_pipeline import Stage, run_pipeline
+from ghost_journal import WRITTEN
+from ghost_text import CONTENT_FORMATS
+from ghost_config import settings, admin_client, prepare_run
+
+# One command for the four scripts, plus a pipeline that runs embed, relate and tag
+# over a single listing of the site and writes each post's tags in one request:
+#
+#   python ghostai.py embed [--concurrency N] [--resume]
+#   python ghostai.py relate [--full] [--resume]
+#   python ghostai.py tag [--reset] [--vocabulary [--rebuild]] [--resume]
+#   python ghostai.py cleanup {both,internal,public} [--orphans] [--restart]
+#   python ghostai.py pipeline [--full] [--reset] [--vocabulary [--rebuild]] [--concurrency N] [--resume]
+#
+# The scripts are imported by the command that uses them, since each one reads its
+# own settings from .env when it is imported.
+DEFAULT_WRITE_WORKERS = 8
+# tagContent never sends more of a post than this, so the pipeline keeps no more of
+# its text while the embeddings are made
+TAG_TEXT_CHARS = 10000
+
+config = settings()
+page_size = config.get('GHOST_PAGE_SIZE', str(DEFAULT_PAGE_SIZE))
+fetch_workers = int(config.get('GHOST_FETCH_WORKERS', DEFAULT_FETCH_WORKERS))
+post_filter = config.get('GHOST_POST_FILTER', None)
+write_workers = int(config.get('WRITE_WORKERS', DEFAULT_WRITE_WORKERS))
+
+
+def scriptArguments(options, *names):
+    # The command line options as the scripts' own arguments, e.g. FULL, RESUME
+    arguments = []
+    for name in names:
+        value = getattr(options, name)
+        if name == 'concurrency':
+            if value is not None:
+                arguments += ['--concurrency', str(value)]
+        elif value:
+            arguments.append(name.upper())
+    return arguments
+
+def embed(options):
+    import ghost_embeddings
+    ghost_embeddings.main(scriptArguments(options, 'concurrency', 'resume'))
+
+def relate(options):
+    import ghost_relation_tags
+    ghost_relation_tags.main(scriptArguments(options, 'full', 'resume'))
+
+def tag(options):
+    import ghost_tag_blogs
+    ghost_tag_blogs.main(scriptArguments(options, 'reset', 'vocabulary', 'rebuild', 'resume'))
+
+def cleanup(options):
+    import ghost_tag_cleanup
+    ghost_tag_cleanup.main([options.kind] + scriptArguments(options, 'orphans', 'restart'))
+
+def writePostTags(post, related_ids, generated_tags, replace_public, missing_ids):
+    # Related posts and generated tags go out in the same request. Either may be None.
+    def build_tags(original_tags):
+        tags = original_tags
+        if related_ids is not None:
+            tags = with_related_tags(tags, related_ids)
+        if generated_tags is not None:
+            tags = with_generated_tags(tags, generated_tags, replace_public)
+        return tags
+
+    try:
+        if admin_client().update_post_tags(post, build_tags) is None:
+            return SKIPPED
+    except requests.exceptions.HTTPError as e:
+        print("Update tag failed due to http error: " + str(e))
+        logging.info(f"An HTTP error occurred: {e}")
+        if e.response is not None and e.response.status_code == 404:
+            missing_ids.add(post['id'])
+        return FAILED
+    except Exception as e:
+        print("Update tag failed due to exception: " + str(e))
+        return FAILED
+    return CHANGED
+
+def pipeline(options):
+    import ghost_embeddings
+    import ghost_relation_tags
+    import ghost_tag_blogs
+
+    # Writes run write_workers at a time, so the connection pool has to hold that many
+    admin_client(max(16, write_workers))
+    prepare_run('pipeline', 'pipeline.log')
+    ghost_embeddings.configure(scriptArguments(options, 'concurrency', 'resume'))
+    ghost_tag_blogs.configure(scriptArguments(options, 'reset', 'vocabulary', 'rebuild', 'resume'))
+    llm_tags = ghost_tag_blogs.tag_mode != 'vocabulary'
+
+    try:
+        listing = admin_client().list_posts(page_size, fetch_workers, fields=['id', 'title', 'updated_at'] + list(CONTENT_FORMATS), formats=CONTENT_FORMATS, include=['tags'], filter=post_filter)
+    except requests.exceptions.RequestException as e:
+        logging.info("Failed to load blog list: "+str(e))
+        sys.exit('Failed to load blog list, please check ./.env to make sure all keys are set.')
+
+    print(str(listing.pages)+' pages to load')
+    print(str(listing.total)+' blogs to load')
+
+    # Only what the later steps need is kept of each post: the snapshot for its tag
+    # write and, for posts that need tags, the start of its text
+    snapshots = {}
+    tag_items = []
+
+    def visit(post):
+        snapshot = {'id': post['id'], 'title': post['title'], 'updated_at': post['updated_at'], 'tags': post.get('tags') or []}
+        snapshots[post['id']] = snapshot
+        if llm_tags:
+            for item in ghost_tag_blogs.prepareTagging(post):
+                item['post'] = snapshot
+                if 'text' in item:
+                    item['text'] = item['text'][:TAG_TEXT_CHARS]
+                tag_items.append(item)
+
+    # listing -> embed, picking out the posts to tag on the way
+    ghost_embeddings.embedPosts(listing, visit)
+
+    # {blog id: (tags, tagging file path)}
+    generated = {}
+    if llm_tags:
+        print(str(len(tag_items))+" blogs to tag")
+        stages = [
+            Stage('batch', ghost_tag_blogs.groupTaggingItems, stream=True),
+            Stage('tag', ghost_tag_blogs.tagBatch, ghost_tag_blogs.tag_concurrency),
+        ]
+        for item, qualified_tags in run_pipeline(tag_items, stages):
+            generated[item['id']] = (qualified_tags, item['tagging_file_path'])
+    tag_items = None
+
+    if not llm_tags:
+        assigned, vocabulary = ghost_tag_blogs.vocabularyTags()
+        for id in snapshots:
+            tagging_file_path = ghost_tag_blogs.output_path+"/blog-"+str(id)+"-tags.txt"
+            if len(assigned.get(id) or []) > 0 and not ghost_tag_blogs.tagsWritten(id, tagging_file_path):
+                generated[id] = (assigned[id], tagging_file_path)
+        print(str(len(generated))+" blogs to tag from "+str(len(vocabulary))+" vocabulary tags")
+
+    # The store is opened after embedding so it sees this run's embeddings. Without a
+    # filter the listing has every post. Otherwise deletions, and the related posts of
+    # posts outside the filter, need a listing of all posts.
+    ghost_relation_tags.configure(scriptArguments(options, 'full', 'resume'))
+    all_snapshots = snapshots if post_filter is None else ghost_relation_tags.fetchPostSnapshots()
+    ghost_relation_tags.removeDeletedBlogs(all_snapshots)
+    blog_ids, titles, matrix = ghost_relation_tags.readEmbedding()
+    table = None
+    # {blog id: related ids}
+    related = {}
+    if len(blog_ids) > 0:
+        table, affected_ids = ghost_relation_tags.updateNeighbours(blog_ids, matrix)
+        relation_journal, affected_ids = ghost_relation_tags.openRelationJournal(table, affected_ids)
+        position = {blog_id: row for row, blog_id in enumerate(blog_ids)}
+        for blog_id in affected_ids:
+            related_ids, related_scores = table.neighbours[blog_id]
+            ghost_relation_tags.saveRelations(blog_id, related_ids, related_scores, titles, position)
+            related[blog_id] = related_ids
+
+    write_ids = list(related) + [id for id in generated if id not in related]
+    print(str(len(write_ids))+" blogs to write: "+str(len(related))+" with new related posts, "+str(len(generated))+" with new tags")
+    logging.info(str(len(write_ids))+" blogs to write: "+str(len(related))+" with new related posts, "+str(len(generated))+" with new tags")
+
+    count = 0
+    summary = WriteSummary()
+    failed_ids = set()
+    missing_ids = set()
+    with ThreadPoolExecutor(max_workers=write_workers) as executor:
+        futures = {executor.submit(writePostTags, snapshots.get(id) or all_snapshots[id], related.get(id), generated[id][0] if id in generated else None, ghost_tag_blogs.reset_all, missing_ids): id for id in write_ids}
+        for future in as_completed(futures):
+            id = futures[future]
+            result = summary.record(future.result())
+            if result == FAILED:
+                failed_ids.add(id)
+                print("Blog-"+str(id)+" failed to update tags, it will be retried on the next run")
+                logging.info("Blog-"+str(id)+" failed to update tags")
+                continue
+            if id in related:
+                relation_journal.record(id, WRITTEN, related[id])
+            if id in generated:
+                ghost_tag_blogs.recordGeneratedTags(id, generated[id][0], generated[id][1])
+            if result == CHANGED:
+                count += 1
+
+    for id in missing_ids:
+        ghost_relation_tags.cleanupMissingBlog(id)
+
+    print("Total "+str(count)+" blog tags updated.")
+    logging.info("Total "+str(count)+" blog tags updated.")
+    summary.report()
+    if table is not None:
+        # Failed writes are retried on the next run even if nothing else changed
+        table.pending = failed_ids & set(related)
+        table.save(ghost_relation_tags.neighbour_table_path)
+        if len(table.pending) == 0:
+            relation_journal.finish()
+    if len(failed_ids & set(generated)) == 0 and len(ghost_tag_blogs.tagging_failures) == 0:
+        ghost_tag_blogs.journal.finish()
+
+COMMANDS = {
+    'embed': embed,
+    'relate': relate,
+    'tag': tag,
+    'cleanup': cleanup,
+    'pipeline': pipeline,
+}
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(prog='ghostai', description='Related posts and tags for a Ghost site.')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    resume_help = 'pick up the last interrupted run of the same kind'
+    command = commands.add_parser('embed', help='embed new and changed posts')
+    command.add_argument('--concurrency', type=int, help='embedding requests in flight')
+    command.add_argument('--resume', action='store_true', help=resume_help)
+
+    command = commands.add_parser('relate', help='tag each post with its related posts')
+    command.add_argument('--full', action='store_true', help='recompute related posts for all posts')
+    command.add_argument('--resume', action='store_true', help=resume_help)
+
+    command = commands.add_parser('tag', help='generate public tags')
+    command.add_argument('--reset', action='store_true', help='replace the public tags of every post')
+    command.add_argument('--vocabulary', action='store_true', help='assign tags from a fixed vocabulary')
+    command.add_argument('--rebuild', action='store_true', help='rebuild the tag vocabulary')
+    command.add_argument('--resume', action='store_true', help=resume_help)
+
+    command = commands.add_parser('cleanup', help='remove generated tags')
+    command.add_argument('kind', choices=['both', 'internal', 'public'])
+    command.add_argument('--orphans', action='store_true', help='also delete tags no post uses any more')
+    command.add_argument('--restart', action='store_true', help='start over instead of resuming')
+
+    command = commands.add_parser('pipeline', help='embed, relate and tag from one listing, one tag write per post')
+    command.add_argument('--full', action='store_true', help='recompute related posts for all posts')
+    command.add_argument('--reset', action='store_true', help='replace the public tags of every post')
+    command.add_argument('--vocabulary', action='store_true', help='assign tags from a fixed vocabulary')
+    command.add_argument('--rebuild', action='store_true', help='rebuild the tag vocabulary')
+    command.add_argument('--concurrency', type=int, help='embedding requests in flight')
+    command.add_argument('--resume', action='store_true', help=resume_help)
+
+    options = parser.parse_args(arguments)
+    COMMANDS[options.command](options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import json
+import time
+import threading
+
+import pytest
+import requests
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from ghost_admin import GhostAdminClient, TokenProvider, TOKEN_LIFETIME, TOKEN_REFRESH_MARGIN
+from ghost_tags import with_related_tags
+
+ADMIN_KEY = '0123456789abcdef01234567:' + '0123456789abcdef' * 4
+
+
+@pytest.fixture
+def stub_ghost():
+    # One post behind a minimal Admin API. Each PUT answer is taken from
+    # state['put_answers'] until it runs out, then the PUT is saved.
+    state = {
+        'post': {'id': 'p1', 'updated_at': '2024-01-02T00:00:00.000Z', 'tags': [{'name': 'Fresh', 'slug': 'fresh'}]},
+        'put_answers': [],
+        'requests': [],
+    }
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def answer(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            state['requests'].append(('GET', None))
+            self.answer(200, {'posts': [state['post']]})
+
+        def do_PUT(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            state['requests'].append(('PUT', body['posts'][0]))
+            if len(state['put_answers']) > 0:
+                self.answer(*state['put_answers'].pop(0))
+                return
+            state['post'] = dict(state['post'], tags=body['posts'][0]['tags'])
+            self.answer(200, {'posts': [state['post']]})
+
+    server = HTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield GhostAdminClient('http://127.0.0.1:'+str(server.server_address[1]), ADMIN_KEY), state
+    server.shutdown()
+
+
+def stale_snapshot():
+    return {'id': 'p1', 'updated_at': '2024-01-01T00:00:00.000Z', 'tags': [{'name': 'Stale', 'slug': 'stale'}]}
+
+
+@pytest.mark.parametrize('collision', [
+    (409, {'errors': [{'type': 'UpdateCollisionError'}]}),
+    (422, {'errors': [{'type': 'UpdateCollisionError', 'message': 'Saving failed! Someone else is editing this post.'}]}),
+])
+def test_a_collision_refetches_once_and_rebuilds_the_tags(stub_ghost, collision):
+    client, state = stub_ghost
+    state['put_answers'] = [collision]
+    post = client.update_post_tags(stale_snapshot(), lambda tags: with_related_tags(tags, ['r1']))
+
+    assert [method for method, _ in state['requests']] == ['PUT', 'GET', 'PUT']
+    retried = state['requests'][2][1]
+    assert retried['updated_at'] == '2024-01-02T00:00:00.000Z'
+    assert [tag['name'] for tag in retried['tags']] == ['Fresh', '#r1']
+    assert [tag['name'] for tag in post['tags']] == ['Fresh', '#r1']
+
+
+def test_other_client_errors_raise_without_a_refetch(stub_ghost):
+    client, state = stub_ghost
+    state['put_answers'] = [(422, {'errors': [{'type': 'ValidationError'}]})]
+    with pytest.raises(requests.exceptions.HTTPError):
+        client.update_post_tags(stale_snapshot(), lambda tags: with_related_tags(tags, ['r1']))
+    assert [method for method, _ in state['requests']] == ['PUT']
+
+
+def test_unchanged_tags_send_no_request(stub_ghost):
+    client, state = stub_ghost
+    snapshot = {'id': 'p1', 'updated_at': '2024-01-01T00:00:00.000Z', 'tags': [{'name': 'Stale', 'slug': 'stale'}, {'name': '#r1', 'slug': 'r1'}, {'name': '#r2', 'slug': 'r2'}]}
+    # Same tags with the related posts reordered
+    assert client.update_post_tags(snapshot, lambda tags: with_related_tags(tags, ['r2', 'r1'])) is None
+    assert state['requests'] == []
+
+
+def test_tokens_are_reused_until_the_refresh_time():
+    import jwt
+    now = [1000.0]
+    provider = TokenProvider(ADMIN_KEY, clock=lambda: now[0])
+    first = provider.authorization()
+    payload = jwt.decode(first[len('Ghost '):], provider.secret, algorithms=['HS256'], audience='/admin/', options={'verify_exp': False})
+    assert payload['exp'] - payload['iat'] == TOKEN_LIFETIME
+
+    now[0] += TOKEN_LIFETIME - TOKEN_REFRESH_MARGIN - 1
+    assert provider.authorization() == first
+    now[0] += 1
+    assert provider.authorization() != first
+
+
+def test_racing_threads_sign_once():
+    signed = []
+
+    class SlowProvider(TokenProvider):
+        def sign(self, iat):
+            signed.append(iat)
+            time.sleep(0.05)
+            return TokenProvider.sign(self, iat)
+
+    provider = SlowProvider(ADMIN_KEY)
+    barrier = threading.Barrier(8)
+    values = []
+
+    def authorize():
+        barrier.wait()
+        values.append(provider.authorization())
+
+    threads = [threading.Thread(target=authorize) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(signed) == 1
+    assert len(set(values)) == 1
@@ -0,0 +1,41 @@
+import numpy as np
+
+from ghost_ann import IVFIndex, recall_at_k, recall_report, DEFAULT_NPROBE
+from ghost_similarity import top_k_similar
+
+
+def clustered_corpus(n, dim, clusters, seed=0):
+    # Random posts grouped around topics, closer to real embeddings than pure noise
+    rng = np.random.default_rng(seed)
+    topics = rng.standard_normal((clusters, dim)).astype(np.float32)
+    return topics[rng.integers(0, clusters, n)] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+
+
+def build_index(n=4000, dim=64):
+    matrix = clustered_corpus(n, dim, 50)
+    blog_ids = ['post'+str(i) for i in range(n)]
+    versions = list(range(n))
+    return blog_ids, versions, matrix, IVFIndex.build(blog_ids, versions, matrix, seed=0)
+
+
+def test_probing_every_list_matches_exact_search():
+    _, _, matrix, index = build_index()
+    indices, _ = index.top_k_similar(10, nprobe=index.n_lists)
+    exact, _ = top_k_similar(matrix, 10)
+    assert recall_at_k(indices, exact) >= 0.999
+
+
+def test_default_nprobe_recall():
+    _, _, _, index = build_index()
+    results = recall_report(index, 10, sample=500, seed=0)
+    assert dict((nprobe, recall) for nprobe, recall, _ in results)[DEFAULT_NPROBE] >= 0.9
+
+
+def test_save_and_load_keep_assignments(tmp_path):
+    blog_ids, versions, matrix, index = build_index()
+    path = str(tmp_path / 'index.npz')
+    index.save(path)
+    loaded = IVFIndex.load(path)
+    versions[0] = len(blog_ids)
+    assert loaded.attach(blog_ids, versions, matrix) == 1
+    assert loaded.n_lists == index.n_lists
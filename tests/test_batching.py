@@ -0,0 +1,51 @@
+from ghost_batching import embed_with_bisection
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__('status '+str(status_code))
+        self.status_code = status_code
+
+
+def items(count):
+    return [{'text': 'post '+str(i)} for i in range(count)]
+
+
+def test_a_rejected_input_only_fails_itself():
+    calls = []
+    failed = []
+
+    def embed_many(texts):
+        calls.append(len(texts))
+        if 'post 5' in texts:
+            raise StatusError(400)
+        return [[float(len(text))] for text in texts]
+
+    results = embed_with_bisection(items(8), embed_many, lambda item, e: failed.append(item['text']))
+    assert [item['text'] for item, _ in results] == ['post '+str(i) for i in range(8) if i != 5]
+    assert failed == ['post 5']
+
+
+def test_retryable_errors_fail_the_whole_batch_without_splitting():
+    calls = []
+    failed = []
+
+    def embed_many(texts):
+        calls.append(len(texts))
+        raise StatusError(429)
+
+    assert embed_with_bisection(items(8), embed_many, lambda item, e: failed.append(item['text'])) == []
+    assert calls == [8]
+    assert len(failed) == 8
+
+
+def test_chunks_without_tiktoken_stay_under_the_limit_for_any_script(monkeypatch):
+    import ghost_batching
+    monkeypatch.setattr(ghost_batching, '_encoding', False)
+    for text in ['word '*5000, '東京の天気は晴れです。'*1000, 'x=[i**2 for i in range(10)];'*800]:
+        chunks = ghost_batching.chunk_text(text, 1000, 50)
+        assert len(chunks) > 1
+        assert all(len(chunk.encode('utf-8')) <= 1000 for chunk in chunks)
+        assert all(ghost_batching.estimate_tokens(chunk) >= len(chunk) for chunk in chunks)
+        assert chunks[0] == text[:len(chunks[0])]
+        assert text.endswith(chunks[-1])
@@ -0,0 +1,20 @@
+import numpy as np
+
+from ghost_embedding_backends import HashingBackend, DEFAULT_LOCAL_DIMENSIONS
+
+TEXTS = [
+    'Ghost themes can be customised with handlebars templates and partials',
+    'Customising a Ghost theme: handlebars templates, partials and helpers',
+    'Sourdough bread needs a starter, flour, water and a long cold proof',
+]
+
+
+def test_hashing_backend_is_deterministic():
+    vectors = np.asarray(HashingBackend().embed(TEXTS))
+    assert vectors.shape == (3, DEFAULT_LOCAL_DIMENSIONS)
+    assert np.allclose(vectors, np.asarray(HashingBackend().embed(TEXTS)))
+
+
+def test_related_posts_score_higher_than_unrelated():
+    vectors = np.asarray(HashingBackend().embed(TEXTS))
+    assert float(vectors[0] @ vectors[1]) > float(vectors[0] @ vectors[2])
@@ -0,0 +1,32 @@
+import time
+
+from ghost_embedding_cache import EmbeddingCache
+
+
+def test_lookups_ignore_whitespace_and_separate_models(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / 'cache.sqlite'), max_entries=3)
+    cache.put_many('model-a', ['one', 'two', 'three'], [[1.0, 0.0], [0.0, 1.0], [0.5, 0.5]])
+    assert cache.get_many('model-a', [' one\n', 'two', 'four']) == [[1.0, 0.0], [0.0, 1.0], None]
+    assert cache.get_many('model-b', ['one']) == [None]
+    cache.close()
+
+
+def test_least_recently_used_entry_is_evicted_and_the_rest_persist(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = EmbeddingCache(path, max_entries=3)
+    cache.put_many('model-a', ['one', 'two', 'three'], [[1.0, 0.0], [0.0, 1.0], [0.5, 0.5]])
+    # 'two' is used after 'three', and 'one' after both
+    time.sleep(0.01)
+    cache.get_many('model-a', ['two'])
+    time.sleep(0.01)
+    cache.get_many('model-a', ['one'])
+    cache.put_many('model-a', ['four'], [[0.25, 0.75]])
+    assert cache.count == 3
+    assert cache.get_many('model-a', ['three'])[0] is None
+    assert cache.get_many('model-a', ['one'])[0] is not None
+    cache.close()
+
+    reopened = EmbeddingCache(path, max_entries=3)
+    assert reopened.count == 3
+    assert reopened.get_many('model-a', ['four'])[0] == [0.25, 0.75]
+    reopened.close()
@@ -0,0 +1,145 @@
+import os
+
+import numpy as np
+import pytest
+
+from ghost_embedding_store import EmbeddingStore, migrateLegacyEmbeddings, openEmbeddingStore, VECTOR_FILE, INDEX_FILE
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    return str(tmp_path / 'embeddings')
+
+
+def vector(value, dim=4):
+    return [float(value)] * dim
+
+
+def test_last_record_wins_and_deletes_survive_reopening(store_path):
+    store = EmbeddingStore(store_path)
+    store.append_many([
+        {'blog_id': 'a', 'title': 'A', 'embedding': vector(1), 'content_hash': 'h1'},
+        {'blog_id': 'b', 'title': 'B', 'embedding': vector(2), 'content_hash': 'h2'},
+        {'blog_id': 'c', 'title': 'C', 'embedding': vector(3), 'content_hash': 'h3'},
+    ])
+    store.append('a', 'A again', vector(4), 'h4')
+    assert store.delete('b')
+    assert not store.delete('b')
+
+    reopened = EmbeddingStore(store_path)
+    assert set(reopened.ids()) == {'a', 'c'}
+    assert reopened.get('a')['content_hash'] == 'h4'
+    blog_ids, titles, matrix = reopened.load()
+    assert dict(zip(blog_ids, titles)) == {'a': 'A again', 'c': 'C'}
+    assert matrix[blog_ids.index('a')].tolist() == vector(4)
+    assert matrix[blog_ids.index('c')].tolist() == vector(3)
+
+
+def test_dimension_mismatch_is_rejected(store_path):
+    store = EmbeddingStore(store_path)
+    store.append('a', 'A', vector(1))
+    with pytest.raises(ValueError):
+        store.append('b', 'B', vector(1, dim=3))
+
+
+def test_update_metadata_keeps_the_row(store_path):
+    store = EmbeddingStore(store_path)
+    store.append('a', 'A', vector(1), 'h1', updated_at='2024-01-01')
+    row = store.get('a')['row']
+    store.update_metadata([('a', {'updated_at': '2024-02-01'}), ('missing', {'updated_at': '2024-02-01'})])
+
+    reopened = EmbeddingStore(store_path)
+    assert reopened.get('a')['row'] == row
+    assert reopened.get('a')['updated_at'] == '2024-02-01'
+    assert reopened.get('a')['content_hash'] == 'h1'
+    assert 'missing' not in reopened
+
+
+def test_torn_vector_row_and_index_line_are_repaired(store_path):
+    store = EmbeddingStore(store_path)
+    store.append('a', 'A', vector(1))
+    store.append('b', 'B', vector(2))
+    # An append interrupted after half a row of vectors, and one interrupted in
+    # the middle of its index record
+    with open(os.path.join(store_path, VECTOR_FILE), 'ab') as f:
+        f.write(np.asarray(vector(9), dtype=np.float32).tobytes()[:6])
+    with open(os.path.join(store_path, INDEX_FILE), 'a') as f:
+        f.write('{"op": "put", "blog_id": "c", "ro')
+
+    repaired = EmbeddingStore(store_path)
+    assert set(repaired.ids()) == {'a', 'b'}
+    assert os.path.getsize(os.path.join(store_path, VECTOR_FILE)) == 2 * 4 * 4
+    repaired.append('c', 'C', vector(3))
+
+    reopened = EmbeddingStore(store_path)
+    assert set(reopened.ids()) == {'a', 'b', 'c'}
+    blog_ids, _, matrix = reopened.load()
+    assert matrix[blog_ids.index('c')].tolist() == vector(3)
+
+
+def test_index_records_past_the_last_vector_are_ignored(store_path):
+    # Vectors are synced before their index records, but a record pointing past the
+    # end of the vectors must never be trusted
+    store = EmbeddingStore(store_path)
+    store.append('a', 'A', vector(1))
+    with open(os.path.join(store_path, INDEX_FILE), 'a') as f:
+        f.write('{"op": "put", "blog_id": "b", "row": 5}\n')
+    assert EmbeddingStore(store_path).ids() == ['a']
+
+
+def test_compact_keeps_live_vectors_only(store_path):
+    store = EmbeddingStore(store_path)
+    for value in range(3):
+        store.append('a', 'A', vector(value))
+    store.append('b', 'B', vector(7))
+    store.append('c', 'C', vector(8))
+    store.delete('b')
+
+    assert store.compact() == 2
+    assert os.path.getsize(os.path.join(store_path, VECTOR_FILE)) == 2 * 4 * 4
+    reopened = EmbeddingStore(store_path)
+    blog_ids, _, matrix = reopened.load()
+    assert blog_ids == ['a', 'c']
+    assert matrix.tolist() == [vector(2), vector(8)]
+
+
+def test_legacy_csv_embeddings_are_migrated_once(tmp_path):
+    import pandas as pd
+    for blog_id, value in (('abc123', 1), ('def456', 2)):
+        pd.DataFrame({'blog_id': [blog_id], 'title': ['Post '+blog_id], 'embedding': [vector(value)]}).to_csv(str(tmp_path / ('blog-'+blog_id+'-embedding.csv')), index=None)
+    (tmp_path / 'blog-broken-embedding.csv').write_text('not,a,csv\n')
+
+    store = openEmbeddingStore(str(tmp_path))
+    assert set(store.ids()) == {'abc123', 'def456'}
+    assert store.get('abc123')['title'] == 'Post abc123'
+    blog_ids, _, matrix = store.load()
+    assert matrix[blog_ids.index('def456')].tolist() == vector(2)
+    assert migrateLegacyEmbeddings(str(tmp_path), store) == 0
+
+
+def test_versions_survive_compaction(store_path):
+    store = EmbeddingStore(store_path)
+    store.append_many([{'blog_id': blog_id, 'title': blog_id, 'embedding': vector(i)} for i, blog_id in enumerate('abcd')])
+    store.append('a', 'A', vector(5))
+    store.delete('b')
+    before = {blog_id: store.version(blog_id) for blog_id in store.ids()}
+
+    store.compact()
+    reopened = EmbeddingStore(store_path)
+    assert {blog_id: reopened.version(blog_id) for blog_id in reopened.ids()} == before
+    # Later vectors still get versions no post has had, although rows start over
+    reopened.append('c', 'C', vector(6))
+    reopened.append('e', 'E', vector(7))
+    assert reopened.version('c') > max(before.values())
+    assert reopened.version('e') > reopened.version('c')
+
+
+def test_records_without_a_version_use_their_row(store_path):
+    store = EmbeddingStore(store_path)
+    store.append('a', 'A', vector(1))
+    with open(os.path.join(store_path, INDEX_FILE), 'w') as f:
+        f.write('{"op": "put", "blog_id": "a", "title": "A", "row": 0}\n')
+    reopened = EmbeddingStore(store_path)
+    assert reopened.version('a') == 0
+    reopened.append('b', 'B', vector(2))
+    assert reopened.version('b') == 1
@@ -0,0 +1,26 @@
+from ghost_journal import RunJournal, JOURNAL_FILE, TAGGED, WRITTEN
+
+
+def test_only_unfinished_runs_of_the_same_mode_are_resumed(tmp_path):
+    path = str(tmp_path / JOURNAL_FILE)
+    journal = RunJournal(path, 'tag_blogs', 'llm reset')
+    journal.record('a', TAGGED, ['PYTHON', 'GHOST'])
+    journal.record('a', WRITTEN)
+    journal.record('b', TAGGED, ['COOKING'])
+    journal.close()
+
+    other = RunJournal(path, 'tag_blogs', 'llm', resume=True)
+    assert not other.resumed
+    other.close()
+
+    resumed = RunJournal(path, 'tag_blogs', 'llm reset', resume=True)
+    assert resumed.resumed
+    assert resumed.completed(TAGGED) == {'a': ['PYTHON', 'GHOST'], 'b': ['COOKING']}
+    assert set(resumed.completed(WRITTEN)) == {'a'}
+    resumed.finish()
+    resumed.close()
+
+    again = RunJournal(path, 'tag_blogs', 'llm reset', resume=True)
+    assert not again.resumed
+    assert len(again.completed(TAGGED)) == 0
+    again.close()
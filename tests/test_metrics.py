@@ -0,0 +1,31 @@
+import time
+
+from ghost_metrics import Metrics
+
+
+def recorded_metrics():
+    metrics = Metrics()
+    for value in (0.002, 0.004, 0.02, 0.03, 0.5):
+        metrics.observe('ghost_put', value)
+    with metrics.timer('extraction'):
+        time.sleep(0.01)
+    metrics.increment('retries')
+    metrics.increment('retries', 2)
+    return metrics
+
+
+def test_counters_timings_and_quantiles():
+    summary = recorded_metrics().summary()
+    put = summary['timings']['ghost_put']
+    assert put['count'] == 5
+    assert abs(put['total_seconds'] - 0.556) < 1e-9
+    assert 0.02 <= put['p50_seconds'] <= 0.032
+    assert put['p99_seconds'] == 0.5
+    assert summary['counters'] == {'retries': 3}
+    assert summary['timings']['extraction']['total_seconds'] >= 0.01
+
+
+def test_prometheus_textfile():
+    text = recorded_metrics().textfile({'script': 'test'})
+    assert 'ghostai_retries_total{script="test"} 3' in text
+    assert 'ghostai_ghost_put_seconds_bucket{script="test",le="+Inf"} 5' in text
@@ -0,0 +1,53 @@
+import numpy as np
+
+from ghost_neighbours import NeighbourTable
+
+
+def test_incremental_updates_match_a_full_rebuild():
+    # Apply adds, re-embeds and deletes incrementally and compare with a full rebuild
+    n, dim, k = 400, 32, 10
+    rng = np.random.default_rng(0)
+    blog_ids = ['post'+str(i) for i in range(n)]
+    versions = list(range(n))
+    matrix = rng.standard_normal((n, dim)).astype(np.float32)
+    table = NeighbourTable.build(blog_ids, versions, matrix, k, block_size=64)
+
+    next_version = n
+    for step in range(3):
+        for _ in range(5):
+            blog_ids.append('post'+str(next_version))
+            versions.append(next_version)
+            matrix = np.vstack([matrix, rng.standard_normal((1, dim)).astype(np.float32)])
+            next_version += 1
+        for i in rng.choice(len(blog_ids), 2, replace=False):
+            versions[i] = next_version
+            matrix[i] = rng.standard_normal(dim)
+            next_version += 1
+        keep = np.ones(len(blog_ids), dtype=bool)
+        keep[rng.choice(len(blog_ids), 3, replace=False)] = False
+        deleted = [blog_id for blog_id, kept in zip(blog_ids, keep) if not kept]
+        blog_ids = [blog_id for blog_id, kept in zip(blog_ids, keep) if kept]
+        versions = [version for version, kept in zip(versions, keep) if kept]
+        matrix = matrix[keep]
+
+        table.update(blog_ids, versions, matrix, block_size=64)
+        expected = NeighbourTable.build(blog_ids, versions, matrix, k, block_size=64)
+        for blog_id in blog_ids:
+            assert table.neighbours[blog_id][0] == expected.neighbours[blog_id][0], "step "+str(step)+", "+blog_id
+        for blog_id in deleted:
+            assert blog_id not in table.neighbours
+
+
+def test_compaction_does_not_count_as_re_embedding(tmp_path):
+    from ghost_embedding_store import EmbeddingStore
+    rng = np.random.default_rng(0)
+    store = EmbeddingStore(str(tmp_path / 'embeddings'))
+    store.append_many([{'blog_id': 'post'+str(i), 'title': '', 'embedding': rng.standard_normal(16).tolist()} for i in range(50)])
+    for i in range(0, 50, 5):
+        store.append('post'+str(i), '', rng.standard_normal(16).tolist())
+    blog_ids, _, matrix = store.load()
+    table = NeighbourTable.build(blog_ids, [store.version(blog_id) for blog_id in blog_ids], matrix, 5)
+
+    store.compact()
+    blog_ids, _, matrix = store.load()
+    assert table.update(blog_ids, [store.version(blog_id) for blog_id in blog_ids], matrix) == set()
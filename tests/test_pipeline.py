@@ -0,0 +1,83 @@
+import itertools
+import threading
+
+import pytest
+
+from ghost_pipeline import Stage, run_pipeline
+
+
+def finish(fn, timeout=10):
+    # Run fn on a thread and fail instead of hanging if the pipeline deadlocks
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = fn()
+        except BaseException as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "pipeline did not finish"
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
+
+
+def batches(items, size=7):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def test_multi_worker_stages_deliver_every_item_and_end():
+    stages = [
+        Stage('square', lambda item: [item * item], 4),
+        Stage('batch', batches, stream=True),
+        Stage('sum', lambda batch: [sum(batch)], 3),
+    ]
+    # A queue size below the number of items makes the stages wait on each other
+    results = finish(lambda: list(run_pipeline(range(500), stages, queue_size=4)))
+    assert sum(results) == sum(item * item for item in range(500))
+    assert len(results) == -(-500 // 7)
+
+
+def test_stages_with_more_workers_than_items_end():
+    stages = [Stage('one', lambda item: [item], 8), Stage('two', lambda item: [item, item], 8)]
+    assert sorted(finish(lambda: list(run_pipeline([1, 2], stages)))) == [1, 1, 2, 2]
+    assert finish(lambda: list(run_pipeline([], stages))) == []
+
+
+def test_the_first_error_stops_every_stage_and_is_raised():
+    started = []
+
+    def fail_at_fifty(item):
+        if item == 50:
+            raise ValueError('bad item')
+        return [item]
+
+    def record(item):
+        started.append(item)
+        return [item]
+
+    # An endless source: only the error can end this run
+    stages = [Stage('fail', fail_at_fifty, 4), Stage('record', record, 2)]
+    with pytest.raises(ValueError, match='bad item'):
+        finish(lambda: list(run_pipeline(itertools.count(), stages, queue_size=4)))
+    assert len(started) < 1000
+    assert all(thread.name.startswith('pipeline-') is False for thread in threading.enumerate())
+
+
+def test_an_error_in_the_source_is_raised():
+    def source():
+        yield 1
+        raise RuntimeError('listing failed')
+
+    with pytest.raises(RuntimeError, match='listing failed'):
+        finish(lambda: list(run_pipeline(source(), [Stage('same', lambda item: [item], 2)])))
@@ -0,0 +1,76 @@
+import json
+import time
+import threading
+
+import pytest
+import requests
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from ghost_ratelimit import TokenBucket, RateLimiter, AdaptiveConcurrency, call_with_retry
+
+
+@pytest.fixture
+def stub_server():
+    # A local server that answers 429 with Retry-After to the first two /throttled calls
+    state = {'calls': 0, 'throttle': 2}
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            state['calls'] += 1
+            if self.path.startswith('/throttled') and state['throttle'] > 0:
+                state['throttle'] -= 1
+                self.send_response(429)
+                self.send_header('Retry-After', '0.2')
+                self.end_headers()
+                return
+            body = json.dumps({'ok': True}).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = HTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:'+str(server.server_address[1]), state
+    server.shutdown()
+
+
+def test_retry_after_is_honored_and_concurrency_backs_off(stub_server):
+    base, state = stub_server
+    concurrency = AdaptiveConcurrency(8)
+    start = time.monotonic()
+    response = call_with_retry(lambda: requests.get(base+'/throttled'), concurrency=concurrency)
+    elapsed = time.monotonic() - start
+    assert response.status_code == 200
+    assert state['calls'] == 3
+    assert elapsed >= 0.4
+    assert concurrency.limit == 2
+
+
+def test_token_bucket_holds_the_request_rate(stub_server):
+    base, _ = stub_server
+    limiter = RateLimiter(requests_per_minute=1200)
+    session = requests.Session()
+    start = time.monotonic()
+    for _ in range(40):
+        call_with_retry(lambda: session.get(base+'/ok'), limiter)
+    # 20 requests of burst, then 20 more at 20/s
+    assert 0.9 <= time.monotonic() - start <= 3.0
+
+
+def test_pause_holds_callers_back_without_a_rate():
+    now = [0.0]
+    slept = []
+
+    def sleep(seconds):
+        slept.append(seconds)
+        now[0] += seconds
+
+    bucket = TokenBucket(0, clock=lambda: now[0], sleep=sleep)
+    assert bucket.acquire() == 0.0
+    bucket.pause(2.5)
+    assert bucket.acquire() == 2.5
+    assert slept == [2.5]
@@ -0,0 +1,34 @@
+import numpy as np
+
+from ghost_similarity import top_k_similar
+
+
+def brute_force_top_k(matrix, k):
+    # Reference implementation: one cosine per pair, full sort per row
+    matrix = np.asarray(matrix, dtype=np.float64)
+    n = matrix.shape[0]
+    indices = []
+    scores = []
+    for i in range(n):
+        similarities = []
+        for j in range(n):
+            if i == j:
+                continue
+            similarity = np.dot(matrix[i], matrix[j]) / (np.linalg.norm(matrix[i]) * np.linalg.norm(matrix[j]))
+            similarities.append((similarity, j))
+        similarities.sort(key=lambda item: -item[0])
+        indices.append([j for _, j in similarities[:k]])
+        scores.append([s for s, _ in similarities[:k]])
+    return np.array(indices, dtype=np.int64), np.array(scores, dtype=np.float64)
+
+
+def test_top_k_similar_matches_brute_force():
+    # An odd block size makes sure rows straddling block boundaries are covered
+    rng = np.random.default_rng(0)
+    matrix = rng.standard_normal((300, 64)).astype(np.float32)
+
+    indices, scores = top_k_similar(matrix, 20, block_size=37)
+    expected_indices, expected_scores = brute_force_top_k(matrix, 20)
+
+    assert np.array_equal(indices, expected_indices)
+    assert np.allclose(scores, expected_scores, atol=1e-5)
@@ -0,0 +1,25 @@
+import numpy as np
+
+from ghost_tag_vocabulary import TagVocabulary
+
+
+def test_clusters_are_labelled_once_and_assigned_back():
+    # Posts around four topics, titled after their topic; the labeller names a cluster
+    # after the most common title among the posts it is shown
+    rng = np.random.default_rng(0)
+    topics = ['PYTHON', 'COOKING', 'TRAVEL', 'MUSIC']
+    topic_vectors = rng.standard_normal((len(topics), 32)).astype(np.float32)
+    labels = rng.integers(0, len(topics), 400)
+    matrix = topic_vectors[labels] + 0.6 * rng.standard_normal((400, 32)).astype(np.float32)
+    titles = [topics[label] for label in labels]
+    calls = []
+
+    def label_cluster(cluster_titles):
+        calls.append(cluster_titles)
+        return max(set(cluster_titles), key=cluster_titles.count)
+
+    vocabulary = TagVocabulary.from_clusters(matrix, titles, label_cluster, n_clusters=8, seed=0)
+    assigned = vocabulary.assign(matrix, 3)
+    correct = sum(1 for tags, title in zip(assigned, titles) if len(tags) > 0 and tags[0] == title)
+    assert len(calls) <= 8
+    assert correct >= 0.95 * len(titles)
@@ -0,0 +1,15 @@
+from ghost_text import extract_text
+from fake_services import sample_post
+
+
+def test_every_format_extracts_the_same_text():
+    paragraphs = ['Paragraph '+str(i)+' with  some text, <tags> & "quotes".' for i in range(30)]
+    texts = {name: extract_text(post) for name, post in sample_post(paragraphs).items()}
+    assert texts['lexical'] == texts['mobiledoc']
+    assert texts['html'] == texts['mobiledoc']
+
+
+def test_html_tags_and_scripts_are_dropped():
+    text = extract_text(sample_post(['Paragraph with <tags> & "quotes".'] * 10)['html'])
+    assert 'track()' not in text
+    assert '<' not in text.replace('<tags>', '')